@@ -48,15 +48,15 @@ except (ImportError, AssertionError):
     print "*******"
     sys.exit(1)
 
+import copy
 import logging
-import requests
 
-from twisted.internet import defer
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
 from urlparse import urlparse
 
 from leap.common.check import leap_assert
 from leap.common.events import emit, catalog
-from leap.common.decorators import memoized_method
 
 from leap.keymanager.errors import (
     KeyNotFound,
@@ -65,14 +65,21 @@ from leap.keymanager.errors import (
     UnsupportedKeyTypeError,
     InvalidSignature
 )
+from leap.keymanager import cache
+from leap.keymanager.http import HTTPClient, HTTPError
 from leap.keymanager.validation import ValidationLevels, can_upgrade
 
 from leap.keymanager.keys import (
     build_key_from_dict,
     KEYMANAGER_KEY_TAG,
+    KEYMANAGER_USAGE_TAG,
     TAGS_PRIVATE_INDEX,
 )
-from leap.keymanager.openpgp import OpenPGPKey, OpenPGPScheme
+from leap.keymanager.openpgp import (
+    OpenPGPKey,
+    OpenPGPScheme,
+    DEFAULT_GPG_THREADS,
+)
 
 from ._version import get_versions
 
@@ -82,6 +89,11 @@ del get_versions
 logger = logging.getLogger(__name__)
 
 
+# the maximum number of keys fetched from the nickserver at once by
+# get_keys.
+MAX_CONCURRENT_FETCHES = 4
+
+
 #
 # The Key Manager
 #
@@ -134,9 +146,52 @@ class KeyManager(object):
             OpenPGPKey: OpenPGPScheme(soledad, gpgbinary=gpgbinary),
             # other types of key will be added to this mapper.
         }
-        # the following are used to perform https requests
-        self._fetcher = requests
-        self._session = self._fetcher.session()
+        # the following is used to perform https requests
+        self._fetcher = HTTPClient()
+        # the Deferreds waiting for the key lookups in progress.
+        self._lookups = {}
+        # the outcome of recent nickserver lookups by address.
+        self._lookup_cache = cache.LookupCache()
+        self._fetch_semaphore = defer.DeferredSemaphore(
+            MAX_CONCURRENT_FETCHES)
+
+    def close(self):
+        """
+        Release the resources held by the key type handlers and close the
+        persistent HTTP connections.
+
+        :return: A Deferred which fires when the key type handlers wrote
+                 their pending changes and the connections are closed.
+        :rtype: Deferred
+        """
+        deferreds = [defer.maybeDeferred(wrapper.close)
+                     for wrapper in self._wrapper_map.values()]
+        deferreds.append(self._fetcher.close())
+        d = defer.gatherResults(deferreds, consumeErrors=True)
+        d.addCallback(lambda _: None)
+        return d
+
+    def get_lookup_cache_stats(self):
+        """
+        Return the hit and miss counters and the number of entries of the
+        nickserver lookup cache.
+
+        :rtype: dict
+        """
+        return self._lookup_cache.stats()
+
+    def get_http_stats(self):
+        """
+        Return statistics of the requests sent to the nickserver and the
+        webapp, useful to size the HTTP connection pool.
+
+        :return: A dict mapping 'host:port' to a dict with the number of
+                 requests sent, in progress, waiting for a connection and
+                 failed, of connections opened and of attempts to resume
+                 a TLS session.
+        :rtype: dict
+        """
+        return self._fetcher.stats()
 
     #
     # utilities
@@ -157,26 +212,21 @@ class KeyManager(object):
         :param uri: The URI of the request.
         :type uri: str
         :param data: The body of the request.
-        :type data: dict, str or file
+        :type data: dict or str
 
-        :return: The response to the request.
-        :rtype: requests.Response
+        :return: A Deferred which fires with the response to the request.
+        :rtype: Deferred
         """
         leap_assert(
             self._ca_cert_path is not None,
             'We need the CA certificate path!')
-        res = self._fetcher.get(uri, data=data, verify=self._ca_cert_path)
         # Nickserver now returns 404 for key not found and 500 for
-        # other cases (like key too small), so we are skipping this
-        # check for the time being
-        # res.raise_for_status()
+        # other cases (like key too small), so we are not checking the
+        # response status here for the time being.
 
-        # Responses are now text/plain, although it's json anyway, but
-        # this will fail when it shouldn't
-        # leap_assert(
-        #     res.headers['content-type'].startswith('application/json'),
-        #     'Content-type is not JSON.')
-        return res
+        # Responses are now text/plain, although it's json anyway, so we
+        # don't check the content-type either.
+        return self._fetcher.get(uri, data=data, verify=self._ca_cert_path)
 
     def _put(self, uri, data=None):
         """
@@ -189,10 +239,11 @@ class KeyManager(object):
         :param uri: The URI of the request.
         :type uri: str
         :param data: The body of the request.
-        :type data: dict, str or file
+        :type data: dict or str
 
-        :return: The response to the request.
-        :rtype: requests.Response
+        :return: A Deferred which fires with the response to the request,
+                 or which fails with HTTPError if the response is an error.
+        :rtype: Deferred
         """
         leap_assert(
             self._ca_cert_path is not None,
@@ -200,14 +251,18 @@ class KeyManager(object):
         leap_assert(
             self._token is not None,
             'We need a token to interact with webapp!')
-        res = self._fetcher.put(
+        d = self._fetcher.put(
             uri, data=data, verify=self._ca_cert_path,
             headers={'Authorization': 'Token token=%s' % self._token})
-        # assert that the response is valid
-        res.raise_for_status()
-        return res
 
-    @memoized_method(invalidation=300)
+        def check_status(res):
+            # assert that the response is valid
+            res.raise_for_status()
+            return res
+
+        d.addCallback(check_status)
+        return d
+
     def _fetch_keys_from_server(self, address):
         """
         Fetch keys bound to address from nickserver and insert them in
@@ -222,14 +277,38 @@ class KeyManager(object):
         :rtype: Deferred
 
         """
-        # request keys from the nickserver
-        d = defer.succeed(None)
-        res = None
-        try:
-            res = self._get(self._nickserver_uri, {'address': address})
+        # recent outcomes are replayed from the lookup cache.
+        cached = self._lookup_cache.get(address)
+        if cached is not None:
+            outcome, error = cached
+            if outcome == cache.FOUND:
+                return defer.succeed(None)
+            return defer.fail(error)
+
+        def check_response(res):
             res.raise_for_status()
-            server_keys = res.json()
+            return res.json()
 
+        def key_not_found(failure):
+            if failure.check(HTTPError):
+                e = failure.value
+                logger.warning("HTTP error retrieving key: %r" % (e,))
+                logger.warning("%s" % (e.response.content,))
+                if e.response.status_code == 404:
+                    error = KeyNotFound(address)
+                    self._lookup_cache.add(address, cache.NOT_FOUND, error)
+                    raise error
+                error = KeyNotFound(str(e))
+            else:
+                logger.warning("Error retrieving key: %r" % (failure.value,))
+                error = KeyNotFound(str(failure.value))
+            self._lookup_cache.add(address, cache.ERROR, error)
+            raise error
+
+        def key_stored(_):
+            self._lookup_cache.add(address, cache.FOUND)
+
+        def put_server_keys(server_keys):
             # insert keys in local database
             if self.OPENPGP_KEY in server_keys:
                 # nicknym server is authoritative for its own domain,
@@ -244,16 +323,21 @@ class KeyManager(object):
                     OpenPGPKey,
                     address=address,
                     validation=validation_level)
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 404:
-                d = defer.fail(KeyNotFound(address))
-            else:
-                d = defer.fail(KeyNotFound(e.message))
-            logger.warning("HTTP error retrieving key: %r" % (e,))
-            logger.warning("%s" % (res.content,))
-        except Exception as e:
-            d = defer.fail(KeyNotFound(e.message))
-            logger.warning("Error retrieving key: %r" % (e,))
+                # failing to store the key, e.g. if it is not a valid upgrade
+                # of the local one, is not a server error to be remembered.
+                d.addCallback(key_stored)
+                return d
+
+            error = KeyNotFound(address)
+            self._lookup_cache.add(address, cache.NOT_FOUND, error)
+            raise error
+
+        # request keys from the nickserver
+        d = defer.maybeDeferred(
+            self._get, self._nickserver_uri, {'address': address})
+        d.addCallback(check_response)
+        d.addErrback(key_not_found)
+        d.addCallback(put_server_keys)
         return d
 
     #
@@ -286,8 +370,10 @@ class KeyManager(object):
                 self._api_uri,
                 self._api_version,
                 self._uid)
-            self._put(uri, data)
-            emit(catalog.KEYMANAGER_DONE_UPLOADING_KEYS, self._address)
+            d = self._put(uri, data)
+            d.addCallback(lambda _: emit(
+                catalog.KEYMANAGER_DONE_UPLOADING_KEYS, self._address))
+            return d
 
         d = self.get_key(
             self._address, ktype, private=False, fetch_remote=False)
@@ -323,6 +409,57 @@ class KeyManager(object):
         leap_assert(
             ktype in self._wrapper_map,
             'Unkown key type: %s.' % str(ktype))
+
+        return self._single_lookup(
+            (address, ktype, private, fetch_remote),
+            self._lookup_key, address, ktype, private, fetch_remote)
+
+    def _single_lookup(self, lookup, func, *args):
+        """
+        Call C{func} with C{args} to look up a key, unless a lookup for the
+        same key is in progress, sharing its result then.
+
+        Concurrent lookups for the same key share a single lookup, so the
+        key is fetched from the nickserver and stored only once.
+
+        :param lookup: The address, ktype, private and fetch_remote of the
+                       lookup.
+        :type lookup: tuple
+        :param func: A function returning a Deferred which fires with the
+                     key.
+        :type func: callable
+
+        :return: A Deferred which fires with the key, the callers sharing
+                 the lookup get copies of it.
+        :rtype: Deferred
+        """
+        if lookup in self._lookups:
+            d = defer.Deferred()
+            self._lookups[lookup].append(d)
+            return d
+        self._lookups[lookup] = []
+
+        def notify_waiters(result):
+            for d in self._lookups.pop(lookup):
+                if isinstance(result, Failure):
+                    d.errback(result)
+                else:
+                    # each caller gets its own copy of the key, as they
+                    # might change it.
+                    d.callback(copy.deepcopy(result))
+            return result
+
+        d = func(*args)
+        d.addBoth(notify_waiters)
+        return d
+
+    def _lookup_key(self, address, ktype, private, fetch_remote):
+        """
+        Look for a key in local storage and then in the nickserver, with the
+        arguments of C{get_key}.
+
+        :rtype: Deferred
+        """
         emit(catalog.KEYMANAGER_LOOKING_FOR_KEY, address)
 
         def key_found(key):
@@ -339,20 +476,97 @@ class KeyManager(object):
             # is True and the key is not private.
             if fetch_remote is False or private is True:
                 return failure
-
-            emit(catalog.KEYMANAGER_LOOKING_FOR_KEY, address)
-            d = self._fetch_keys_from_server(address)
-            d.addCallback(
-                lambda _:
-                self._wrapper_map[ktype].get_key(address, private=False))
-            d.addCallback(key_found)
-            return d
+            return self._fetch_key(address, ktype)
 
         # return key if it exists in local database
         d = self._wrapper_map[ktype].get_key(address, private=private)
         d.addCallbacks(key_found, key_not_found)
         return d
 
+    def _fetch_key(self, address, ktype):
+        """
+        Fetch the public key bound to C{address} from the nickserver, for a
+        key that is not in local storage.
+
+        :rtype: Deferred
+        """
+        def key_found(key):
+            emit(catalog.KEYMANAGER_KEY_FOUND, address)
+            return key
+
+        emit(catalog.KEYMANAGER_LOOKING_FOR_KEY, address)
+        d = self._fetch_keys_from_server(address)
+        # the stored key is cached, so this doesn't query local storage
+        d.addCallback(
+            lambda _: self._wrapper_map[ktype].get_key(address, private=False))
+        d.addCallback(key_found)
+        return d
+
+    def get_keys(self, addresses, ktype, private=False, fetch_remote=True):
+        """
+        Return the keys of type ktype bound to each of C{addresses}.
+
+        The keys in local storage are looked up at once, and only the
+        missing ones are fetched from nickserver, at most
+        MAX_CONCURRENT_FETCHES at a time, without looking them up locally
+        again.
+
+        :param addresses: The addresses bound to the keys.
+        :type addresses: list(str)
+        :param ktype: The type of the keys.
+        :type ktype: subclass of EncryptionKey
+        :param private: Look for private keys instead of public ones?
+        :type private: bool
+        :param fetch_remote: If a key is not found in local storage try to
+                             fetch it from nickserver
+        :type fetch_remote: bool
+
+        :return: A Deferred which fires with a dict mapping each address to
+                 its EncryptionKey of type ktype, or to a Failure if no key
+                 was found or it could not be fetched.
+        :rtype: Deferred
+
+        :raise UnsupportedKeyTypeError: if invalid key type
+        """
+        self._assert_supported_key_type(ktype)
+        addresses = set(addresses)
+        for address in addresses:
+            emit(catalog.KEYMANAGER_LOOKING_FOR_KEY, address)
+
+        def fetch_missing(keys):
+            results = {}
+            for address, key in keys.items():
+                emit(catalog.KEYMANAGER_KEY_FOUND, address)
+                results[address] = key
+            missing = addresses - set(keys)
+            for address in missing:
+                emit(catalog.KEYMANAGER_KEY_NOT_FOUND, address)
+            if fetch_remote is False or private is True:
+                for address in missing:
+                    results[address] = Failure(KeyNotFound(address))
+                return results
+
+            def add_result(result, address):
+                results[address] = result
+
+            # the missing keys go straight to the nickserver, without
+            # looking them up in local storage again
+            deferreds = []
+            for address in missing:
+                d = self._fetch_semaphore.run(
+                    self._single_lookup,
+                    (address, ktype, private, fetch_remote),
+                    self._fetch_key, address, ktype)
+                d.addBoth(add_result, address)
+                deferreds.append(d)
+            d = defer.gatherResults(deferreds)
+            d.addCallback(lambda _: results)
+            return d
+
+        d = self._wrapper_map[ktype].get_keys(addresses, private=private)
+        d.addCallback(fetch_missing)
+        return d
+
     def get_all_keys(self, private=False):
         """
         Return all keys stored in local database.
@@ -363,23 +577,37 @@ class KeyManager(object):
         :return: A Deferred which fires with a list of all keys in local db.
         :rtype: Deferred
         """
-        def build_keys(docs):
+        def build_keys(results):
+            docs, usagedocs = results
+            usage = dict(
+                ((doc.content['key_id'], doc.content['fingerprint']),
+                 doc.content)
+                for doc in usagedocs)
             return map(
                 lambda doc: build_key_from_dict(
                     self._key_class_from_type(doc.content['type']),
-                    doc.content),
+                    doc.content,
+                    usage.get((doc.content['key_id'],
+                               doc.content['fingerprint']))),
                 docs)
 
-        # XXX: there is no check that the soledad indexes are ready, as it
-        #      happens with EncryptionScheme.
-        #      The usecases right now are not problematic. This could be solve
-        #      adding a keytype to this funciont and moving the soledad request
-        #      to the EncryptionScheme.
-        d = self._soledad.get_from_index(
-            TAGS_PRIVATE_INDEX,
-            KEYMANAGER_KEY_TAG,
-            '1' if private else '0')
-        d.addCallback(build_keys)
+        def get_docs(_):
+            d = defer.gatherResults([
+                self._soledad.get_from_index(
+                    TAGS_PRIVATE_INDEX, KEYMANAGER_KEY_TAG, private),
+                self._soledad.get_from_index(
+                    TAGS_PRIVATE_INDEX, KEYMANAGER_USAGE_TAG, private),
+            ], consumeErrors=True)
+            d.addCallbacks(build_keys, self._extract_first_error)
+            return d
+
+        private = '1' if private else '0'
+        # wait for the indexes and the migration of the documents stored by
+        # previous versions
+        d = defer.gatherResults(
+            [scheme.wait_ready() for scheme in self._wrapper_map.values()],
+            consumeErrors=True)
+        d.addCallbacks(get_docs, self._extract_first_error)
         return d
 
     def gen_key(self, ktype):
@@ -465,10 +693,13 @@ class KeyManager(object):
         Encrypt data with the public key bound to address and sign with with
         the private key bound to sign address.
 
+        If C{address} is a list of addresses a single message is encrypted to
+        the keys of all of them.
+
         :param data: The data to be encrypted.
         :type data: str
-        :param address: The address to encrypt it for.
-        :type address: str
+        :param address: The address to encrypt it for, or list of.
+        :type address: str or list of str
         :param ktype: The type of the key.
         :type ktype: subclass of EncryptionKey
         :param passphrase: The passphrase for the secret key used for the
@@ -492,23 +723,151 @@ class KeyManager(object):
         """
         self._assert_supported_key_type(ktype)
 
-        def encrypt(keys):
-            pubkey, signkey = keys
-            encrypted = self._wrapper_map[ktype].encrypt(
+        def encrypt(pubkey, signkey):
+            return self._wrapper_map[ktype].encrypt(
                 data, pubkey, passphrase, sign=signkey,
                 cipher_algo=cipher_algo)
-            pubkey.encr_used = True
-            d = self._wrapper_map[ktype].put_key(pubkey, address)
-            d.addCallback(lambda _: encrypted)
+
+        return self._encrypt_with(encrypt, address, ktype, sign, fetch_remote)
+
+    def encrypt_stream(self, instream, consumer, address, ktype,
+                       passphrase=None, sign=None, cipher_algo='AES256',
+                       fetch_remote=True):
+        """
+        Encrypt the data read from instream like encrypt() does, writing the
+        encrypted data to consumer in chunks.
+
+        Neither the data nor the encrypted data is ever held in memory as a
+        whole, so memory use doesn't grow with the size of the data.
+
+        :param instream: The data to be encrypted.
+        :type instream: file
+        :param consumer: The consumer of the encrypted data.
+        :type consumer: twisted.internet.interfaces.IConsumer
+        :param address: The address to encrypt it for, or list of.
+        :type address: str or list of str
+        :param ktype: The type of the key.
+        :type ktype: subclass of EncryptionKey
+        :param passphrase: The passphrase for the secret key used for the
+                           signature.
+        :type passphrase: str
+        :param sign: The address to be used for signature.
+        :type sign: str
+        :param cipher_algo: The cipher algorithm to use.
+        :type cipher_algo: str
+        :param fetch_remote: If key is not found in local storage try to fetch
+                             from nickserver
+        :type fetch_remote: bool
+
+        :return: A Deferred which fires when all the encrypted data was
+                 written to consumer, or which fails with KeyNotFound if no
+                 keys were found neither locally or in keyserver or fails
+                 with EncryptError if failed encrypting for some reason.
+        :rtype: Deferred
+
+        :raise UnsupportedKeyTypeError: if invalid key type
+        """
+        self._assert_supported_key_type(ktype)
+
+        def encrypt(pubkey, signkey):
+            return self._wrapper_map[ktype].encrypt_stream(
+                instream, consumer, pubkey, passphrase, sign=signkey,
+                cipher_algo=cipher_algo)
+
+        return self._encrypt_with(encrypt, address, ktype, sign, fetch_remote)
+
+    def encrypt_file(self, path, output, address, ktype, passphrase=None,
+                     sign=None, cipher_algo='AES256', fetch_remote=True):
+        """
+        Encrypt the file at path like encrypt() does, writing the encrypted
+        data to the file at output.
+
+        The files are read and written in chunks, so memory use doesn't grow
+        with their size.
+
+        :param path: The path of the file to be encrypted.
+        :type path: str
+        :param output: The path of the file to write the encrypted data to.
+        :type output: str
+        :param address: The address to encrypt it for, or list of.
+        :type address: str or list of str
+        :param ktype: The type of the key.
+        :type ktype: subclass of EncryptionKey
+        :param passphrase: The passphrase for the secret key used for the
+                           signature.
+        :type passphrase: str
+        :param sign: The address to be used for signature.
+        :type sign: str
+        :param cipher_algo: The cipher algorithm to use.
+        :type cipher_algo: str
+        :param fetch_remote: If key is not found in local storage try to fetch
+                             from nickserver
+        :type fetch_remote: bool
+
+        :return: A Deferred which fires when the encrypted file was written,
+                 or which fails with KeyNotFound if no keys were found
+                 neither locally or in keyserver or fails with EncryptError
+                 if failed encrypting for some reason.
+        :rtype: Deferred
+
+        :raise UnsupportedKeyTypeError: if invalid key type
+        """
+        self._assert_supported_key_type(ktype)
+
+        def encrypt(pubkey, signkey):
+            return self._wrapper_map[ktype].encrypt_file(
+                path, output, pubkey, passphrase, sign=signkey,
+                cipher_algo=cipher_algo)
+
+        return self._encrypt_with(encrypt, address, ktype, sign, fetch_remote)
+
+    def _encrypt_with(self, encrypt, address, ktype, sign, fetch_remote):
+        """
+        Look up the keys to encrypt to address and sign with, encrypt with
+        them and mark the public keys as used.
+
+        :param encrypt: A function called with the public key, or list of,
+                        and the signing key, returning a Deferred which fires
+                        with the outcome of the encryption.
+        :type encrypt: callable
+
+        :return: A Deferred which fires with the outcome of C{encrypt}.
+        :rtype: Deferred
+        """
+        def mark_used(encrypted, pubkey):
+            pubkeys = pubkey if isinstance(address, list) else [pubkey]
+            for key in pubkeys:
+                self._wrapper_map[ktype].mark_used(key, encr_used=True)
+            return encrypted
+
+        def ordered_keys(keys):
+            pubkeys = []
+            for recipient in address:
+                if isinstance(keys[recipient], Failure):
+                    return keys[recipient]
+                pubkeys.append(keys[recipient])
+            return pubkeys
+
+        def encrypt_with_keys(keys):
+            pubkey, signkey = keys
+            d = encrypt(pubkey, signkey)
+            d.addCallback(mark_used, pubkey)
             return d
 
-        dpub = self.get_key(address, ktype, private=False,
-                            fetch_remote=fetch_remote)
+        if isinstance(address, list):
+            # encrypt once to each recipient
+            address = sorted(set(address), key=address.index)
+            dpub = self.get_keys(address, ktype, private=False,
+                                 fetch_remote=fetch_remote)
+            dpub.addCallback(ordered_keys)
+        else:
+            dpub = self.get_key(address, ktype, private=False,
+                                fetch_remote=fetch_remote)
         dpriv = defer.succeed(None)
         if sign is not None:
             dpriv = self.get_key(sign, ktype, private=True)
         d = defer.gatherResults([dpub, dpriv], consumeErrors=True)
-        d.addCallbacks(encrypt, self._extract_first_error)
+        d.addCallbacks(encrypt_with_keys, self._extract_first_error)
         return d
 
     def decrypt(self, data, address, ktype, passphrase=None, verify=None,
@@ -544,21 +903,212 @@ class KeyManager(object):
         """
         self._assert_supported_key_type(ktype)
 
-        def decrypt(keys):
-            pubkey, privkey = keys
-            decrypted, signed = self._wrapper_map[ktype].decrypt(
+        def decrypt(privkey, pubkey):
+            return self._wrapper_map[ktype].decrypt(
                 data, privkey, passphrase=passphrase, verify=pubkey)
-            if pubkey is None:
-                signature = KeyNotFound(verify)
-            elif signed:
-                pubkey.sign_used = True
-                d = self._wrapper_map[ktype].put_key(pubkey, address)
-                d.addCallback(lambda _: (decrypted, pubkey))
+
+        return self._decrypt_with(decrypt, address, ktype, verify,
+                                  fetch_remote)
+
+    def decrypt_stream(self, instream, consumer, address, ktype,
+                       passphrase=None, verify=None, fetch_remote=True):
+        """
+        Decrypt the data read from instream like decrypt() does, writing the
+        decrypted data to consumer in chunks.
+
+        Neither the data nor the decrypted data is ever held in memory as a
+        whole, so memory use doesn't grow with the size of the data.
+
+        :param instream: The data to be decrypted.
+        :type instream: file
+        :param consumer: The consumer of the decrypted data.
+        :type consumer: twisted.internet.interfaces.IConsumer
+        :param address: The address to whom data was encrypted.
+        :type address: str
+        :param ktype: The type of the key.
+        :type ktype: subclass of EncryptionKey
+        :param passphrase: The passphrase for the secret key used for
+                           decryption.
+        :type passphrase: str
+        :param verify: The address to be used for signature.
+        :type verify: str
+        :param fetch_remote: If key for verify not found in local storage try
+                             to fetch from nickserver
+        :type fetch_remote: bool
+
+        :return: A Deferred which fires once all the decrypted data was
+                 written to consumer with:
+            * the signing key if validation works
+            * KeyNotFound if signing key not found
+            * InvalidSignature if signature is invalid
+            * KeyNotFound failure if private key not found
+            * DecryptError failure if decription failed
+        :rtype: Deferred
+
+        :raise UnsupportedKeyTypeError: if invalid key type
+        """
+        self._assert_supported_key_type(ktype)
+
+        def decrypt(privkey, pubkey):
+            d = self._wrapper_map[ktype].decrypt_stream(
+                instream, consumer, privkey, passphrase=passphrase,
+                verify=pubkey)
+            d.addCallback(lambda signed: (None, signed))
+            return d
+
+        d = self._decrypt_with(decrypt, address, ktype, verify, fetch_remote)
+        d.addCallback(lambda result: result[1])
+        return d
+
+    def decrypt_file(self, path, output, address, ktype, passphrase=None,
+                     verify=None, fetch_remote=True):
+        """
+        Decrypt the file at path like decrypt() does, writing the decrypted
+        data to the file at output.
+
+        The files are read and written in chunks, so memory use doesn't grow
+        with their size.
+
+        :param path: The path of the file to be decrypted.
+        :type path: str
+        :param output: The path of the file to write the decrypted data to.
+        :type output: str
+        :param address: The address to whom data was encrypted.
+        :type address: str
+        :param ktype: The type of the key.
+        :type ktype: subclass of EncryptionKey
+        :param passphrase: The passphrase for the secret key used for
+                           decryption.
+        :type passphrase: str
+        :param verify: The address to be used for signature.
+        :type verify: str
+        :param fetch_remote: If key for verify not found in local storage try
+                             to fetch from nickserver
+        :type fetch_remote: bool
+
+        :return: A Deferred which fires once the decrypted file was written
+                 with:
+            * the signing key if validation works
+            * KeyNotFound if signing key not found
+            * InvalidSignature if signature is invalid
+            * KeyNotFound failure if private key not found
+            * DecryptError failure if decription failed
+        :rtype: Deferred
+
+        :raise UnsupportedKeyTypeError: if invalid key type
+        """
+        self._assert_supported_key_type(ktype)
+
+        def decrypt(privkey, pubkey):
+            d = self._wrapper_map[ktype].decrypt_file(
+                path, output, privkey, passphrase=passphrase, verify=pubkey)
+            d.addCallback(lambda signed: (None, signed))
+            return d
+
+        d = self._decrypt_with(decrypt, address, ktype, verify, fetch_remote)
+        d.addCallback(lambda result: result[1])
+        return d
+
+    def _decrypt_with(self, decrypt, address, ktype, verify, fetch_remote):
+        """
+        Look up the keys to decrypt for address and verify with, decrypt
+        with them and check the signature.
+
+        :param decrypt: A function called with the private key and the
+                        verifying key, returning a Deferred which fires with
+                        the decrypted data and whether the signature
+                        verifies.
+        :type decrypt: callable
+
+        :return: A Deferred which fires with the decrypted data and the
+                 outcome of verifying the signature.
+        :rtype: Deferred
+        """
+        def decrypt_with_keys(keys):
+            pubkey, privkey = keys
+            d = decrypt(privkey, pubkey)
+            d.addCallback(check_signature, pubkey)
+            return d
+
+        def check_signature(result, pubkey):
+            decrypted, signature = self._check_signature(
+                result, pubkey, verify)
+            if signature is pubkey:
+                self._wrapper_map[ktype].mark_used(pubkey, sign_used=True)
+            return (decrypted, signature)
+
+        dpriv = self.get_key(address, ktype, private=True)
+        dpub = defer.succeed(None)
+        if verify is not None:
+            dpub = self.get_key(verify, ktype, private=False,
+                                fetch_remote=fetch_remote)
+            dpub.addErrback(lambda f: None if f.check(KeyNotFound) else f)
+        d = defer.gatherResults([dpub, dpriv], consumeErrors=True)
+        d.addCallbacks(decrypt_with_keys, self._extract_first_error)
+        return d
+
+    def decrypt_many(self, messages, address, ktype, passphrase=None,
+                     verify=None, fetch_remote=True,
+                     concurrency=DEFAULT_GPG_THREADS, on_result=None):
+        """
+        Decrypt many messages encrypted to address, verifying them with the
+        public key bound to verify address.
+
+        The keys are looked up once for the whole batch, and at most
+        C{concurrency} messages are decrypted at a time, so C{messages} can
+        be a lazy iterable.
+
+        :param messages: The data to be decrypted.
+        :type messages: iterable of str
+        :param address: The address to whom the messages were encrypted.
+        :type address: str
+        :param ktype: The type of the key.
+        :type ktype: subclass of EncryptionKey
+        :param passphrase: The passphrase for the secret key used for
+                           decryption.
+        :type passphrase: str
+        :param verify: The address to be used for signature.
+        :type verify: str
+        :param fetch_remote: If key for verify not found in local storage try
+                             to fetch from nickserver
+        :type fetch_remote: bool
+        :param concurrency: The maximum number of messages decrypted at a
+                            time.
+        :type concurrency: int
+        :param on_result: A function called with the index of each message
+                          and its result as soon as it is decrypted.
+        :type on_result: callable
+
+        :return: A Deferred which fires with a list with the result for each
+                 message, in order, being one of:
+            * (decripted str, signing key) if validation works
+            * (decripted str, KeyNotFound) if signing key not found
+            * (decripted str, InvalidSignature) if signature is invalid
+            * a DecryptError Failure if decription failed
+            The Deferred fails with KeyNotFound if the private key is not
+            found.
+        :rtype: Deferred
+
+        :raise UnsupportedKeyTypeError: if invalid key type
+        """
+        self._assert_supported_key_type(ktype)
+
+        def decrypt_all(keys):
+            pubkey, privkey = keys
+
+            def decrypt(data):
+                d = self._wrapper_map[ktype].decrypt(
+                    data, privkey, passphrase=passphrase, verify=pubkey)
+                d.addCallback(check_signature, pubkey)
                 return d
-            else:
-                signature = InvalidSignature(
-                    'Failed to verify signature with key %s' %
-                    (pubkey.key_id,))
+
+            return _process_many(messages, decrypt, concurrency, on_result)
+
+        def check_signature(result, pubkey):
+            decrypted, signature = self._check_signature(
+                result, pubkey, verify)
+            if signature is pubkey:
+                self._wrapper_map[ktype].mark_used(pubkey, sign_used=True)
             return (decrypted, signature)
 
         dpriv = self.get_key(address, ktype, private=True)
@@ -568,9 +1118,36 @@ class KeyManager(object):
                                 fetch_remote=fetch_remote)
             dpub.addErrback(lambda f: None if f.check(KeyNotFound) else f)
         d = defer.gatherResults([dpub, dpriv], consumeErrors=True)
-        d.addCallbacks(decrypt, self._extract_first_error)
+        d.addCallbacks(decrypt_all, self._extract_first_error)
         return d
 
+    def _check_signature(self, result, pubkey, verify):
+        """
+        Return the decrypted data and the outcome of verifying its signature
+        with C{pubkey}.
+
+        :param result: The decrypted data and whether the signature verifies.
+        :type result: (str, bool)
+        :param pubkey: The key used to verify the signature.
+        :type pubkey: EncryptionKey
+        :param verify: The address to be used for signature.
+        :type verify: str
+
+        :return: The decrypted data and C{pubkey} if the signature verifies,
+                 or KeyNotFound or InvalidSignature otherwise.
+        :rtype: (str, EncryptionKey or Exception)
+        """
+        decrypted, signed = result
+        if pubkey is None:
+            signature = KeyNotFound(verify)
+        elif signed:
+            signature = pubkey
+        else:
+            signature = InvalidSignature(
+                'Failed to verify signature with key %s' %
+                (pubkey.key_id,))
+        return (decrypted, signature)
+
     def _extract_first_error(self, failure):
         return failure.value.subFailure
 
@@ -613,6 +1190,98 @@ class KeyManager(object):
         d.addCallback(sign)
         return d
 
+    def sign_file(self, path, output, address, ktype, digest_algo='SHA512',
+                  clearsign=False, detach=True, binary=False):
+        """
+        Sign the file at path like sign() does, writing the signature, or the
+        signed data, to the file at output.
+
+        :param path: The path of the file to be signed.
+        :type path: str
+        :param output: The path of the file to write the signature to.
+        :type output: str
+        :param address: The address to be used to sign.
+        :type address: EncryptionKey
+        :param ktype: The type of the key.
+        :type ktype: subclass of EncryptionKey
+        :param digest_algo: The hash digest to use.
+        :type digest_algo: str
+        :param clearsign: If True, create a cleartext signature.
+        :type clearsign: bool
+        :param detach: If True, create a detached signature.
+        :type detach: bool
+        :param binary: If True, do not ascii armour the output.
+        :type binary: bool
+
+        :return: A Deferred which fires when the signature was written or
+                 fails with KeyNotFound if no key was found neither locally
+                 or in keyserver or fails with SignFailed if there was any
+                 error signing.
+        :rtype: Deferred
+
+        :raise UnsupportedKeyTypeError: if invalid key type
+        """
+        self._assert_supported_key_type(ktype)
+
+        def sign(privkey):
+            return self._wrapper_map[ktype].sign_file(
+                path, output, privkey, digest_algo=digest_algo,
+                clearsign=clearsign, detach=detach, binary=binary)
+
+        d = self.get_key(address, ktype, private=True)
+        d.addCallback(sign)
+        return d
+
+    def sign_many(self, items, address, ktype, digest_algo='SHA512',
+                  clearsign=False, detach=True, binary=False,
+                  concurrency=DEFAULT_GPG_THREADS, on_result=None):
+        """
+        Sign many messages with the private key bound to address.
+
+        The key is looked up once for the whole batch, and at most
+        C{concurrency} messages are signed at a time, so C{items} can be a
+        lazy iterable.
+
+        :param items: The data to be signed.
+        :type items: iterable of str
+        :param address: The address to be used to sign.
+        :type address: str
+        :param ktype: The type of the key.
+        :type ktype: subclass of EncryptionKey
+        :param digest_algo: The hash digest to use.
+        :type digest_algo: str
+        :param clearsign: If True, create cleartext signatures.
+        :type clearsign: bool
+        :param detach: If True, create detached signatures.
+        :type detach: bool
+        :param binary: If True, do not ascii armour the output.
+        :type binary: bool
+        :param concurrency: The maximum number of messages signed at a time.
+        :type concurrency: int
+        :param on_result: A function called with the index of each message
+                          and its result as soon as it is signed.
+        :type on_result: callable
+
+        :return: A Deferred which fires with a list with the signed data as
+                 str, or a SignFailed Failure, for each message, in order, or
+                 which fails with KeyNotFound if no key was found.
+        :rtype: Deferred
+
+        :raise UnsupportedKeyTypeError: if invalid key type
+        """
+        self._assert_supported_key_type(ktype)
+
+        def sign_all(privkey):
+            def sign(data):
+                return self._wrapper_map[ktype].sign(
+                    data, privkey, digest_algo=digest_algo,
+                    clearsign=clearsign, detach=detach, binary=binary)
+            return _process_many(items, sign, concurrency, on_result)
+
+        d = self.get_key(address, ktype, private=True)
+        d.addCallback(sign_all)
+        return d
+
     def verify(self, data, address, ktype, detached_sig=None,
                fetch_remote=True):
         """
@@ -643,13 +1312,107 @@ class KeyManager(object):
         self._assert_supported_key_type(ktype)
 
         def verify(pubkey):
-            signed = self._wrapper_map[ktype].verify(
+            return self._wrapper_map[ktype].verify(
                 data, pubkey, detached_sig=detached_sig)
+
+        return self._verify_with(verify, address, ktype, fetch_remote)
+
+    def verify_stream(self, instream, address, ktype, detached_sig=None,
+                      fetch_remote=True):
+        """
+        Verify the signed data read from instream like verify() does.
+
+        The data is fed to gpg in chunks, so memory use doesn't grow with its
+        size.
+
+        :param instream: The data to be verified.
+        :type instream: file
+        :param address: The address to be used to verify.
+        :type address: EncryptionKey
+        :param ktype: The type of the key.
+        :type ktype: subclass of EncryptionKey
+        :param detached_sig: A detached signature. If given, the data is
+                             verified using this detached signature.
+        :type detached_sig: str
+        :param fetch_remote: If key for verify not found in local storage try
+                             to fetch from nickserver
+        :type fetch_remote: bool
+
+        :return: A Deferred which fires with the signing EncryptionKey if
+                 signature verifies, or which fails with InvalidSignature if
+                 signature don't verifies or fails with KeyNotFound if no key
+                 was found neither locally or in keyserver.
+        :rtype: Deferred
+
+        :raise UnsupportedKeyTypeError: if invalid key type
+        """
+        self._assert_supported_key_type(ktype)
+
+        def verify(pubkey):
+            return self._wrapper_map[ktype].verify_stream(
+                instream, pubkey, detached_sig=detached_sig)
+
+        return self._verify_with(verify, address, ktype, fetch_remote)
+
+    def verify_file(self, path, address, ktype, detached_sig=None,
+                    fetch_remote=True):
+        """
+        Verify the signed file at path like verify() does, eventually using
+        the detached signature in the file at detached_sig.
+
+        :param path: The path of the file to be verified.
+        :type path: str
+        :param address: The address to be used to verify.
+        :type address: EncryptionKey
+        :param ktype: The type of the key.
+        :type ktype: subclass of EncryptionKey
+        :param detached_sig: The path of a file with a detached signature. If
+                             given, the file at C{path} is verified using
+                             this detached signature.
+        :type detached_sig: str
+        :param fetch_remote: If key for verify not found in local storage try
+                             to fetch from nickserver
+        :type fetch_remote: bool
+
+        :return: A Deferred which fires with the signing EncryptionKey if
+                 signature verifies, or which fails with InvalidSignature if
+                 signature don't verifies or fails with KeyNotFound if no key
+                 was found neither locally or in keyserver.
+        :rtype: Deferred
+
+        :raise UnsupportedKeyTypeError: if invalid key type
+        """
+        self._assert_supported_key_type(ktype)
+
+        def verify(pubkey):
+            return self._wrapper_map[ktype].verify_file(
+                path, pubkey, detached_sig=detached_sig)
+
+        return self._verify_with(verify, address, ktype, fetch_remote)
+
+    def _verify_with(self, verify, address, ktype, fetch_remote):
+        """
+        Look up the key bound to address, verify with it and mark it as used
+        if the signature verifies.
+
+        :param verify: A function called with the public key, returning a
+                       Deferred which fires with whether the signature
+                       verifies.
+        :type verify: callable
+
+        :return: A Deferred which fires with the signing key, or which fails
+                 with InvalidSignature if the signature doesn't verify.
+        :rtype: Deferred
+        """
+        def verify_with_key(pubkey):
+            d = verify(pubkey)
+            d.addCallback(check_signature, pubkey)
+            return d
+
+        def check_signature(signed, pubkey):
             if signed:
-                pubkey.sign_used = True
-                d = self._wrapper_map[ktype].put_key(pubkey, address)
-                d.addCallback(lambda _: pubkey)
-                return d
+                self._wrapper_map[ktype].mark_used(pubkey, sign_used=True)
+                return pubkey
             else:
                 raise InvalidSignature(
                     'Failed to verify signature with key %s' %
@@ -657,7 +1420,90 @@ class KeyManager(object):
 
         d = self.get_key(address, ktype, private=False,
                          fetch_remote=fetch_remote)
-        d.addCallback(verify)
+        d.addCallback(verify_with_key)
+        return d
+
+    def verify_many(self, items, ktype, fetch_remote=True,
+                    concurrency=DEFAULT_GPG_THREADS, on_result=None):
+        """
+        Verify many signed messages, each with the public key bound to its
+        signer address.
+
+        The key of each signer is looked up once for the whole batch, and
+        marked as used once, after all the messages are verified. At most
+        C{concurrency} messages are verified at a time, whoever signed them,
+        so C{items} can be a lazy iterable.
+
+        :param items: Tuples with the data to be verified, the address of
+                      its signer and, optionally, a detached signature.
+        :type items: iterable of (str, str) or (str, str, str)
+        :param ktype: The type of the keys.
+        :type ktype: subclass of EncryptionKey
+        :param fetch_remote: If a signer key is not found in local storage
+                             try to fetch from nickserver
+        :type fetch_remote: bool
+        :param concurrency: The maximum number of messages verified at a
+                            time.
+        :type concurrency: int
+        :param on_result: A function called with the index of each message
+                          and its result as soon as it is verified.
+        :type on_result: callable
+
+        :return: A Deferred which fires with a list with the result for each
+                 message, in order: the signing EncryptionKey if the
+                 signature verifies, or an InvalidSignature or KeyNotFound
+                 Failure.
+        :rtype: Deferred
+
+        :raise UnsupportedKeyTypeError: if invalid key type
+        """
+        self._assert_supported_key_type(ktype)
+        wrapper = self._wrapper_map[ktype]
+        # the key, or failure to get it, of each signer. Concurrent
+        # lookups of a signer are coalesced by get_key.
+        signers = {}
+        # the keys that verified a signature, by fingerprint
+        used = {}
+
+        def verify(item):
+            data, address = item[:2]
+            detached_sig = item[2] if len(item) > 2 else None
+            signer = signers.get(address)
+            if isinstance(signer, Failure):
+                d = defer.fail(signer)
+            elif signer is not None:
+                d = defer.succeed(signer)
+            else:
+                d = self.get_key(address, ktype, private=False,
+                                 fetch_remote=fetch_remote)
+                d.addBoth(remember, address)
+            d.addCallback(verify_with_key, data, detached_sig)
+            return d
+
+        def remember(result, address):
+            signers.setdefault(address, result)
+            return result
+
+        def verify_with_key(pubkey, data, detached_sig):
+            d = wrapper.verify(data, pubkey, detached_sig=detached_sig)
+            d.addCallback(check_signature, pubkey)
+            return d
+
+        def check_signature(valid, pubkey):
+            if not valid:
+                raise InvalidSignature(
+                    'Failed to verify signature with key %s' %
+                    (pubkey.key_id,))
+            used[pubkey.fingerprint] = pubkey
+            return pubkey
+
+        def mark_used(results):
+            for pubkey in used.values():
+                wrapper.mark_used(pubkey, sign_used=True)
+            return results
+
+        d = _process_many(items, verify, concurrency, on_result)
+        d.addCallback(mark_used)
         return d
 
     def delete_key(self, key):
@@ -674,6 +1520,8 @@ class KeyManager(object):
         :raise UnsupportedKeyTypeError: if invalid key type
         """
         self._assert_supported_key_type(type(key))
+        for address in key.address:
+            self._lookup_cache.invalidate(address)
         return self._wrapper_map[type(key)].delete_key(key)
 
     def put_key(self, key, address):
@@ -700,26 +1548,18 @@ class KeyManager(object):
             return defer.fail(
                 KeyAddressMismatch("UID %s found, but expected %s"
                                    % (str(key.address), address)))
-
-        def old_key_not_found(failure):
-            if failure.check(KeyNotFound):
-                return None
-            else:
-                return failure
+        self._lookup_cache.invalidate(address)
 
         def check_upgrade(old_key):
-            if key.private or can_upgrade(key, old_key):
-                return self._wrapper_map[type(key)].put_key(key, address)
-            else:
+            if not can_upgrade(key, old_key):
                 raise KeyNotValidUpgrade(
                     "Key %s can not be upgraded by new key %s"
                     % (old_key.key_id, key.key_id))
 
-        d = self._wrapper_map[type(key)].get_key(address,
-                                                 private=key.private)
-        d.addErrback(old_key_not_found)
-        d.addCallback(check_upgrade)
-        return d
+        # the scheme checks the upgrade against the documents it looks up
+        # for the put, so each of them is looked up once
+        return self._wrapper_map[type(key)].put_key(
+            key, address, check=None if key.private else check_upgrade)
 
     def put_raw_key(self, key, ktype, address,
                     validation=ValidationLevels.Weak_Chain):
@@ -746,11 +1586,205 @@ class KeyManager(object):
         :raise UnsupportedKeyTypeError: if invalid key type
         """
         self._assert_supported_key_type(ktype)
-        pubkey, privkey = self._wrapper_map[ktype].parse_ascii_key(key)
-        pubkey.validation = validation
-        d = self.put_key(pubkey, address)
-        if privkey is not None:
-            d.addCallback(lambda _: self.put_key(privkey, address))
+
+        def put_keys(keys):
+            pubkey, privkey = keys
+            pubkey.validation = validation
+            d = self.put_key(pubkey, address)
+            if privkey is not None:
+                d.addCallback(lambda _: self.put_key(privkey, address))
+            return d
+
+        d = self._wrapper_map[ktype].parse_ascii_key(key)
+        d.addCallback(put_keys)
+        return d
+
+    def put_raw_keys(self, keys, ktype, on_result=None):
+        """
+        Put many raw keys, each bound to an address, in local storage in a
+        single pass.
+
+        All the keys are parsed first, then the scheme looks up the stored
+        documents once for all of them, checks each upgrade in memory and
+        writes the keys in batches.
+
+        :param keys: Tuples with the ascii key, the address for which it
+                     will be active and, optionally, its validation level
+                     (default: 'Weak_Chain').
+        :type keys: iterable of (str, str) or (str, str, ValidationLevels)
+        :param ktype: the type of the keys.
+        :type ktype: subclass of EncryptionKey
+        :param on_result: A function called with the index of each key and
+                          its result as soon as it is stored.
+        :type on_result: callable
+
+        :return: A Deferred which fires with a list with the result for each
+                 key, in order: the stored public EncryptionKey, or a
+                 Failure with KeyAddressMismatch, KeyNotValidUpgrade or the
+                 error parsing or storing the key.
+        :rtype: Deferred
+
+        :raise UnsupportedKeyTypeError: if invalid key type
+        """
+        self._assert_supported_key_type(ktype)
+        keys = list(keys)
+        parse = self._wrapper_map[ktype].parse_ascii_key
+
+        def put_parsed(results):
+            parsed = []
+            for item, (success, result) in zip(keys, results):
+                address = item[1]
+                validation = item[2] if len(item) > 2 \
+                    else ValidationLevels.Weak_Chain
+                if not success:
+                    pubkey, privkey = result, None
+                else:
+                    pubkey, privkey = result
+                    if pubkey is not None:
+                        pubkey.validation = validation
+                parsed.append((pubkey, privkey, address))
+            return self._put_parsed_keys(parsed, ktype, on_result)
+
+        # the keys gpg has to parse are parsed concurrently in its threads
+        d = defer.DeferredList(
+            [defer.maybeDeferred(parse, item[0]) for item in keys],
+            consumeErrors=True)
+        d.addCallback(put_parsed)
+        return d
+
+    def put_keyring_file(self, path, ktype,
+                         validation=ValidationLevels.Weak_Chain,
+                         on_result=None):
+        """
+        Put the keys in the keyring file at path in local storage, like
+        put_raw_keys() does. Each key is active for each of its addresses.
+
+        :param path: The path of a binary keyring, or of ASCII armored keys.
+        :type path: str
+        :param ktype: the type of the keys.
+        :type ktype: subclass of EncryptionKey
+        :param validation: validation level for the keys
+                           (default: 'Weak_Chain')
+        :type validation: ValidationLevels
+        :param on_result: A function called with the index of each key and
+                          address and its result as soon as it is stored.
+        :type on_result: callable
+
+        :return: A Deferred which fires with a list with the result for each
+                 key and address, in keyring order, like put_raw_keys(), or
+                 which fails with IOError if the file can't be read or with
+                 InvalidPacket if the keyring is malformed.
+        :rtype: Deferred
+
+        :raise UnsupportedKeyTypeError: if invalid key type
+        """
+        self._assert_supported_key_type(ktype)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return defer.fail()
+
+        def put_parsed(keyring):
+            parsed = []
+            for pubkey, privkey in keyring:
+                if pubkey is None:
+                    parsed.append((None, None, None))
+                    continue
+                pubkey.validation = validation
+                # user IDs without an email address don't bind the key
+                for address in filter(None, pubkey.address):
+                    parsed.append((pubkey, privkey, address))
+            return self._put_parsed_keys(parsed, ktype, on_result)
+
+        d = defer.maybeDeferred(
+            self._wrapper_map[ktype].parse_keyring, data)
+        d.addCallback(put_parsed)
+        return d
+
+    def _put_parsed_keys(self, parsed, ktype, on_result):
+        """
+        Put the parsed keys in local storage, with one call to the scheme
+        for all the public keys and then another one for the private keys.
+
+        Like put_raw_key() does, a private key is only put after its public
+        key is, and only the upgrade of the public key is checked.
+
+        :param parsed: Tuples with the public key, or a Failure parsing it,
+                       the private key or None, and the address for which
+                       they will be active.
+        :type parsed: list(tuple)
+        :param ktype: the type of the keys.
+        :type ktype: subclass of EncryptionKey
+        :param on_result: A function called with the index of each tuple
+                          and its result as soon as it is stored.
+        :type on_result: callable
+
+        :return: A Deferred which fires with a list with the result for each
+                 tuple, in order.
+        :rtype: Deferred
+        """
+        results = {}
+        # the index of the tuple of each put
+        pubowners = []
+        pubputs = []
+        privowners = []
+        privputs = []
+
+        def done(index, result):
+            results[index] = result
+            if on_result is not None:
+                on_result(index, result)
+
+        for index, (pubkey, privkey, address) in enumerate(parsed):
+            if isinstance(pubkey, Failure):
+                done(index, pubkey)
+                continue
+            if pubkey is None:
+                done(index, Failure(KeyNotFound(address)))
+                continue
+            if address not in pubkey.address:
+                done(index, Failure(KeyAddressMismatch(
+                    "UID %s found, but expected %s"
+                    % (str(pubkey.address), address))))
+                continue
+            self._lookup_cache.invalidate(address)
+            pubputs.append((pubkey, address))
+            pubowners.append(index)
+
+        def check_upgrade(key, old_key):
+            if not can_upgrade(key, old_key):
+                raise KeyNotValidUpgrade(
+                    "Key %s can not be upgraded by new key %s"
+                    % (old_key.key_id, key.key_id))
+
+        def pub_done(put_index, result):
+            index = pubowners[put_index]
+            pubkey, privkey, address = parsed[index]
+            if isinstance(result, Failure) or privkey is None:
+                done(index, result)
+            else:
+                # the public key is the result once the private key is in
+                results[index] = result
+                privputs.append((privkey, address))
+                privowners.append(index)
+
+        def put_private_keys(_):
+            if not privputs:
+                return
+            return self._wrapper_map[ktype].put_keys(
+                privputs, on_result=priv_done)
+
+        def priv_done(put_index, result):
+            index = privowners[put_index]
+            if not isinstance(result, Failure):
+                result = results[index]
+            done(index, result)
+
+        d = self._wrapper_map[ktype].put_keys(
+            pubputs, check=check_upgrade, on_result=pub_done)
+        d.addCallback(put_private_keys)
+        d.addCallback(lambda _: [results[i] for i in range(len(parsed))])
         return d
 
     def fetch_key(self, address, uri, ktype,
@@ -780,17 +1814,25 @@ class KeyManager(object):
         """
         self._assert_supported_key_type(ktype)
 
-        res = self._get(uri)
-        if not res.ok:
-            return defer.fail(KeyNotFound(uri))
+        def parse_fetched_key(res):
+            if not res.ok:
+                raise KeyNotFound(uri)
 
-        # XXX parse binary keys
-        pubkey, _ = self._wrapper_map[ktype].parse_ascii_key(res.content)
-        if pubkey is None:
-            return defer.fail(KeyNotFound(uri))
+            # XXX parse binary keys
+            return self._wrapper_map[ktype].parse_ascii_key(res.content)
+
+        def put_fetched_key(keys):
+            pubkey, _ = keys
+            if pubkey is None:
+                raise KeyNotFound(uri)
 
-        pubkey.validation = validation
-        return self.put_key(pubkey, address)
+            pubkey.validation = validation
+            return self.put_key(pubkey, address)
+
+        d = self._get(uri)
+        d.addCallback(parse_fetched_key)
+        d.addCallback(put_fetched_key)
+        return d
 
     def _assert_supported_key_type(self, ktype):
         """
@@ -805,6 +1847,52 @@ class KeyManager(object):
             raise UnsupportedKeyTypeError(str(ktype))
 
 
+def _process_many(items, process, concurrency, on_result=None):
+    """
+    Call C{process} for each of C{items}, with at most C{concurrency} calls
+    in progress at a time.
+
+    Items are taken from C{items} only when there is room for them, so it
+    can be a lazy iterable. A failure processing an item doesn't stop
+    processing the others.
+
+    :param items: The items to be processed.
+    :type items: iterable
+    :param process: A function called with each item, which may return a
+                    Deferred.
+    :type process: callable
+    :param concurrency: The maximum number of calls in progress.
+    :type concurrency: int
+    :param on_result: A function called with the index of each item and its
+                      result, or Failure, as soon as it is processed.
+    :type on_result: callable
+
+    :return: A Deferred which fires with a list with the result, or Failure,
+             for each item, in order.
+    :rtype: Deferred
+    """
+    results = {}
+
+    def store(result, index):
+        results[index] = result
+        if on_result is not None:
+            on_result(index, result)
+
+    def work(pending):
+        for index, item in pending:
+            d = defer.maybeDeferred(process, item)
+            d.addBoth(store, index)
+            yield d
+
+    # all the workers take their items from the same iterator.
+    pending = enumerate(items)
+    d = defer.gatherResults(
+        [task.cooperate(work(pending)).whenDone()
+         for _ in range(max(concurrency, 1))])
+    d.addCallback(lambda _: [results[i] for i in sorted(results)])
+    return d
+
+
 def _split_email(address):
     """
     Split username and domain from an email address
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+# cache.py
+# Copyright (C) 2015 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Bounded caches for key lookups.
+"""
+import copy
+import time
+
+from collections import OrderedDict
+
+
+#
+# Cache defaults
+#
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_FOUND_TTL = 300  # seconds
+DEFAULT_NOT_FOUND_TTL = 60  # seconds
+DEFAULT_ERROR_TTL = 10  # seconds
+DEFAULT_KEY_CACHE_SIZE = 4 * 1024 * 1024  # bytes of key data
+
+#
+# Lookup outcomes
+#
+
+FOUND = 'found'
+NOT_FOUND = 'not_found'
+ERROR = 'error'
+
+
+class LookupCache(object):
+    """
+    A cache of the outcome of lookups.
+
+    Each outcome is kept for its own time to live: keys that were found,
+    keys the server doesn't have and transient errors. At most
+    C{max_entries} outcomes are kept, evicting the least recently used
+    ones.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES,
+                 found_ttl=DEFAULT_FOUND_TTL,
+                 not_found_ttl=DEFAULT_NOT_FOUND_TTL,
+                 error_ttl=DEFAULT_ERROR_TTL, clock=time.time):
+        """
+        Initialize the cache.
+
+        :param max_entries: The maximum number of cached outcomes.
+        :type max_entries: int
+        :param found_ttl: Seconds to keep FOUND outcomes.
+        :type found_ttl: int
+        :param not_found_ttl: Seconds to keep NOT_FOUND outcomes.
+        :type not_found_ttl: int
+        :param error_ttl: Seconds to keep ERROR outcomes.
+        :type error_ttl: int
+        :param clock: A function returning the current time in seconds.
+        :type clock: callable
+        """
+        self._max_entries = max_entries
+        self._ttls = {
+            FOUND: found_ttl,
+            NOT_FOUND: not_found_ttl,
+            ERROR: error_ttl,
+        }
+        self._clock = clock
+        # (expiry time, outcome, value) by key, the least recently used
+        # first.
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Return the cached outcome for C{key}.
+
+        :param key: The key of the lookup.
+        :type key: str
+
+        :return: A tuple with the outcome and its value, or None if there is
+                 no cached outcome for C{key}.
+        :rtype: (str, object)
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[0] <= self._clock():
+            self.misses += 1
+            return None
+        # reinsert the entry as the most recently used.
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[1:]
+
+    def add(self, key, outcome, value=None):
+        """
+        Cache the C{outcome} of the lookup for C{key}.
+
+        :param key: The key of the lookup.
+        :type key: str
+        :param outcome: One of FOUND, NOT_FOUND or ERROR.
+        :type outcome: str
+        :param value: A value to keep with the outcome.
+        :type value: object
+        """
+        self._entries.pop(key, None)
+        expiry = self._clock() + self._ttls[outcome]
+        self._entries[key] = (expiry, outcome, value)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Forget the cached outcome for C{key}.
+
+        :param key: The key of the lookup.
+        :type key: str
+        """
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Forget all the cached outcomes.
+        """
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        Return the hit and miss counters and the number of entries.
+
+        :rtype: dict
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+        }
+
+
+class KeyCache(object):
+    """
+    A cache of the keys bound to each address.
+
+    Keys are cached by address and whether they are private, and the cache
+    holds at most C{max_size} bytes of key data, evicting the least
+    recently used keys. Callers get copies of the cached keys, so changing
+    them doesn't change the cache.
+
+    Every change to the stored keys bumps the cache C{generation}. Keys read
+    from storage are only cached if no change happened since the read
+    started, so a slow read never caches an outdated key.
+    """
+
+    def __init__(self, max_size=DEFAULT_KEY_CACHE_SIZE):
+        """
+        Initialize the cache.
+
+        :param max_size: The maximum size of the key data in the cache, in
+                         bytes.
+        :type max_size: int
+        """
+        self._max_size = max_size
+        self._size = 0
+        # keys by (address, private), the least recently used first.
+        self._keys = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, address, private):
+        """
+        Return a copy of the key bound to C{address}.
+
+        :param address: The address bound to the key.
+        :type address: str
+        :param private: Whether the key is private.
+        :type private: bool
+
+        :return: The key, or None if it is not cached.
+        :rtype: EncryptionKey
+        """
+        key = self._keys.pop((address, private), None)
+        if key is None:
+            self.misses += 1
+            return None
+        # reinsert the key as the most recently used.
+        self._keys[(address, private)] = key
+        self.hits += 1
+        return copy.deepcopy(key)
+
+    def peek(self, address, private):
+        """
+        Return a copy of the key bound to C{address} like get() does, but
+        without counting a hit or a miss nor marking the key as recently
+        used.
+
+        :param address: The address bound to the key.
+        :type address: str
+        :param private: Whether the key is private.
+        :type private: bool
+
+        :return: The key, or None if it is not cached.
+        :rtype: EncryptionKey
+        """
+        key = self._keys.get((address, private))
+        if key is None:
+            return None
+        return copy.deepcopy(key)
+
+    def put(self, address, key, generation=None):
+        """
+        Cache a copy of C{key} as the key bound to C{address}.
+
+        :param address: The address bound to the key.
+        :type address: str
+        :param key: The key.
+        :type key: EncryptionKey
+        :param generation: The cache generation when the key was read from
+                           storage, or None if the key was just stored.
+        :type generation: int
+        """
+        if generation is None:
+            self.generation += 1
+        elif generation != self.generation:
+            return
+        self._remove((address, key.private))
+        size = len(key.key_data)
+        if size > self._max_size:
+            return
+        self._keys[(address, key.private)] = copy.deepcopy(key)
+        self._size += size
+        while self._size > self._max_size:
+            _, old = self._keys.popitem(last=False)
+            self._size -= len(old.key_data)
+
+    def invalidate(self, fingerprint):
+        """
+        Forget the cached copies of the key with C{fingerprint}.
+
+        :param fingerprint: The fingerprint of the key.
+        :type fingerprint: str
+        """
+        self.generation += 1
+        for cache_key, key in self._keys.items():
+            if key.fingerprint == fingerprint:
+                self._remove(cache_key)
+
+    def invalidate_address(self, address, private):
+        """
+        Forget the cached key bound to C{address}.
+
+        :param address: The address bound to the key.
+        :type address: str
+        :param private: Whether the key is private.
+        :type private: bool
+        """
+        self.generation += 1
+        self._remove((address, private))
+
+    def clear(self):
+        """
+        Forget all the cached keys.
+        """
+        self.generation += 1
+        self._keys.clear()
+        self._size = 0
+
+    def _remove(self, cache_key):
+        key = self._keys.pop(cache_key, None)
+        if key is not None:
+            self._size -= len(key.key_data)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def stats(self):
+        """
+        Return the hit and miss counters, the hit ratio, the number of
+        cached keys and their size.
+
+        :rtype: dict
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+            'entries': len(self._keys),
+            'size': self._size,
+        }
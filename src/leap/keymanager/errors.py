@@ -108,3 +108,9 @@ class UnsupportedKeyTypeError(Exception):
     """
     Invalid key type
     """
+
+
+class InvalidPacket(Exception):
+    """
+    Raised when OpenPGP data can't be parsed.
+    """
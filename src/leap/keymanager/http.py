@@ -0,0 +1,483 @@
+# -*- coding: utf-8 -*-
+# http.py
+# Copyright (C) 2015 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+A non-blocking HTTP client for talking to the nickserver and the webapp.
+"""
+import urllib
+import weakref
+
+try:
+    import simplejson as json
+except ImportError:
+    import json  # noqa
+
+from StringIO import StringIO
+from urlparse import urlparse
+
+from twisted.internet import defer
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+from twisted.internet.ssl import Certificate, optionsForClientTLS
+from twisted.python.failure import Failure
+from twisted.web.client import (
+    Agent,
+    FileBodyProducer,
+    HTTPConnectionPool,
+    readBody,
+)
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IPolicyForHTTPS
+from zope.interface import implementer
+
+
+DEFAULT_TIMEOUT = 30  # seconds
+DEFAULT_CONNECTIONS_PER_HOST = 4
+
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class HTTPError(Exception):
+    """
+    Raised when the server answers a request with an error status code.
+    """
+
+    def __init__(self, response):
+        Exception.__init__(
+            self, '%s error for %s' % (response.status_code, response.uri))
+        self.response = response
+
+
+class TimeoutError(Exception):
+    """
+    Raised when a request doesn't finish in time.
+    """
+    pass
+
+
+class Response(object):
+    """
+    The response to an HTTP request, with its body fully read.
+    """
+
+    def __init__(self, uri, status_code, headers, content):
+        """
+        :param uri: The URI of the request.
+        :type uri: str
+        :param status_code: The HTTP status code of the response.
+        :type status_code: int
+        :param headers: The headers of the response.
+        :type headers: twisted.web.http_headers.Headers
+        :param content: The body of the response.
+        :type content: str
+        """
+        self.uri = uri
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def ok(self):
+        """
+        Whether the status code of the response is not an error.
+
+        :rtype: bool
+        """
+        return self.status_code < 400
+
+    def json(self):
+        """
+        Decode the body of the response as JSON.
+        """
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        """
+        Raise HTTPError if the status code of the response is an error.
+        """
+        if not self.ok:
+            raise HTTPError(self)
+
+
+class HostStats(object):
+    """
+    Statistics of the requests sent to a host.
+    """
+
+    def __init__(self):
+        # requests sent to the host.
+        self.requests = 0
+        # requests in progress.
+        self.active = 0
+        # requests waiting for a free connection to the host.
+        self.waiting = 0
+        # requests that failed without a response.
+        self.failures = 0
+        # new connections opened to the host.
+        self.connections = 0
+        # TLS connections that offered the session of a previous one, the
+        # server may still do a full handshake.
+        self.tls_resumption_attempts = 0
+
+    def as_dict(self):
+        """
+        Return the statistics as a dict.
+
+        :rtype: dict
+        """
+        return dict(self.__dict__)
+
+
+class HTTPClient(object):
+    """
+    An HTTP client that doesn't block the reactor.
+
+    Requests go through a pool of persistent connections, are cancelled if
+    they take longer than C{timeout} seconds and, for https, verify the
+    server certificate against the given CA certificate.
+
+    At most C{connections_per_host} requests are sent to a host at the same
+    time, so the connections to each host are bounded too. Further requests
+    wait for one of them to finish and reuse its connection. New TLS
+    connections to a host resume the TLS session of a previous connection
+    to it, saving a full handshake.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT,
+                 connections_per_host=DEFAULT_CONNECTIONS_PER_HOST,
+                 reactor=None):
+        """
+        Initialize the client.
+
+        :param timeout: Seconds after which a request is cancelled.
+        :type timeout: int
+        :param connections_per_host: The maximum number of connections to
+                                     each host.
+        :type connections_per_host: int
+        :param reactor: The reactor to use, the global one by default.
+        :type reactor: IReactorTime
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._timeout = timeout
+        self._connections_per_host = connections_per_host
+        self._pool = _CountingConnectionPool(
+            reactor, self._host_stats, persistent=True)
+        self._pool.maxPersistentPerHost = connections_per_host
+        # agents by the CA certificate used to verify the servers.
+        self._agents = {}
+        # semaphores and stats by host, as 'host:port'.
+        self._semaphores = {}
+        self._stats = {}
+
+    def stats(self):
+        """
+        Return the statistics of the requests sent to each host.
+
+        :return: A dict mapping 'host:port' to a dict with the number of
+                 requests sent, in progress, waiting for a connection and
+                 failed, of connections opened and of attempts to resume
+                 a TLS session.
+        :rtype: dict
+        """
+        return dict(
+            (host, stats.as_dict()) for host, stats in self._stats.items())
+
+    def _host_stats(self, host):
+        """
+        Return the statistics of C{host}.
+
+        :param host: The host, as 'host:port'.
+        :type host: str
+
+        :rtype: HostStats
+        """
+        if host not in self._stats:
+            self._stats[host] = HostStats()
+        return self._stats[host]
+
+    def get(self, uri, data=None, verify=None, headers=None):
+        """
+        Send a GET request to C{uri} containing C{data}.
+
+        :param uri: The URI of the request.
+        :type uri: str
+        :param data: The body of the request.
+        :type data: dict or str
+        :param verify: The path to the CA certificate for https requests.
+        :type verify: str
+        :param headers: Extra headers for the request.
+        :type headers: dict
+
+        :return: A Deferred which fires with the Response.
+        :rtype: Deferred
+        """
+        return self.request('GET', uri, data=data, verify=verify,
+                            headers=headers)
+
+    def put(self, uri, data=None, verify=None, headers=None):
+        """
+        Send a PUT request to C{uri} containing C{data}.
+
+        :param uri: The URI of the request.
+        :type uri: str
+        :param data: The body of the request.
+        :type data: dict or str
+        :param verify: The path to the CA certificate for https requests.
+        :type verify: str
+        :param headers: Extra headers for the request.
+        :type headers: dict
+
+        :return: A Deferred which fires with the Response.
+        :rtype: Deferred
+        """
+        return self.request('PUT', uri, data=data, verify=verify,
+                            headers=headers)
+
+    def request(self, method, uri, data=None, verify=None, headers=None):
+        """
+        Send a request to C{uri} and read the response.
+
+        :param method: The HTTP method.
+        :type method: str
+        :param uri: The URI of the request.
+        :type uri: str
+        :param data: The body of the request. Dicts are form encoded, in the
+                     query string for GET requests.
+        :type data: dict or str
+        :param verify: The path to the CA certificate for https requests.
+        :type verify: str
+        :param headers: Extra headers for the request.
+        :type headers: dict
+
+        :return: A Deferred which fires with the Response, or which fails
+                 with TimeoutError if the request doesn't finish in time.
+        :rtype: Deferred
+        """
+        host = _host(uri)
+        if host not in self._semaphores:
+            self._semaphores[host] = defer.DeferredSemaphore(
+                self._connections_per_host)
+        semaphore = self._semaphores[host]
+        stats = self._host_stats(host)
+        stats.requests += 1
+        stats.waiting += 1
+
+        def send(_):
+            stats.waiting -= 1
+            stats.active += 1
+            d = self._request(method, uri, data, verify, headers)
+            d.addErrback(count_failure)
+            d.addBoth(finished)
+            return d
+
+        def count_failure(failure):
+            stats.failures += 1
+            return failure
+
+        def finished(result):
+            stats.active -= 1
+            semaphore.release()
+            return result
+
+        d = semaphore.acquire()
+        d.addCallback(send)
+        return d
+
+    def _request(self, method, uri, data, verify, headers):
+        """
+        Send a request to C{uri} and read the response, with the arguments
+        of C{request}.
+
+        :rtype: Deferred
+        """
+        request_headers = Headers()
+        for name, value in (headers or {}).items():
+            request_headers.addRawHeader(name, value)
+        body = None
+        if isinstance(data, dict) and method == 'GET':
+            uri = '%s%s%s' % (
+                uri, '&' if '?' in uri else '?', urllib.urlencode(data))
+        elif data is not None:
+            if isinstance(data, dict):
+                data = urllib.urlencode(data)
+                request_headers.addRawHeader(
+                    'Content-Type', 'application/x-www-form-urlencoded')
+            body = FileBodyProducer(StringIO(data))
+
+        # the CA certificate is only needed to verify https servers.
+        if not uri.startswith('https:'):
+            verify = None
+        agent = self._agent(verify)
+        d = agent.request(method, uri, request_headers, body)
+
+        def read(response):
+            d = readBody(response)
+            d.addCallback(
+                lambda content: Response(
+                    uri, response.code, response.headers, content))
+            return d
+
+        d.addCallback(read)
+        return self._with_timeout(d, uri)
+
+    def _agent(self, ca_cert_path):
+        """
+        Return the agent that verifies servers using C{ca_cert_path}.
+
+        :param ca_cert_path: The path to the CA certificate.
+        :type ca_cert_path: str
+
+        :rtype: twisted.web.client.Agent
+        """
+        if ca_cert_path not in self._agents:
+            trust_root = None
+            if ca_cert_path is not None:
+                with open(ca_cert_path) as f:
+                    trust_root = Certificate.loadPEM(f.read())
+            policy = _SessionResumingPolicy(trust_root, self._host_stats)
+            self._agents[ca_cert_path] = Agent(
+                self._reactor, contextFactory=policy, pool=self._pool)
+        return self._agents[ca_cert_path]
+
+    def _with_timeout(self, d, uri):
+        """
+        Cancel C{d} if it doesn't fire in C{timeout} seconds.
+
+        :param d: The Deferred of the request.
+        :type d: Deferred
+        :param uri: The URI of the request.
+        :type uri: str
+
+        :rtype: Deferred
+        """
+        timeout = self._reactor.callLater(self._timeout, d.cancel)
+
+        def cancel_timeout(result):
+            if timeout.active():
+                timeout.cancel()
+                return result
+            # the request was cancelled by the timeout, whatever the
+            # failure it ended with.
+            if isinstance(result, Failure):
+                raise TimeoutError('Request to %s timed out.' % (uri,))
+            return result
+
+        d.addBoth(cancel_timeout)
+        return d
+
+    def close(self):
+        """
+        Close the persistent connections.
+
+        :return: A Deferred which fires when the connections are closed.
+        :rtype: Deferred
+        """
+        return self._pool.closeCachedConnections()
+
+
+class _CountingConnectionPool(HTTPConnectionPool):
+    """
+    A connection pool that counts the connections it opens to each host.
+    """
+
+    def __init__(self, reactor, host_stats, persistent=True):
+        HTTPConnectionPool.__init__(self, reactor, persistent=persistent)
+        self._host_stats = host_stats
+
+    def _newConnection(self, key, endpoint):
+        # agents use (scheme, host, port) as the connection key.
+        _, host, port = key
+        self._host_stats('%s:%d' % (host.lower(), port)).connections += 1
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+
+@implementer(IPolicyForHTTPS)
+class _SessionResumingPolicy(object):
+    """
+    A policy that verifies servers like a browser does and keeps one
+    connection creator per host, so new connections to a host can resume
+    the TLS session of a previous one.
+    """
+
+    def __init__(self, trust_root, host_stats):
+        """
+        :param trust_root: The CA certificate to verify servers with, or
+                           None to use the platform trust.
+        :type trust_root: IOpenSSLTrustRoot
+        :param host_stats: A function returning the stats of a host.
+        :type host_stats: callable
+        """
+        self._trust_root = trust_root
+        self._host_stats = host_stats
+        self._creators = {}
+
+    def creatorForNetloc(self, hostname, port):
+        key = (hostname, port)
+        if key not in self._creators:
+            creator = optionsForClientTLS(
+                hostname.decode('ascii'), trustRoot=self._trust_root,
+                extraCertificateOptions={'enableSessionTickets': True})
+            self._creators[key] = _SessionResumingCreator(
+                creator, self._host_stats('%s:%d' % (hostname.lower(), port)))
+        return self._creators[key]
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class _SessionResumingCreator(object):
+    """
+    A connection creator that offers the TLS session of the last
+    established connection when creating a new one.
+    """
+
+    def __init__(self, creator, stats):
+        """
+        :param creator: The connection creator to wrap.
+        :type creator: IOpenSSLClientConnectionCreator
+        :param stats: The stats of the host.
+        :type stats: HostStats
+        """
+        self._creator = creator
+        self._stats = stats
+        self._session = None
+        # the connections created so far whose session we may reuse.
+        self._connections = weakref.WeakSet()
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        for connection in self._connections:
+            session = connection.get_session()
+            if session is not None:
+                self._session = session
+        connection = self._creator.clientConnectionForTLS(tlsProtocol)
+        if self._session is not None:
+            connection.set_session(self._session)
+            self._stats.tls_resumption_attempts += 1
+        self._connections.add(connection)
+        return connection
+
+
+def _host(uri):
+    """
+    Return the host of C{uri} as 'host:port'.
+
+    :param uri: The URI.
+    :type uri: str
+
+    :rtype: str
+    """
+    parsed = urlparse(uri)
+    port = parsed.port or _DEFAULT_PORTS.get(parsed.scheme)
+    return '%s:%s' % (parsed.hostname, port)
@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+# keyring.py
+# Copyright (C) 2015 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+A pool of long-lived GPG keyrings to be leased by the encryption schemes.
+"""
+import atexit
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import weakref
+
+from contextlib import contextmanager
+
+import gnupg
+
+from leap.common.check import leap_assert
+
+
+logger = logging.getLogger(__name__)
+
+
+#
+# Pool defaults
+#
+
+DEFAULT_POOL_SIZE = 8
+DEFAULT_IDLE_TIMEOUT = 300  # seconds
+
+# files and directories in a gpg homedir that hold key material. Removing
+# them leaves an empty keyring behind without the need of running gpg.
+_KEYRING_FILES = (
+    'pubring.gpg',
+    'pubring.gpg~',
+    'secring.gpg',
+    'secring.gpg~',
+    'pubring.kbx',
+    'pubring.kbx~',
+)
+_KEYRING_DIRS = (
+    'private-keys-v1.d',
+)
+
+# held while starting gpg processes, and while creating file descriptors
+# that they must not inherit until they are marked close-on-exec.
+SPAWN_LOCK = threading.Lock()
+
+
+class GPG(gnupg.GPG):
+    """
+    A gnupg.GPG that starts its gpg processes holding SPAWN_LOCK.
+    """
+
+    def _open_subprocess(self, *args, **kwargs):
+        with SPAWN_LOCK:
+            return super(GPG, self)._open_subprocess(*args, **kwargs)
+
+
+class PooledKeyring(object):
+    """
+    A GPG keyring living in its own temporary homedir that can be emptied
+    and refilled with different keys without being destroyed.
+    """
+
+    def __init__(self, gpgbinary=None):
+        """
+        Create an empty keyring in a new temporary homedir.
+
+        :param gpgbinary: Name for GnuPG binary executable.
+        :type gpgbinary: C{str}
+        """
+        self._gpgbinary = gpgbinary
+        self.gpg = GPG(binary=gpgbinary, homedir=tempfile.mkdtemp())
+        self.last_used = time.time()
+        # the cache key of the keys in the keyring, or None if the contents
+        # of the keyring are unknown.
+        self.content = None
+        # whether the keys in the keyring were invalidated while leased.
+        self.stale = False
+
+    def load(self, keys):
+        """
+        Import C{keys} into the keyring with a single gpg call.
+
+        The keyring is expected to be empty.
+
+        :param keys: the keys to import.
+        :type keys: list(OpenPGPKey)
+        """
+        privkeys = [key for key in keys if key and key.private is True]
+        publkeys = [key for key in keys if key and key.private is False]
+        # here we filter out public keys that have a correspondent
+        # private key in the list because the private key_data by
+        # itself is enough to also have the public key in the keyring.
+        privids = map(lambda privkey: privkey.key_id, privkeys)
+        publkeys = filter(
+            lambda pubkey: pubkey.key_id not in privids, publkeys)
+        if not publkeys + privkeys:
+            self.content = _cache_key(keys)
+            return
+
+        # import keys into the keyring:
+        # concatenating ascii-armored keys, which is correctly
+        # understood by GPG.
+        self.content = None
+        result = self.gpg.import_keys("".join(
+            [x.key_data for x in publkeys + privkeys]))
+
+        # assert all the keys made it into the keyring, using the import
+        # status instead of listing the keyring.
+        expected = set([key.fingerprint for key in publkeys + privkeys])
+        missing = expected - set(result.fingerprints)
+        leap_assert(
+            not missing,
+            'Failed to import keys into keyring: %s' % (', '.join(missing),))
+        self.content = _cache_key(keys)
+
+    def contains(self, fingerprint):
+        """
+        Return whether the key with C{fingerprint} was loaded in the keyring.
+
+        :param fingerprint: The fingerprint of the key.
+        :type fingerprint: str
+        :rtype: bool
+        """
+        if self.content is None:
+            return False
+        return fingerprint in [fpr for fpr, _ in self.content]
+
+    @property
+    def has_private_keys(self):
+        """
+        Whether private keys might have been loaded in the keyring.
+
+        :rtype: bool
+        """
+        if self.content is None:
+            return True
+        return any(private for _, private in self.content)
+
+    def reset(self):
+        """
+        Remove all keys from the keyring.
+
+        This removes the keyring files from the homedir, so no gpg process
+        needs to be spawned.
+        """
+        homedir = self.gpg.homedir
+        for name in _KEYRING_FILES:
+            _wipe(os.path.join(homedir, name))
+        for name in _KEYRING_DIRS:
+            # the directories are kept, as a running gpg-agent expects them
+            # to exist.
+            path = os.path.join(homedir, name)
+            if os.path.isdir(path):
+                for filename in os.listdir(path):
+                    _wipe(os.path.join(path, filename))
+        self.content = frozenset()
+
+    def destroy(self):
+        """
+        Securely erase the keyring, stop the gpg-agent of its homedir, if
+        any, and remove the homedir.
+        """
+        homedir = self.gpg.homedir
+        leap_assert(homedir != os.path.expanduser('~/.gnupg'),
+                    "watch out! Tried to remove default gnupg home!")
+        try:
+            self.reset()
+        finally:
+            self._kill_agent()
+            shutil.rmtree(homedir, ignore_errors=True)
+
+    def _kill_agent(self):
+        """
+        Stop the gpg-agent that gpg 2 starts for the homedir.
+
+        gpg 1 doesn't start an agent, nor ships gpgconf, so nothing is done
+        if gpgconf can't be run.
+        """
+        gpgconf = 'gpgconf'
+        if self._gpgbinary and os.path.dirname(self._gpgbinary):
+            path = os.path.join(os.path.dirname(self._gpgbinary), 'gpgconf')
+            if os.path.isfile(path):
+                gpgconf = path
+        try:
+            with open(os.devnull, 'wb') as devnull:
+                subprocess.call(
+                    [gpgconf, '--homedir', self.gpg.homedir,
+                     '--kill', 'gpg-agent'],
+                    stdout=devnull, stderr=devnull, close_fds=True)
+        except OSError as e:
+            logger.debug("Could not stop gpg-agent: %r" % (e,))
+
+
+class KeyringPool(object):
+    """
+    A pool of GPG keyrings.
+
+    Creating a GPG keyring for each operation means creating a homedir,
+    starting gpg to check its version and trustdb, and deleting every key
+    afterwards. Pooled keyrings are created once and emptied between leases
+    by removing their keyring files, so an operation only pays for importing
+    its keys and for the operation itself.
+
+    Idle keyrings also act as a cache of prepared keyrings: they keep the
+    public keys they were loaded with, and a lease for the same set of keys
+    gets one of them back without running gpg at all. Keyrings that might
+    hold private keys are emptied as soon as they are given back, so no
+    secret key material is left on disk. When a keyring with other
+    keys is needed and the pool is full the least recently used idle keyring
+    is emptied and reused.
+
+    At most C{size} keyrings are kept idle in the pool, and keyrings that
+    have been idle for more than C{idle_timeout} seconds are destroyed.
+    Leases are never blocked: if no idle keyring is available a new one is
+    created.
+    """
+
+    def __init__(self, gpgbinary=None, size=DEFAULT_POOL_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        """
+        Initialize the pool.
+
+        :param gpgbinary: Name for GnuPG binary executable.
+        :type gpgbinary: C{str}
+        :param size: The maximum number of idle keyrings kept in the pool.
+        :type size: int
+        :param idle_timeout: Seconds after which an idle keyring is
+                             destroyed.
+        :type idle_timeout: int
+        """
+        leap_assert(size >= 0, 'Pool size must not be negative.')
+        self._gpgbinary = gpgbinary
+        self._size = size
+        self._idle_timeout = idle_timeout
+        # idle keyrings, the least recently used first.
+        self._idle = []
+        self._leased = set()
+        self._lock = threading.Lock()
+        _pools.add(self)
+
+    @property
+    def size(self):
+        """
+        The maximum number of idle keyrings kept in the pool.
+
+        :rtype: int
+        """
+        return self._size
+
+    def lease(self, keys=None):
+        """
+        Get a keyring from the pool containing exactly C{keys}.
+
+        The keyring has to be given back to the pool with C{release}.
+
+        :param keys: OpenPGP key, or list of.
+        :type keys: OpenPGPKey or list of OpenPGPKeys
+
+        :return: A keyring containing C{keys}.
+        :rtype: PooledKeyring
+        """
+        keys = _as_list(keys)
+        content = _cache_key(keys)
+        self.evict_idle()
+        with self._lock:
+            keyring = self._pop_idle(content)
+            if keyring is not None:
+                keyring.stale = False
+                self._leased.add(keyring)
+        if keyring is not None and keyring.content == content:
+            return keyring
+        loaded = False
+        try:
+            if keyring is None:
+                keyring = PooledKeyring(gpgbinary=self._gpgbinary)
+                with self._lock:
+                    self._leased.add(keyring)
+            keyring.reset()
+            keyring.load(keys)
+            loaded = True
+        finally:
+            # don't lease a keyring that failed to load, whatever the error
+            if not loaded and keyring is not None:
+                with self._lock:
+                    self._leased.discard(keyring)
+                keyring.destroy()
+        return keyring
+
+    def _pop_idle(self, content):
+        """
+        Remove and return an idle keyring, preferring the most recently used
+        keyring with C{content}, then keyrings not prepared with any keys.
+        Keyrings prepared with other keys are kept for later leases while the
+        pool has room for a new keyring, otherwise the least recently used
+        one is returned.
+
+        Must be called with the pool lock held.
+
+        :param content: The cache key of the wanted keys.
+        :type content: frozenset
+
+        :return: An idle keyring or None if there are no idle keyrings.
+        :rtype: PooledKeyring
+        """
+        for keyring in reversed(self._idle):
+            if keyring.content == content:
+                self._idle.remove(keyring)
+                return keyring
+        for keyring in self._idle:
+            if not keyring.content:
+                self._idle.remove(keyring)
+                return keyring
+        if self._idle and len(self._idle) >= self._size:
+            return self._idle.pop(0)
+        return None
+
+    def release(self, keyring):
+        """
+        Give C{keyring} back to the pool.
+
+        Keyrings that might hold private keys are emptied. If the pool is
+        full the least recently used idle keyring is destroyed.
+
+        :param keyring: A keyring obtained with C{lease}.
+        :type keyring: PooledKeyring
+        """
+        keyring.last_used = time.time()
+        if keyring.stale or not keyring.content:
+            # keyrings leased without keys are scratch keyrings that might
+            # have been modified by the caller.
+            keyring.content = None
+        if keyring.has_private_keys:
+            keyring.reset()
+        with self._lock:
+            self._leased.discard(keyring)
+            self._idle.append(keyring)
+            excess = len(self._idle) - self._size
+            evicted = []
+            if excess > 0:
+                evicted = self._idle[:excess]
+                self._idle = self._idle[excess:]
+        for old in evicted:
+            old.destroy()
+        self.evict_idle()
+
+    @contextmanager
+    def keyring(self, keys=None):
+        """
+        A context manager that leases a keyring containing C{keys} and
+        returns it to the pool when done.
+
+        :param keys: OpenPGP key, or list of.
+        :type keys: OpenPGPKey or list of OpenPGPKeys
+
+        :return: A GPG instance containing C{keys}.
+        :rtype: gnupg.GPG
+        """
+        keyring = self.lease(keys)
+        try:
+            yield keyring.gpg
+        finally:
+            self.release(keyring)
+
+    def invalidate(self, fingerprint):
+        """
+        Stop reusing keyrings that contain the key with C{fingerprint}.
+
+        This has to be called when the key material for a fingerprint
+        changes, so no outdated copy of the key is used.
+
+        :param fingerprint: The fingerprint of the key.
+        :type fingerprint: str
+        """
+        with self._lock:
+            evicted = [k for k in self._idle if k.contains(fingerprint)]
+            self._idle = [k for k in self._idle if k not in evicted]
+            for keyring in self._leased:
+                if keyring.content is None or keyring.contains(fingerprint):
+                    keyring.stale = True
+        for keyring in evicted:
+            keyring.destroy()
+
+    def evict_idle(self):
+        """
+        Destroy the keyrings that have been idle for too long.
+        """
+        deadline = time.time() - self._idle_timeout
+        with self._lock:
+            expired = [k for k in self._idle if k.last_used < deadline]
+            self._idle = [k for k in self._idle if k.last_used >= deadline]
+        for keyring in expired:
+            keyring.destroy()
+
+    def close(self):
+        """
+        Destroy all the idle keyrings of the pool.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for keyring in idle:
+            keyring.destroy()
+
+
+def _cache_key(keys):
+    """
+    Return the key used to look up a keyring containing C{keys}.
+
+    :param keys: the keys.
+    :type keys: list(OpenPGPKey)
+
+    :rtype: frozenset
+    """
+    return frozenset(
+        [(key.fingerprint, key.private) for key in keys if key])
+
+
+def _as_list(keys):
+    """
+    Return C{keys} as a list.
+    """
+    if not keys:
+        return []
+    if not isinstance(keys, list):
+        return [keys]
+    return keys
+
+
+def _wipe(path):
+    """
+    Overwrite the file at C{path} with zeros and remove it.
+
+    :param path: The path of the file.
+    :type path: str
+    """
+    if not os.path.isfile(path):
+        return
+    try:
+        size = os.path.getsize(path)
+        with open(path, 'r+b') as f:
+            f.write('\x00' * size)
+            f.flush()
+            os.fsync(f.fileno())
+    except (IOError, OSError) as e:
+        logger.warning("Could not wipe %s: %r" % (path, e))
+    os.unlink(path)
+
+
+# all live pools, so their keyrings don't outlive the process.
+_pools = weakref.WeakSet()
+
+
+@atexit.register
+def _close_pools():
+    for pool in list(_pools):
+        pool.close()
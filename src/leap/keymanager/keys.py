@@ -25,6 +25,7 @@ try:
     import simplejson as json
 except ImportError:
     import json  # noqa
+import functools
 import logging
 import re
 import time
@@ -35,6 +36,7 @@ from datetime import datetime
 from leap.common.check import leap_assert
 from twisted.internet import defer
 
+from leap.keymanager import errors
 from leap.keymanager.validation import ValidationLevels
 
 logger = logging.getLogger(__name__)
@@ -57,7 +59,9 @@ KEY_REFRESHED_AT_KEY = 'refreshed_at'
 KEY_VALIDATION_KEY = 'validation'
 KEY_ENCR_USED_KEY = 'encr_used'
 KEY_SIGN_USED_KEY = 'sign_used'
+KEY_SIGNATURES_KEY = 'signatures'
 KEY_TAGS_KEY = 'tags'
+KEY_ACTIVE_ADDRESS_KEY = 'active_address'
 
 
 #
@@ -65,6 +69,20 @@ KEY_TAGS_KEY = 'tags'
 #
 
 KEYMANAGER_KEY_TAG = 'keymanager-key'
+
+# the fields of a key that change as it is used are stored in a small usage
+# document apart from the key, so updating them doesn't rewrite the key data.
+KEYMANAGER_USAGE_TAG = 'keymanager-usage'
+KEYMANAGER_USAGE_TYPE = '-usage'
+USAGE_KEYS = (
+    KEY_LAST_AUDITED_AT_KEY,
+    KEY_REFRESHED_AT_KEY,
+    KEY_ENCR_USED_KEY,
+    KEY_SIGN_USED_KEY,
+)
+
+# previous versions stored which key is active for an address in separate
+# documents, these are only used to migrate them.
 KEYMANAGER_ACTIVE_TAG = 'keymanager-active'
 KEYMANAGER_ACTIVE_TYPE = '-active'
 
@@ -75,7 +93,7 @@ KEYMANAGER_ACTIVE_TYPE = '-active'
 
 TAGS_PRIVATE_INDEX = 'by-tags-private'
 TYPE_ID_PRIVATE_INDEX = 'by-type-id-private'
-TYPE_ADDRESS_PRIVATE_INDEX = 'by-type-address-private'
+TYPE_ACTIVE_ADDRESS_PRIVATE_INDEX = 'by-type-active-address-private'
 INDEXES = {
     TAGS_PRIVATE_INDEX: [
         KEY_TAGS_KEY,
@@ -86,13 +104,19 @@ INDEXES = {
         KEY_ID_KEY,
         'bool(%s)' % KEY_PRIVATE_KEY,
     ],
-    TYPE_ADDRESS_PRIVATE_INDEX: [
+    TYPE_ACTIVE_ADDRESS_PRIVATE_INDEX: [
         KEY_TYPE_KEY,
-        KEY_ADDRESS_KEY,
+        KEY_ACTIVE_ADDRESS_KEY,
         'bool(%s)' % KEY_PRIVATE_KEY,
     ]
 }
 
+# indexes used by previous versions, removed when found.
+TYPE_ADDRESS_PRIVATE_INDEX = 'by-type-address-private'
+OBSOLETE_INDEXES = [
+    TYPE_ADDRESS_PRIVATE_INDEX,
+]
+
 
 #
 # Key handling utilities
@@ -110,15 +134,23 @@ def is_address(address):
     return bool(re.match('[\w.-]+@[\w.-]+', address))
 
 
-def build_key_from_dict(kClass, kdict):
+def build_key_from_dict(kClass, kdict, usage=None):
     """
     Build an C{kClass} key based on info in C{kdict}.
 
     :param kdict: Dictionary with key data.
     :type kdict: dict
+    :param usage: Dictionary with the usage data of the key, if it has a
+                  usage document.
+    :type usage: dict
     :return: An instance of the key.
     :rtype: C{kClass}
     """
+    # key documents of previous versions hold the usage fields themselves
+    usage_fields = dict((name, kdict.get(name)) for name in USAGE_KEYS)
+    if usage is not None:
+        usage_fields.update((name, usage[name]) for name in USAGE_KEYS)
+
     try:
         validation = ValidationLevels.get(kdict[KEY_VALIDATION_KEY])
     except ValueError:
@@ -127,8 +159,8 @@ def build_key_from_dict(kClass, kdict):
         validation = ValidationLevels.Weak_Chain
 
     expiry_date = _to_datetime(kdict[KEY_EXPIRY_DATE_KEY])
-    last_audited_at = _to_datetime(kdict[KEY_LAST_AUDITED_AT_KEY])
-    refreshed_at = _to_datetime(kdict[KEY_REFRESHED_AT_KEY])
+    last_audited_at = _to_datetime(usage_fields[KEY_LAST_AUDITED_AT_KEY])
+    refreshed_at = _to_datetime(usage_fields[KEY_REFRESHED_AT_KEY])
 
     return kClass(
         kdict[KEY_ADDRESS_KEY],
@@ -141,13 +173,15 @@ def build_key_from_dict(kClass, kdict):
         last_audited_at=last_audited_at,
         refreshed_at=refreshed_at,
         validation=validation,
-        encr_used=kdict[KEY_ENCR_USED_KEY],
-        sign_used=kdict[KEY_SIGN_USED_KEY],
+        encr_used=bool(usage_fields[KEY_ENCR_USED_KEY]),
+        sign_used=bool(usage_fields[KEY_SIGN_USED_KEY]),
+        # keys stored by previous versions don't have their signatures
+        signatures=kdict.get(KEY_SIGNATURES_KEY),
     )
 
 
 def _to_datetime(unix_time):
-    if unix_time != 0:
+    if unix_time:
         return datetime.fromtimestamp(unix_time)
     else:
         return None
@@ -177,7 +211,8 @@ class EncryptionKey(object):
     def __init__(self, address, key_id="", fingerprint="",
                  key_data="", private=False, length=0, expiry_date=None,
                  validation=ValidationLevels.Weak_Chain, last_audited_at=None,
-                 refreshed_at=None, encr_used=False, sign_used=False):
+                 refreshed_at=None, encr_used=False, sign_used=False,
+                 signatures=None):
         self.address = address
         self.key_id = key_id
         self.fingerprint = fingerprint
@@ -190,17 +225,18 @@ class EncryptionKey(object):
         self.refreshed_at = refreshed_at
         self.encr_used = encr_used
         self.sign_used = sign_used
+        self.signatures = signatures
 
-    def get_json(self):
+    def get_json(self, active_address=()):
         """
         Return a JSON string describing this key.
 
+        :param active_address: Addresses for which the key is active.
+        :type active_address: list(str)
         :return: The JSON string describing this key.
         :rtype: str
         """
         expiry_date = _to_unix_time(self.expiry_date)
-        last_audited_at = _to_unix_time(self.last_audited_at)
-        refreshed_at = _to_unix_time(self.refreshed_at)
 
         return json.dumps({
             KEY_ADDRESS_KEY: self.address,
@@ -211,29 +247,30 @@ class EncryptionKey(object):
             KEY_PRIVATE_KEY: self.private,
             KEY_LENGTH_KEY: self.length,
             KEY_EXPIRY_DATE_KEY: expiry_date,
-            KEY_LAST_AUDITED_AT_KEY: last_audited_at,
-            KEY_REFRESHED_AT_KEY: refreshed_at,
             KEY_VALIDATION_KEY: str(self.validation),
-            KEY_ENCR_USED_KEY: self.encr_used,
-            KEY_SIGN_USED_KEY: self.sign_used,
+            KEY_SIGNATURES_KEY: self.signatures,
             KEY_TAGS_KEY: [KEYMANAGER_KEY_TAG],
+            KEY_ACTIVE_ADDRESS_KEY: list(active_address),
         })
 
-    def get_active_json(self, address):
+    def get_usage_json(self):
         """
-        Return a JSON string describing this key.
+        Return a JSON string describing the usage of this key, stored in a
+        separate document.
 
-        :param address: Address for wich the key is active
-        :type address: str
-        :return: The JSON string describing this key.
+        :return: The JSON string describing the usage of this key.
         :rtype: str
         """
         return json.dumps({
-            KEY_ADDRESS_KEY: address,
-            KEY_TYPE_KEY: self.__class__.__name__ + KEYMANAGER_ACTIVE_TYPE,
+            KEY_TYPE_KEY: self.__class__.__name__ + KEYMANAGER_USAGE_TYPE,
             KEY_ID_KEY: self.key_id,
+            KEY_FINGERPRINT_KEY: self.fingerprint,
             KEY_PRIVATE_KEY: self.private,
-            KEY_TAGS_KEY: [KEYMANAGER_ACTIVE_TAG],
+            KEY_LAST_AUDITED_AT_KEY: _to_unix_time(self.last_audited_at),
+            KEY_REFRESHED_AT_KEY: _to_unix_time(self.refreshed_at),
+            KEY_ENCR_USED_KEY: self.encr_used,
+            KEY_SIGN_USED_KEY: self.sign_used,
+            KEY_TAGS_KEY: [KEYMANAGER_USAGE_TAG],
         })
 
     def __repr__(self):
@@ -296,6 +333,9 @@ class EncryptionScheme(object):
                         lambda _:
                             self._soledad.create_index(name, *expression))
                     deferreds.append(d)
+            for name in OBSOLETE_INDEXES:
+                if name in db_indexes:
+                    deferreds.append(self._soledad.delete_index(name))
             return defer.gatherResults(deferreds, consumeErrors=True)
 
         self.deferred_indexes = self._soledad.list_indexes()
@@ -334,6 +374,25 @@ class EncryptionScheme(object):
 
         self.deferred_indexes.addCallback(restore)
 
+    def close(self):
+        """
+        Release any resources held by this Encryption Scheme.
+        """
+        pass
+
+    def wait_ready(self):
+        """
+        Wait for this Encryption Scheme to be ready to look up keys in local
+        storage.
+
+        Schemes that prepare the storage, like migrating the documents of
+        previous versions, wrap it with _wait_indexes.
+
+        :return: A Deferred which fires when the keys can be looked up.
+        :rtype: Deferred
+        """
+        return defer.succeed(None)
+
     @abstractmethod
     def get_key(self, address, private=False):
         """
@@ -351,8 +410,42 @@ class EncryptionScheme(object):
         """
         pass
 
+    def get_keys(self, addresses, private=False):
+        """
+        Get the keys bound to each of C{addresses} from local storage.
+
+        This looks up each key with get_key, concurrently. Schemes that can
+        look up all the keys with a single query override it.
+
+        :param addresses: The addresses bound to the keys.
+        :type addresses: list(str)
+        :param private: Look for private keys instead of public ones?
+        :type private: bool
+
+        :return: A Deferred which fires with a dict mapping each address to
+                 its EncryptionKey. Addresses without a key in local storage
+                 are left out.
+        :rtype: Deferred
+        """
+        keys = {}
+
+        def add_key(key, address):
+            keys[address] = key
+
+        def key_not_found(failure):
+            failure.trap(errors.KeyNotFound)
+
+        deferreds = []
+        for address in set(addresses):
+            d = self.get_key(address, private=private)
+            d.addCallbacks(add_key, key_not_found, callbackArgs=(address,))
+            deferreds.append(d)
+        d = defer.gatherResults(deferreds, consumeErrors=True)
+        d.addCallback(lambda _: keys)
+        return d
+
     @abstractmethod
-    def put_key(self, key, address):
+    def put_key(self, key, address, check=None):
         """
         Put a key in local storage.
 
@@ -360,12 +453,59 @@ class EncryptionScheme(object):
         :type key: EncryptionKey
         :param address: address for which this key will be active.
         :type address: str
+        :param check: A function called, before storing C{key}, with the
+                      key active for C{address} or None if there is none.
+                      If it raises C{key} is not stored.
+        :type check: callable
 
         :return: A Deferred which fires when the key is in the storage.
         :rtype: Deferred
         """
         pass
 
+    def put_keys(self, keys, check=None, on_result=None):
+        """
+        Put many keys in local storage.
+
+        The keys are put one after the other.
+
+        :param keys: Tuples with a key and the address for which it will be
+                     active.
+        :type keys: iterable of (EncryptionKey, str)
+        :param check: A function called, before storing each key, with the
+                      key and the key active for its address or None if
+                      there is none. If it raises the key is not stored.
+        :type check: callable
+        :param on_result: A function called with the index of each key and
+                          its result as soon as it is stored.
+        :type on_result: callable
+
+        :return: A Deferred which fires with a list with the result for each
+                 key, in order: the EncryptionKey, or a Failure.
+        :rtype: Deferred
+        """
+        results = []
+
+        def put(_, key, address):
+            check_key = None
+            if check is not None:
+                check_key = functools.partial(check, key)
+            d = self.put_key(key, address, check=check_key)
+            d.addCallback(lambda _: key)
+            d.addBoth(store)
+            return d
+
+        def store(result):
+            if on_result is not None:
+                on_result(len(results), result)
+            results.append(result)
+
+        d = defer.succeed(None)
+        for key, address in keys:
+            d.addCallback(put, key, address)
+        d.addCallback(lambda _: results)
+        return d
+
     @abstractmethod
     def gen_key(self, address):
         """
@@ -406,8 +546,8 @@ class EncryptionScheme(object):
         :param sign: The key used for signing.
         :type sign: EncryptionKey
 
-        :return: The encrypted data.
-        :rtype: str
+        :return: A Deferred which fires with the encrypted data.
+        :rtype: Deferred
         """
         pass
 
@@ -423,10 +563,10 @@ class EncryptionScheme(object):
         :param verify: The key used to verify a signature.
         :type verify: OpenPGPKey
 
-        :return: The decrypted data and if signature verifies
-        :rtype: (unicode, bool)
-
-        :raise DecryptError: Raised if failed decrypting for some reason.
+        :return: A Deferred which fires with the decrypted data and if
+                 signature verifies (unicode, bool), or which fails with
+                 DecryptError if failed decrypting for some reason.
+        :rtype: Deferred
         """
         pass
 
@@ -441,8 +581,8 @@ class EncryptionScheme(object):
         :param privkey: The private key to be used to sign.
         :type privkey: EncryptionKey
 
-        :return: The signed data.
-        :rtype: str
+        :return: A Deferred which fires with the signed data.
+        :rtype: Deferred
         """
         pass
 
@@ -460,7 +600,7 @@ class EncryptionScheme(object):
                              verified against this sdetached signature.
         :type detached_sig: str
 
-        :return: signature matches
-        :rtype: bool
+        :return: A Deferred which fires with whether the signature matches.
+        :rtype: Deferred
         """
         pass
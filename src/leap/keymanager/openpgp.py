@@ -17,37 +17,76 @@
 """
 Infrastructure for using OpenPGP keys in Key Manager.
 """
+import copy
+import fcntl
+import json
 import logging
 import os
 import re
 import shutil
+import sys
 import tempfile
-import io
+import threading
+import weakref
 
 
+from collections import deque
+from contextlib import contextmanager
+from cStringIO import StringIO
 from datetime import datetime
-from gnupg import GPG
-from gnupg.gnupg import GPGUtilities
-from twisted.internet import defer
+from twisted.internet import defer, threads
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 
 from leap.common.check import leap_assert, leap_assert_type, leap_check
-from leap.keymanager import errors
+from leap.common.events import catalog, register, unregister
+from leap.keymanager import errors, packets
+from leap.keymanager.cache import KeyCache, DEFAULT_KEY_CACHE_SIZE
+from leap.keymanager.keyring import (
+    GPG,
+    KeyringPool,
+    SPAWN_LOCK,
+    DEFAULT_POOL_SIZE,
+    DEFAULT_IDLE_TIMEOUT,
+)
 from leap.keymanager.keys import (
     EncryptionKey,
     EncryptionScheme,
     is_address,
     build_key_from_dict,
+    TAGS_PRIVATE_INDEX,
     TYPE_ID_PRIVATE_INDEX,
-    TYPE_ADDRESS_PRIVATE_INDEX,
+    TYPE_ACTIVE_ADDRESS_PRIVATE_INDEX,
+    KEY_ACTIVE_ADDRESS_KEY,
     KEY_ADDRESS_KEY,
+    KEY_ENCR_USED_KEY,
+    KEY_FINGERPRINT_KEY,
     KEY_ID_KEY,
+    KEY_PRIVATE_KEY,
+    KEY_SIGN_USED_KEY,
+    KEY_TYPE_KEY,
+    KEYMANAGER_ACTIVE_TAG,
     KEYMANAGER_ACTIVE_TYPE,
+    KEYMANAGER_USAGE_TYPE,
 )
 
 
 logger = logging.getLogger(__name__)
 
 
+# the maximum number of threads running gpg operations for a scheme.
+DEFAULT_GPG_THREADS = 4
+
+# the size of the chunks of gpg output handed to stream consumers.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# seconds the keys marked as used wait before being written to storage.
+DEFAULT_USAGE_FLUSH_INTERVAL = 60
+
+# the maximum number of keys written at a time by put_keys.
+PUT_BATCH_SIZE = 50
+
+
 #
 # A temporary GPG keyring wrapped to provide OpenPGP functionality.
 #
@@ -178,10 +217,295 @@ def _parse_address(address):
     return ''.join(match.group(2, 4))
 
 
+def _consumer_writer(consumer):
+    """
+    Return a function for gpg threads to write data to C{consumer}.
+
+    Each write is done in the reactor thread, and the calling thread waits
+    for it to finish.
+
+    :param consumer: The consumer of the data.
+    :type consumer: twisted.internet.interfaces.IConsumer
+
+    :rtype: callable
+    """
+    from twisted.internet import reactor
+
+    def write(data):
+        threads.blockingCallFromThread(reactor, consumer.write, data)
+
+    return write
+
+
+@contextmanager
+def _streaming_output(gpg, write):
+    """
+    Make C{gpg} hand the output of its operations to C{write} in chunks of
+    STREAM_CHUNK_SIZE, instead of keeping it in memory as the result data,
+    while in the context.
+
+    C{write} is called in the gpg thread, and the next chunk is only read
+    once it returns, so at most one chunk of output is held in memory at a
+    time. If C{write} is None the output is kept as the result data, as
+    usual.
+
+    :param gpg: A gpg instance leased for the context.
+    :type gpg: gnupg.GPG
+    :param write: The function to write each chunk of output.
+    :type write: callable
+
+    :return: A context manager returning a list that holds the failure of
+             the first failed write, if any.
+    :rtype: GeneratorContextManager
+    """
+    failures = []
+    if write is None:
+        yield failures
+        return
+
+    def read_data(stream, result):
+        while True:
+            data = stream.read(STREAM_CHUNK_SIZE)
+            if len(data) == 0:
+                break
+            if failures:
+                # keep draining gpg output, or gpg would never exit.
+                continue
+            try:
+                write(data)
+            except Exception:
+                failures.append(Failure())
+        result.data = ''
+
+    # gnupg reads the output of gpg with the instance's _read_data().
+    gpg._read_data = read_data
+    try:
+        yield failures
+    finally:
+        del gpg._read_data
+
+
+@contextmanager
+def _pipe_path(data):
+    """
+    Return the path of a pipe from which gpg processes started while in the
+    context can read C{data}, so it never touches the disk.
+
+    The pipe is passed as /dev/fd/N, which gnupg only accepts as a file on
+    Linux. Elsewhere C{data} is written to a temporary file instead.
+
+    :param data: The data to be read from the pipe.
+    :type data: str
+
+    :return: A context manager returning the path of the read end of the
+             pipe.
+    :rtype: GeneratorContextManager
+    """
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    if not sys.platform.startswith('linux'):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            yield f.name
+        return
+
+    # gpg must only inherit the read end, or it would never see the end of
+    # the data. The lock keeps other threads from starting gpg before the
+    # write end is marked close-on-exec.
+    with SPAWN_LOCK:
+        rfd, wfd = os.pipe()
+        fcntl.fcntl(wfd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+    def write():
+        try:
+            written = 0
+            while written < len(data):
+                written += os.write(wfd, buffer(data, written))
+        except OSError:
+            # gpg may stop reading before the end of the data.
+            pass
+        finally:
+            os.close(wfd)
+
+    writer = threading.Thread(target=write)
+    writer.daemon = True
+    writer.start()
+    try:
+        yield '/dev/fd/%d' % rfd
+    finally:
+        os.close(rfd)
+        writer.join()
+
+
+def _list_signatures(gpg, key_id, address):
+    """
+    List the key IDs that have signed the user ID of a key bound to one of
+    C{address}.
+
+    :param gpg: A gpg wrapper holding the key.
+    :type gpg: gnupg.GPG
+    :param key_id: The ID of the key.
+    :type key_id: str
+    :param address: The addresses of the key.
+    :type address: list(str)
+
+    :return: the key IDs that have signed the key
+    :rtype: list(str)
+    """
+    return _select_signatures(
+        gpg.list_sigs(key_id).sigs.iteritems(), address)
+
+
+def _select_signatures(uid_signatures, address):
+    """
+    Return the key IDs that have signed the user ID bound to the first of
+    C{address} that has one.
+
+    :param uid_signatures: Each user ID with the key IDs that have signed
+                           it.
+    :type uid_signatures: iterable of (str, list(str))
+    :param address: The addresses of the key, in order.
+    :type address: list(str)
+
+    :return: the key IDs that have signed the key
+    :rtype: list(str)
+    """
+    by_address = {}
+    for uid, sigs in uid_signatures:
+        by_address.setdefault(_parse_address(uid), set()).update(sigs)
+    for uid_address in address:
+        if uid_address is not None and uid_address in by_address:
+            return sorted(by_address[uid_address])
+    return []
+
+
 #
 # The OpenPGP wrapper
 #
 
+def _has_new_packets(oldkey, key):
+    """
+    Return whether C{key} has packets, like signatures, user IDs or subkeys,
+    that C{oldkey} lacks.
+
+    :type oldkey: OpenPGPKey
+    :type key: OpenPGPKey
+
+    :rtype: bool
+    """
+    try:
+        return not packets.key_digests(key.key_data).issubset(
+            packets.key_digests(oldkey.key_data))
+    except errors.InvalidPacket:
+        # let gnupg make sense of it
+        return True
+
+
+def _gather(deferreds):
+    """
+    Return a Deferred which fires with the results of C{deferreds}, in
+    order, or fails with the first failure.
+
+    :type deferreds: list(Deferred)
+    :rtype: Deferred
+    """
+    d = defer.DeferredList(
+        deferreds, fireOnOneErrback=True, consumeErrors=True)
+    d.addCallbacks(
+        lambda results: [result for _, result in results],
+        lambda failure: failure.value.subFailure)
+    return d
+
+
+def _find_doc(docs, fingerprint):
+    """
+    Return the document in C{docs} of the key with C{fingerprint}.
+
+    :type docs: list(SoledadDocument)
+    :type fingerprint: str
+
+    :return: The document, or None if there is none.
+    :rtype: SoledadDocument
+    """
+    for doc in docs:
+        if doc.content[KEY_FINGERPRINT_KEY] == fingerprint:
+            return doc
+    return None
+
+
+class _KeyDocs(object):
+    """
+    Key and usage documents indexed in memory, by key_id and by active
+    address like the storage does, to put many keys in a single pass.
+    """
+
+    def __init__(self, docs, usagedocs):
+        """
+        :type docs: list(SoledadDocument)
+        :type usagedocs: list(SoledadDocument)
+        """
+        self._index = {}
+        self._entries = {}
+        self._usage = {}
+        for doc in docs:
+            self.update(doc)
+        for usagedoc in usagedocs:
+            self.update_usage(usagedoc)
+
+    def update(self, doc):
+        """
+        Index C{doc} again after it changes, or for the first time.
+
+        :type doc: SoledadDocument
+        """
+        for entry in self._entries.pop(doc.doc_id, ()):
+            self._index[entry] = [
+                indexed for indexed in self._index[entry]
+                if indexed.doc_id != doc.doc_id]
+        content = doc.content
+        private = content[KEY_PRIVATE_KEY]
+        entries = [(KEY_ID_KEY, content[KEY_ID_KEY], private)]
+        entries.extend(
+            (KEY_ACTIVE_ADDRESS_KEY, address, private)
+            for address in content.get(KEY_ACTIVE_ADDRESS_KEY, []))
+        for entry in entries:
+            self._index.setdefault(entry, []).append(doc)
+        self._entries[doc.doc_id] = entries
+
+    def update_usage(self, usagedoc):
+        """
+        Index the usage document C{usagedoc}.
+
+        :type usagedoc: SoledadDocument
+        """
+        content = usagedoc.content
+        self._usage[(content[KEY_FINGERPRINT_KEY],
+                     content[KEY_PRIVATE_KEY])] = usagedoc
+
+    def by_id(self, key_id, private):
+        """
+        :return: The key documents with C{key_id}.
+        :rtype: list(SoledadDocument)
+        """
+        return list(self._index.get((KEY_ID_KEY, key_id, private), []))
+
+    def active(self, address, private):
+        """
+        :return: The key documents active for C{address}.
+        :rtype: list(SoledadDocument)
+        """
+        return list(self._index.get(
+            (KEY_ACTIVE_ADDRESS_KEY, address, private), []))
+
+    def usage(self, fingerprint, private):
+        """
+        :return: The usage document of the key with C{fingerprint}, or None.
+        :rtype: SoledadDocument
+        """
+        return self._usage.get((fingerprint, private))
+
+
 class OpenPGPKey(EncryptionKey):
     """
     Base class for OpenPGP keys.
@@ -196,16 +520,57 @@ class OpenPGPKey(EncryptionKey):
         """
         Get the key signatures
 
+        They are listed when the key is parsed, only keys stored by previous
+        versions need gpg to list them, once.
+
         :return: the key IDs that have signed the key
         :rtype: list(str)
         """
-        with TempGPGWrapper(keys=[self], gpgbinary=self._gpgbinary) as gpg:
-            res = gpg.list_sigs(self.key_id)
-            for uid, sigs in res.sigs.iteritems():
-                if _parse_address(uid) in self.address:
-                    return sigs
+        if self._signatures is None:
+            with TempGPGWrapper(keys=[self],
+                                gpgbinary=self._gpgbinary) as gpg:
+                self._signatures = _list_signatures(
+                    gpg, self.key_id, self.address)
+        return self._signatures
 
-        return []
+    @signatures.setter
+    def signatures(self, signatures):
+        self._signatures = signatures
+
+
+# the live schemes, whose pending usage flags are written before the reactor
+# shuts down without the shutdown trigger keeping them alive.
+_schemes = weakref.WeakSet()
+_usage_shutdown_trigger = None
+
+
+def _watch_usage(scheme):
+    """
+    Write the pending usage flags of C{scheme} before the reactor shuts
+    down.
+
+    A single shutdown trigger is registered for all the schemes.
+
+    :type scheme: OpenPGPScheme
+    """
+    global _usage_shutdown_trigger
+    if _usage_shutdown_trigger is None:
+        from twisted.internet import reactor
+        _usage_shutdown_trigger = reactor.addSystemEventTrigger(
+            'before', 'shutdown', _flush_usage)
+    _schemes.add(scheme)
+
+
+def _flush_usage():
+    """
+    Write the pending usage flags of all the live schemes.
+
+    :return: A Deferred which fires when the flags are written.
+    :rtype: Deferred
+    """
+    return defer.gatherResults(
+        [scheme.flush_usage() for scheme in list(_schemes)],
+        consumeErrors=True)
 
 
 class OpenPGPScheme(EncryptionScheme):
@@ -216,9 +581,17 @@ class OpenPGPScheme(EncryptionScheme):
 
     # type used on the soledad documents
     KEY_TYPE = OpenPGPKey.__name__
+    # type of the active key documents of previous versions
     ACTIVE_TYPE = KEY_TYPE + KEYMANAGER_ACTIVE_TYPE
-
-    def __init__(self, soledad, gpgbinary=None):
+    # type of the documents with the usage of the keys
+    USAGE_TYPE = KEY_TYPE + KEYMANAGER_USAGE_TYPE
+
+    def __init__(self, soledad, gpgbinary=None,
+                 keyring_pool_size=DEFAULT_POOL_SIZE,
+                 keyring_idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 gpg_threads=DEFAULT_GPG_THREADS,
+                 key_cache_size=DEFAULT_KEY_CACHE_SIZE,
+                 usage_flush_interval=DEFAULT_USAGE_FLUSH_INTERVAL):
         """
         Initialize the OpenPGP wrapper.
 
@@ -226,10 +599,86 @@ class OpenPGPScheme(EncryptionScheme):
         :type soledad: leap.soledad.Soledad
         :param gpgbinary: Name for GnuPG binary executable.
         :type gpgbinary: C{str}
+        :param keyring_pool_size: The maximum number of idle GPG keyrings
+                                  kept for reuse.
+        :type keyring_pool_size: int
+        :param keyring_idle_timeout: Seconds after which an idle GPG keyring
+                                     is destroyed.
+        :type keyring_idle_timeout: int
+        :param gpg_threads: The maximum number of threads running gpg
+                            operations.
+        :type gpg_threads: int
+        :param key_cache_size: The maximum size in bytes of the key data
+                               kept in memory to answer get_key.
+        :type key_cache_size: int
+        :param usage_flush_interval: Seconds the keys marked as used wait
+                                     before being written to storage.
+        :type usage_flush_interval: int
         """
         EncryptionScheme.__init__(self, soledad)
-        self._wait_indexes("get_key", "put_key")
+        # keys stored by previous versions are migrated before serving them,
+        # the wrapped methods wait for the migration as it is chained before
+        self.deferred_indexes.addCallback(
+            lambda _: self._migrate_active_docs())
+        self._wait_indexes(
+            "get_key", "get_keys", "put_key", "put_keys", "delete_key",
+            "flush_usage", "wait_ready")
         self._gpgbinary = gpgbinary
+        self._keyring_pool = KeyringPool(
+            gpgbinary=gpgbinary,
+            size=keyring_pool_size,
+            idle_timeout=keyring_idle_timeout)
+        self._threadpool = ThreadPool(
+            minthreads=0, maxthreads=gpg_threads,
+            name='keymanager-openpgp')
+        self._shutdown_trigger = None
+        self._key_cache = KeyCache(max_size=key_cache_size)
+        # a sync might bring keys from other devices, so the cached ones
+        # can't be trusted anymore.
+        self._sync_callback_uid = register(
+            catalog.SOLEDAD_DONE_DATA_SYNC, self._clear_key_cache)
+        # the usage flags not written to storage yet, by key.
+        self._usage = {}
+        self._usage_flush_interval = usage_flush_interval
+        self._usage_flush_call = None
+        _watch_usage(self)
+
+    def close(self):
+        """
+        Write the pending usage flags, stop the gpg thread pool and destroy
+        the pooled GPG keyrings.
+
+        :return: A Deferred which fires when the usage flags are written.
+        :rtype: Deferred
+        """
+        from twisted.internet import reactor
+        unregister(catalog.SOLEDAD_DONE_DATA_SYNC, self._sync_callback_uid)
+        _schemes.discard(self)
+        d = self.flush_usage()
+        if self._threadpool.started:
+            reactor.removeSystemEventTrigger(self._shutdown_trigger)
+            self._threadpool.stop()
+        self._keyring_pool.close()
+        return d
+
+    def get_key_cache_stats(self):
+        """
+        Return the hit and miss counters, the hit ratio, the number of keys
+        and their size of the in-memory key cache.
+
+        :rtype: dict
+        """
+        return self._key_cache.stats()
+
+    def _clear_key_cache(self, *_):
+        """
+        Clear the in-memory key cache.
+
+        Events might be received in other threads, so the cache is cleared
+        in the reactor thread.
+        """
+        from twisted.internet import reactor
+        reactor.callFromThread(self._key_cache.clear)
 
     #
     # Keys management
@@ -249,7 +698,7 @@ class OpenPGPScheme(EncryptionScheme):
         # make sure the key does not already exist
         leap_assert(is_address(address), 'Not an user address: %s' % address)
 
-        def _gen_key(_):
+        def generate():
             with self._temporary_gpgwrapper() as gpg:
                 # TODO: inspect result, or use decorator
                 params = gpg.gen_key_input(
@@ -280,16 +729,29 @@ class OpenPGPScheme(EncryptionScheme):
                         break
                 leap_assert(uid_match, 'Key not correctly bound to address.')
 
-                # insert both public and private keys in storage
-                deferreds = []
+                signatures = _list_signatures(
+                    gpg, key['fingerprint'], [address])
+                openpgp_keys = []
                 for secret in [True, False]:
                     key = gpg.list_keys(secret=secret).pop()
-                    openpgp_key = self._build_key_from_gpg(
+                    openpgp_keys.append(self._build_key_from_gpg(
                         key,
-                        gpg.export_keys(key['fingerprint'], secret=secret))
-                    d = self.put_key(openpgp_key, address)
-                    deferreds.append(d)
-                return defer.gatherResults(deferreds)
+                        gpg.export_keys(key['fingerprint'], secret=secret),
+                        signatures))
+                return openpgp_keys
+
+        def store(openpgp_keys):
+            # insert both public and private keys in storage
+            return defer.gatherResults(
+                [self.put_key(openpgp_key, address)
+                 for openpgp_key in openpgp_keys])
+
+        def _gen_key(_):
+            # generating a 4096 bits key takes a long time, keep it off the
+            # reactor thread
+            d = self._from_thread(generate)
+            d.addCallback(store)
+            return d
 
         def key_already_exists(_):
             raise errors.KeyAlreadyExists(address)
@@ -314,6 +776,10 @@ class OpenPGPScheme(EncryptionScheme):
         :rtype: Deferred
         """
         address = _parse_address(address)
+        key = self._key_cache.get(address, private)
+        if key is not None:
+            return defer.succeed(self._apply_usage(key))
+        generation = self._key_cache.generation
 
         def build_key(doc):
             if doc is None:
@@ -321,30 +787,300 @@ class OpenPGPScheme(EncryptionScheme):
             leap_assert(
                 address in doc.content[KEY_ADDRESS_KEY],
                 'Wrong address in key data.')
-            key = build_key_from_dict(OpenPGPKey, doc.content)
-            key._gpgbinary = self._gpgbinary
-            return key
+            d = self._get_usage_doc(
+                doc.content[KEY_ID_KEY],
+                doc.content[KEY_PRIVATE_KEY],
+                doc.content[KEY_FINGERPRINT_KEY])
+            d.addCallback(cache_key, doc)
+            return d
+
+        def cache_key(usagedoc, doc):
+            key = self._build_key_from_docs(doc, usagedoc)
+            self._key_cache.put(address, key, generation=generation)
+            return self._apply_usage(key)
 
         d = self._get_key_doc(address, private)
         d.addCallback(build_key)
         return d
 
+    def get_keys(self, addresses, private=False):
+        """
+        Get the keys bound to each of C{addresses} from local storage.
+
+        The key documents of the addresses that are not in the key cache
+        are looked up at the same time, and then the usage documents of the
+        keys found.
+
+        :param addresses: The addresses bound to the keys.
+        :type addresses: list(str)
+        :param private: Look for private keys instead of public ones?
+        :type private: bool
+
+        :return: A Deferred which fires with a dict mapping each address to
+                 its OpenPGPKey. Addresses without a key in local storage
+                 are left out.
+        :rtype: Deferred
+        """
+        keys = {}
+        # the addresses asked for of each address not in the cache
+        missing = {}
+        for address in set(addresses):
+            parsed = _parse_address(address)
+            key = self._key_cache.get(parsed, private)
+            if key is not None:
+                keys[address] = self._apply_usage(key)
+            else:
+                missing.setdefault(parsed, []).append(address)
+        if not missing:
+            return defer.succeed(keys)
+        generation = self._key_cache.generation
+
+        parsed_addresses = list(missing)
+
+        def get_usage_docs(docs):
+            found = [(parsed, doc)
+                     for parsed, doc in zip(parsed_addresses, docs)
+                     if doc is not None]
+            d = _gather([
+                self._get_usage_doc(
+                    doc.content[KEY_ID_KEY],
+                    doc.content[KEY_PRIVATE_KEY],
+                    doc.content[KEY_FINGERPRINT_KEY])
+                for _, doc in found])
+            d.addCallback(build_keys, found)
+            return d
+
+        def build_keys(usagedocs, found):
+            for (parsed, doc), usagedoc in zip(found, usagedocs):
+                key = self._build_key_from_docs(doc, usagedoc)
+                self._key_cache.put(parsed, key, generation=generation)
+                for address in missing[parsed]:
+                    keys[address] = self._apply_usage(copy.deepcopy(key))
+            return keys
+
+        d = _gather([self._get_key_doc(parsed, private)
+                     for parsed in parsed_addresses])
+        d.addCallback(get_usage_docs)
+        return d
+
+    def _build_key_from_docs(self, doc, usagedoc):
+        """
+        Build an OpenPGPKey from its key document and its usage document.
+
+        :param doc: The document with the key.
+        :type doc: SoledadDocument
+        :param usagedoc: The document with the usage of the key, or None if
+                         the key doesn't have one yet.
+        :type usagedoc: SoledadDocument
+
+        :rtype: OpenPGPKey
+        """
+        usage = usagedoc.content if usagedoc is not None else None
+        key = build_key_from_dict(OpenPGPKey, doc.content, usage)
+        key._gpgbinary = self._gpgbinary
+        return key
+
+    def mark_used(self, key, encr_used=False, sign_used=False):
+        """
+        Mark C{key} as used to encrypt or to verify a signature.
+
+        The flags are kept in memory, where get_key sees them, and written
+        to storage every usage_flush_interval seconds, in a single pass for
+        all the keys. Flags that are already set are never written again.
+
+        :param key: The key that was used.
+        :type key: OpenPGPKey
+        :param encr_used: Whether the key was used to encrypt.
+        :type encr_used: bool
+        :param sign_used: Whether the key was used to verify a signature.
+        :type sign_used: bool
+        """
+        encr_used = encr_used and not key.encr_used
+        sign_used = sign_used and not key.sign_used
+        if not (encr_used or sign_used):
+            return
+        key.encr_used = key.encr_used or encr_used
+        key.sign_used = key.sign_used or sign_used
+        usage = self._usage.setdefault(
+            (key.key_id, key.private),
+            {KEY_FINGERPRINT_KEY: key.fingerprint,
+             KEY_ENCR_USED_KEY: False,
+             KEY_SIGN_USED_KEY: False})
+        usage[KEY_ENCR_USED_KEY] = usage[KEY_ENCR_USED_KEY] or encr_used
+        usage[KEY_SIGN_USED_KEY] = usage[KEY_SIGN_USED_KEY] or sign_used
+        if self._usage_flush_call is None:
+            from twisted.internet import reactor
+            self._usage_flush_call = reactor.callLater(
+                self._usage_flush_interval, self.flush_usage)
+
+    def _apply_usage(self, key):
+        """
+        Set the usage flags of C{key} that might not be in storage yet.
+
+        :type key: OpenPGPKey
+        :rtype: OpenPGPKey
+        """
+        usage = self._usage.get((key.key_id, key.private))
+        if usage is not None:
+            key.encr_used = key.encr_used or usage[KEY_ENCR_USED_KEY]
+            key.sign_used = key.sign_used or usage[KEY_SIGN_USED_KEY]
+        return key
+
+    def flush_usage(self):
+        """
+        Write the usage flags set by mark_used to storage.
+
+        Only the usage documents of keys whose flags change are written,
+        the key documents are left untouched.
+
+        :return: A Deferred which fires when the flags are written.
+        :rtype: Deferred
+        """
+        if self._usage_flush_call is not None:
+            if self._usage_flush_call.active():
+                self._usage_flush_call.cancel()
+            self._usage_flush_call = None
+
+        def update(usagedoc, key_id, private, usage):
+            if usagedoc is None:
+                # keys stored by previous versions keep their usage in the
+                # key document, move it to a usage document of its own
+                d = self._soledad.get_from_index(
+                    TYPE_ID_PRIVATE_INDEX,
+                    self.KEY_TYPE,
+                    key_id,
+                    '1' if private else '0')
+                d.addCallback(create, usage)
+                return d
+            content = usagedoc.content
+            changed = False
+            for flag in (KEY_ENCR_USED_KEY, KEY_SIGN_USED_KEY):
+                if usage[flag] and not content[flag]:
+                    content[flag] = changed = True
+            if changed:
+                usagedoc.content = content
+                return self._soledad.put_doc(usagedoc)
+
+        def create(docs, usage):
+            for doc in docs:
+                if doc.content[KEY_FINGERPRINT_KEY] == \
+                        usage[KEY_FINGERPRINT_KEY]:
+                    key = build_key_from_dict(OpenPGPKey, doc.content)
+                    key.encr_used = key.encr_used or usage[KEY_ENCR_USED_KEY]
+                    key.sign_used = key.sign_used or usage[KEY_SIGN_USED_KEY]
+                    return self._put_usage_doc(key, None)
+
+        def written(_, cache_key, usage):
+            # keep the flags set while writing for the next flush
+            if self._usage.get(cache_key) == usage:
+                del self._usage[cache_key]
+            self._key_cache.invalidate(usage[KEY_FINGERPRINT_KEY])
+
+        def log_error(failure):
+            logger.error("Failed to write the usage of the keys: %r"
+                         % (failure,))
+
+        deferreds = []
+        for cache_key, usage in self._usage.items():
+            key_id, private = cache_key
+            d = self._get_usage_doc(
+                key_id, private, usage[KEY_FINGERPRINT_KEY])
+            d.addCallback(update, key_id, private, usage)
+            d.addCallback(written, cache_key, dict(usage))
+            deferreds.append(d)
+        d = defer.gatherResults(deferreds, consumeErrors=True)
+        d.addCallbacks(lambda _: None, log_error)
+        return d
+
     def parse_ascii_key(self, key_data):
         """
         Parses an ascii armored key (or key pair) data and returns
         the OpenPGPKey keys.
 
+        The key packets are parsed in-process, gpg is only used for the keys
+        the parser doesn't support.
+
         :param key_data: the key data to be parsed.
         :type key_data: str or unicode
 
-        :returns: the public key and private key (if applies) for that data.
-        :rtype: (public, private) -> tuple(OpenPGPKey, OpenPGPKey)
-                the tuple may have one or both components None
+        :return: A Deferred which fires with the public key and private key
+                 (if applies) for that data, the tuple may have one or both
+                 components None.
+        :rtype: Deferred
         """
         leap_assert_type(key_data, (str, unicode))
         # TODO: add more checks for correct key data.
         leap_assert(key_data is not None, 'Data does not represent a key.')
 
+        try:
+            parsed = packets.parse_key(key_data)
+        except errors.InvalidPacket as e:
+            logger.debug("Parsing the key with gpg: %s" % (e,))
+            return self._from_thread(self._parse_ascii_key_with_gpg, key_data)
+
+        openpgp_privkey = None
+        if parsed.secret:
+            openpgp_privkey = self._build_key_from_packets(parsed, True)
+        openpgp_pubkey = self._build_key_from_packets(parsed, False)
+        return defer.succeed((openpgp_pubkey, openpgp_privkey))
+
+    def parse_keyring(self, data):
+        """
+        Parse each of the keys in the keyring C{data} like parse_ascii_key
+        does.
+
+        :param data: A binary keyring, or ASCII armored keys.
+        :type data: str
+
+        :return: A Deferred which fires with the public key and private key
+                 (if applies) of each key in the keyring, in order, or fails
+                 with InvalidPacket if C{data} is not a valid keyring.
+        :rtype: Deferred
+        """
+        try:
+            keys = packets.split_keys(data)
+        except errors.InvalidPacket:
+            return defer.fail()
+        return _gather([self.parse_ascii_key(key_data)
+                        for key_data in keys])
+
+    def _build_key_from_packets(self, parsed, secret):
+        """
+        Build an OpenPGPKey from a key parsed from its packets.
+
+        :param parsed: The parsed key.
+        :type parsed: packets.ParsedKey
+        :param secret: Build the private key instead of the public one.
+        :type secret: bool
+
+        :return: An instance of the key.
+        :rtype: OpenPGPKey
+        """
+        # the same fields gpg lists for a key
+        key = {
+            'keyid': parsed.key_id,
+            'fingerprint': parsed.fingerprint,
+            'uids': parsed.uids,
+            'length': parsed.length,
+            'expires': parsed.expires,
+            'type': 'sec' if secret else 'pub',
+        }
+        signatures = _select_signatures(
+            parsed.uid_signatures, map(_parse_address, parsed.uids))
+        return self._build_key_from_gpg(
+            key, parsed.export(secret=secret), signatures)
+
+    def _parse_ascii_key_with_gpg(self, key_data):
+        """
+        Parse C{key_data} like parse_ascii_key() does, importing it in a
+        keyring, for the keys the in-process parser doesn't support.
+
+        :param key_data: the key data to be parsed.
+        :type key_data: str or unicode
+
+        :returns: the public key and private key (if applies) for that data.
+        :rtype: (public, private) -> tuple(OpenPGPKey, OpenPGPKey)
+        """
         with self._temporary_gpgwrapper() as gpg:
             # TODO: inspect result, or use decorator
             gpg.import_keys(key_data)
@@ -360,12 +1096,19 @@ class OpenPGPScheme(EncryptionScheme):
             except IndexError:
                 return (None, None)
 
+            # list the signatures now, so deciding whether a key can be
+            # upgraded doesn't need gpg
+            signatures = _list_signatures(
+                gpg, pubkey['fingerprint'],
+                map(_parse_address, pubkey['uids']))
+
             openpgp_privkey = None
             if privkey is not None:
                 # build private key
                 openpgp_privkey = self._build_key_from_gpg(
                     privkey,
-                    gpg.export_keys(privkey['fingerprint'], secret=True))
+                    gpg.export_keys(privkey['fingerprint'], secret=True),
+                    signatures)
                 leap_check(pubkey['fingerprint'] == privkey['fingerprint'],
                            'Fingerprints for public and private key differ.',
                            errors.KeyFingerprintMismatch)
@@ -373,7 +1116,8 @@ class OpenPGPScheme(EncryptionScheme):
             # build public key
             openpgp_pubkey = self._build_key_from_gpg(
                 pubkey,
-                gpg.export_keys(pubkey['fingerprint'], secret=False))
+                gpg.export_keys(pubkey['fingerprint'], secret=False),
+                signatures)
 
             return (openpgp_pubkey, openpgp_privkey)
 
@@ -391,129 +1135,456 @@ class OpenPGPScheme(EncryptionScheme):
         """
         leap_assert_type(key_data, (str, unicode))
 
-        openpgp_privkey = None
-        try:
-            openpgp_pubkey, openpgp_privkey = self.parse_ascii_key(key_data)
-        except (errors.KeyAddressMismatch, errors.KeyFingerprintMismatch) as e:
-            return defer.fail(e)
-
         def put_key(_, key):
             return self.put_key(key, address)
 
-        d = defer.succeed(None)
-        if openpgp_pubkey is not None:
-            d.addCallback(put_key, openpgp_pubkey)
-        if openpgp_privkey is not None:
-            d.addCallback(put_key, openpgp_privkey)
+        def put_keys(keys):
+            openpgp_pubkey, openpgp_privkey = keys
+            d = defer.succeed(None)
+            if openpgp_pubkey is not None:
+                d.addCallback(put_key, openpgp_pubkey)
+            if openpgp_privkey is not None:
+                d.addCallback(put_key, openpgp_privkey)
+            return d
+
+        d = self.parse_ascii_key(key_data)
+        d.addCallback(put_keys)
         return d
 
-    def put_key(self, key, address):
+    def put_key(self, key, address, check=None):
         """
         Put C{key} in local storage.
 
+        The documents needed are looked up once, and also used to build the
+        key that is active for C{address} before the put.
+
         :param key: The key to be stored.
         :type key: OpenPGPKey
         :param address: address for which this key will be active.
         :type address: str
+        :param check: A function called, before storing C{key}, with the
+                      key active for C{address} or None if there is none.
+                      If it raises C{key} is not stored.
+        :type check: callable
 
         :return: A Deferred which fires when the key is in the storage.
         :rtype: Deferred
         """
-        d = self._put_key_doc(key)
-        d.addCallback(lambda _: self._put_active_doc(key, address))
+        activekey = self._key_cache.peek(address, key.private)
+        self._key_cache.invalidate_address(address, key.private)
+        private = '1' if key.private else '0'
+
+        def put(results):
+            activedocs, docs, usagedocs = results
+            usagedoc = _find_doc(usagedocs, key.fingerprint)
+
+            def get_usage_doc(doc):
+                fingerprint = doc.content[KEY_FINGERPRINT_KEY]
+                if doc.content[KEY_ID_KEY] == key.key_id:
+                    return defer.succeed(_find_doc(usagedocs, fingerprint))
+                return self._get_usage_doc(
+                    doc.content[KEY_ID_KEY], key.private, fingerprint)
+
+            d = defer.succeed(None)
+            if check is not None:
+                d.addCallback(
+                    lambda _: self._get_active_key(
+                        activekey, address, activedocs, get_usage_doc))
+                d.addCallback(check)
+            d.addCallback(
+                lambda _: self._deactivate_key_docs(key, address, activedocs))
+            d.addCallback(
+                lambda _: self._put_key_doc(key, address, docs, usagedoc))
+            d.addCallback(cache_key)
+            return d
+
+        def cache_key(docs):
+            doc, usagedoc = docs
+            self._cache_stored_key(address, doc, usagedoc)
+
+        d = defer.gatherResults([
+            self._soledad.get_from_index(
+                TYPE_ACTIVE_ADDRESS_PRIVATE_INDEX,
+                self.KEY_TYPE,
+                address,
+                private),
+            self._soledad.get_from_index(
+                TYPE_ID_PRIVATE_INDEX,
+                self.KEY_TYPE,
+                key.key_id,
+                private),
+            self._soledad.get_from_index(
+                TYPE_ID_PRIVATE_INDEX,
+                self.USAGE_TYPE,
+                key.key_id,
+                private),
+        ], consumeErrors=True)
+        d.addCallbacks(put, lambda failure: failure.value.subFailure)
         return d
 
-    def _put_key_doc(self, key):
+    def put_keys(self, keys, check=None, on_result=None):
         """
-        Put key document in soledad
+        Put many keys in local storage in a single pass.
+
+        The documents of the keys and of the keys active for their addresses
+        are looked up at the same time for all of them, and the keys are
+        written in batches of up to PUT_BATCH_SIZE keys,
+        concurrently. A key touching the documents of a previous key of the
+        batch starts a new batch.
+
+        :param keys: Tuples with a key and the address for which it will be
+                     active.
+        :type keys: iterable of (OpenPGPKey, str)
+        :param check: A function called, before storing each key, with the
+                      key and the key active for its address or None if
+                      there is none. If it raises the key is not stored.
+        :type check: callable
+        :param on_result: A function called with the index of each key and
+                          its result as soon as it is stored.
+        :type on_result: callable
+
+        :return: A Deferred which fires with a list with the result for each
+                 key, in order: the stored OpenPGPKey, or a Failure.
+        :rtype: Deferred
+        """
+        keys = list(keys)
+        results = {}
+
+        def put_batch(stored, pending):
+            batch = []
+            touched = set()
+            while pending and len(batch) < PUT_BATCH_SIZE:
+                index, (key, address) = pending[0]
+                activedocs = stored.active(address, key.private)
+                entries = set(
+                    (doc.content[KEY_ID_KEY], key.private)
+                    for doc in activedocs)
+                entries.add((key.key_id, key.private))
+                entries.add((address, key.private))
+                if touched & entries:
+                    break
+                touched |= entries
+                pending.popleft()
+                d = put(key, address, activedocs, stored)
+                d.addBoth(store, index)
+                batch.append(d)
+            if not batch:
+                return
+            d = defer.gatherResults(batch)
+            d.addCallback(lambda _: put_batch(stored, pending))
+            return d
 
-        :type key: OpenPGPKey
+        def put(key, address, activedocs, stored):
+            activekey = self._key_cache.peek(address, key.private)
+            self._key_cache.invalidate_address(address, key.private)
+
+            def get_usage_doc(doc):
+                return defer.succeed(stored.usage(
+                    doc.content[KEY_FINGERPRINT_KEY], key.private))
+
+            def reindex(_):
+                for doc in activedocs:
+                    stored.update(doc)
+
+            def update(docs):
+                doc, usagedoc = docs
+                stored.update(doc)
+                stored.update_usage(usagedoc)
+                return self._cache_stored_key(address, doc, usagedoc)
+
+            d = defer.succeed(None)
+            if check is not None:
+                d.addCallback(
+                    lambda _: self._get_active_key(
+                        activekey, address, activedocs, get_usage_doc))
+                d.addCallback(lambda activekey: check(key, activekey))
+            d.addCallback(
+                lambda _: self._deactivate_key_docs(key, address, activedocs))
+            d.addCallback(reindex)
+            d.addCallback(
+                lambda _: self._put_key_doc(
+                    key, address,
+                    stored.by_id(key.key_id, key.private),
+                    stored.usage(key.fingerprint, key.private)))
+            d.addCallback(update)
+            return d
+
+        def store(result, index):
+            results[index] = result
+            if on_result is not None:
+                on_result(index, result)
+
+        d = self._get_put_docs(keys)
+        d.addCallback(put_batch, deque(enumerate(keys)))
+        d.addCallback(lambda _: [results[i] for i in range(len(keys))])
+        return d
+
+    def _get_put_docs(self, keys):
+        """
+        Get the key and usage documents that putting C{keys} touches: those
+        of the keys and those of the keys active for their addresses.
+
+        :param keys: Tuples with a key and the address for which it will be
+                     active.
+        :type keys: list of (OpenPGPKey, str)
+
+        :return: A Deferred which fires with the documents, as _KeyDocs.
         :rtype: Deferred
         """
-        def check_and_put(docs, key):
-            if len(docs) == 1:
-                doc = docs.pop()
-                oldkey = build_key_from_dict(OpenPGPKey, doc.content)
-                if key.fingerprint == oldkey.fingerprint:
-                    # in case of an update of the key merge them with gnupg
-                    with self._temporary_gpgwrapper() as gpg:
-                        gpg.import_keys(oldkey.key_data)
-                        gpg.import_keys(key.key_data)
-                        gpgkey = gpg.list_keys(secret=key.private).pop()
-                        mergedkey = self._build_key_from_gpg(
-                            gpgkey,
-                            gpg.export_keys(gpgkey['fingerprint'],
-                                            secret=key.private))
-                    mergedkey.validation = max(
-                        [key.validation, oldkey.validation])
-                    mergedkey.last_audited_at = oldkey.last_audited_at
-                    mergedkey.refreshed_at = key.refreshed_at
-                    mergedkey.encr_used = key.encr_used or oldkey.encr_used
-                    mergedkey.sign_used = key.sign_used or oldkey.sign_used
-                    doc.set_json(mergedkey.get_json())
-                    d = self._soledad.put_doc(doc)
-                else:
-                    logger.critical(
-                        "Can't put a key whith the same key_id and different "
-                        "fingerprint: %s, %s"
-                        % (key.fingerprint, oldkey.fingerprint))
-                    d = defer.fail(
-                        errors.KeyFingerprintMismatch(key.fingerprint))
-            elif len(docs) > 1:
-                logger.critical(
-                    "There is more than one key with the same key_id %s"
-                    % (key.key_id,))
-                d = defer.fail(errors.KeyAttributesDiffer(key.key_id))
-            else:
-                d = self._soledad.create_doc_from_json(key.get_json())
+        def get_all(queries):
+            d = _gather([self._soledad.get_from_index(*query)
+                         for query in queries])
+            d.addCallback(
+                lambda results: [doc for docs in results for doc in docs])
             return d
 
-        d = self._soledad.get_from_index(
-            TYPE_ID_PRIVATE_INDEX,
-            self.KEY_TYPE,
-            key.key_id,
-            '1' if key.private else '0')
-        d.addCallback(check_and_put, key)
+        def usage_query(key_id, private):
+            return (TYPE_ID_PRIVATE_INDEX, self.USAGE_TYPE, key_id,
+                    '1' if private else '0')
+
+        queries = set()
+        for key, address in keys:
+            private = '1' if key.private else '0'
+            queries.add(
+                (TYPE_ID_PRIVATE_INDEX, self.KEY_TYPE, key.key_id, private))
+            queries.add(
+                (TYPE_ACTIVE_ADDRESS_PRIVATE_INDEX, self.KEY_TYPE, address,
+                 private))
+
+        def get_usage_docs(docs):
+            d = get_all(set(
+                usage_query(doc.content[KEY_ID_KEY],
+                            doc.content[KEY_PRIVATE_KEY])
+                for doc in docs))
+            d.addCallback(lambda usagedocs: _KeyDocs(docs, usagedocs))
+            return d
+
+        d = get_all(queries)
+        d.addCallback(get_usage_docs)
+        return d
+
+    def _cache_stored_key(self, address, doc, usagedoc):
+        """
+        Cache the key as stored, it might have been merged with a previous
+        version.
+
+        :type address: str
+        :type doc: SoledadDocument
+        :type usagedoc: SoledadDocument
+
+        :return: The stored key.
+        :rtype: OpenPGPKey
+        """
+        stored = self._build_key_from_docs(doc, usagedoc)
+        if address in doc.content[KEY_ADDRESS_KEY]:
+            self._key_cache.put(address, stored)
+        return stored
+
+    def _get_active_key(self, activekey, address, activedocs, get_usage_doc):
+        """
+        Build the key active for an address from its documents, unless it
+        is C{activekey} from the key cache.
+
+        :param activekey: The cached active key, or None.
+        :type activekey: OpenPGPKey
+        :param address: The address the key is active for.
+        :type address: str
+        :param activedocs: The key documents active for the address.
+        :type activedocs: list(SoledadDocument)
+        :param get_usage_doc: A function called with the key document to
+                              get a Deferred which fires with its usage
+                              document.
+        :type get_usage_doc: callable
+
+        :return: A Deferred which fires with the active OpenPGPKey, or None
+                 if there is no active key.
+        :rtype: Deferred
+        """
+        if activekey is not None:
+            return defer.succeed(self._apply_usage(activekey))
+        if len(activedocs) == 0:
+            return defer.succeed(None)
+        leap_assert(
+            len(activedocs) == 1,
+            'Found more than one key for address %s!' % (address,))
+        doc = activedocs[0]
+
+        def build_key(usagedoc):
+            return self._apply_usage(self._build_key_from_docs(doc, usagedoc))
+
+        d = get_usage_doc(doc)
+        d.addCallback(build_key)
         return d
 
-    def _put_active_doc(self, key, address):
+    def _put_key_doc(self, key, address, docs, usagedoc):
         """
-        Put active key document in soledad
+        Put key document in soledad, active for C{address}, and its usage
+        in the usage document.
+
+        Key documents stored by previous versions, with the usage in them,
+        are rewritten without it.
 
         :type key: OpenPGPKey
-        :type addresses: str
+        :type address: str
+        :param docs: The key documents with the key_id of C{key}.
+        :type docs: list(SoledadDocument)
+        :param usagedoc: The usage document of C{key}, or None.
+        :type usagedoc: SoledadDocument
+
+        :return: A Deferred which fires with a tuple of the stored key
+                 document and usage document.
         :rtype: Deferred
         """
-        def check_and_put(docs):
-            if len(docs) == 1:
-                doc = docs.pop()
-                doc.set_json(key.get_active_json(address))
+        def put_usage(_, doc, key, usagedoc):
+            d = self._put_usage_doc(key, usagedoc)
+            d.addCallback(lambda usagedoc: (doc, usagedoc))
+            return d
+
+        def merge_metadata(mergedkey, doc, oldkey):
+            mergedkey.validation = max(
+                [key.validation, oldkey.validation])
+            mergedkey.last_audited_at = oldkey.last_audited_at
+            mergedkey.refreshed_at = key.refreshed_at
+            mergedkey.encr_used = key.encr_used or oldkey.encr_used
+            mergedkey.sign_used = key.sign_used or oldkey.sign_used
+            self._key_cache.invalidate(key.fingerprint)
+            active = doc.content.get(KEY_ACTIVE_ADDRESS_KEY, [])
+            if address not in active:
+                active = active + [address]
+            content = json.loads(
+                mergedkey.get_json(active_address=active))
+            if content != doc.content:
+                doc.content = content
                 d = self._soledad.put_doc(doc)
             else:
-                if len(docs) > 1:
-                    logger.error("There is more than one active key document "
-                                 "for the address %s" % (address,))
-                    deferreds = []
-                    for doc in docs:
-                        delete = self._soledad.delete_doc(doc)
-                        deferreds.append(delete)
-                    d = defer.gatherResults(deferreds, consumeErrors=True)
+                d = defer.succeed(None)
+            d.addCallback(put_usage, doc, mergedkey, usagedoc)
+            return d
+
+        def invalidate_keyrings(mergedkey):
+            # the key material changed, so stop using keyrings
+            # prepared with the old one
+            self._keyring_pool.invalidate(key.fingerprint)
+            return mergedkey
+
+        if len(docs) == 1:
+            doc = docs[0]
+            oldkey = self._build_key_from_docs(doc, usagedoc)
+            if key.fingerprint == oldkey.fingerprint:
+                if _has_new_packets(oldkey, key):
+                    # the key got new signatures, user IDs or subkeys,
+                    # merge them with gnupg
+                    d = self._from_thread(self._merge_keys, oldkey, key)
+                    d.addCallback(invalidate_keyrings)
                 else:
-                    d = defer.succeed(None)
+                    # same key material, only the metadata is merged
+                    d = defer.succeed(oldkey)
+                d.addCallback(merge_metadata, doc, oldkey)
+            else:
+                logger.critical(
+                    "Can't put a key whith the same key_id and different "
+                    "fingerprint: %s, %s"
+                    % (key.fingerprint, oldkey.fingerprint))
+                d = defer.fail(
+                    errors.KeyFingerprintMismatch(key.fingerprint))
+        elif len(docs) > 1:
+            logger.critical(
+                "There is more than one key with the same key_id %s"
+                % (key.key_id,))
+            d = defer.fail(errors.KeyAttributesDiffer(key.key_id))
+        else:
+            d = self._soledad.create_doc_from_json(
+                key.get_json(active_address=[address]))
+            d.addCallback(lambda doc: put_usage(None, doc, key, usagedoc))
+        return d
 
-                d.addCallback(
-                    lambda _: self._soledad.create_doc_from_json(
-                        key.get_active_json(address)))
-            return d
+    def _get_usage_doc(self, key_id, private, fingerprint):
+        """
+        Get the document with the usage of a key.
+
+        :param key_id: The key_id of the key.
+        :type key_id: str
+        :param private: Whether the key is private.
+        :type private: bool
+        :param fingerprint: The fingerprint of the key.
+        :type fingerprint: str
 
+        :return: A Deferred which fires with the SoledadDocument with the
+                 usage or None if it does not exist.
+        :rtype: Deferred
+        """
         d = self._soledad.get_from_index(
-            TYPE_ADDRESS_PRIVATE_INDEX,
-            self.ACTIVE_TYPE,
-            address,
-            '1' if key.private else '0')
-        d.addCallback(check_and_put)
+            TYPE_ID_PRIVATE_INDEX,
+            self.USAGE_TYPE,
+            key_id,
+            '1' if private else '0')
+        d.addCallback(_find_doc, fingerprint)
         return d
 
+    def _put_usage_doc(self, key, usagedoc):
+        """
+        Store the usage of C{key} in C{usagedoc}, or in a new document if
+        C{usagedoc} is None. C{usagedoc} is not written if it doesn't change.
+
+        :type key: OpenPGPKey
+        :type usagedoc: SoledadDocument
+
+        :return: A Deferred which fires with the stored usage document.
+        :rtype: Deferred
+        """
+        if usagedoc is None:
+            return self._soledad.create_doc_from_json(key.get_usage_json())
+        content = json.loads(key.get_usage_json())
+        if content == usagedoc.content:
+            return defer.succeed(usagedoc)
+        usagedoc.content = content
+        d = self._soledad.put_doc(usagedoc)
+        d.addCallback(lambda _: usagedoc)
+        return d
+
+    def _merge_keys(self, oldkey, key):
+        """
+        Merge the packets of C{key} and C{oldkey}, two versions of the same
+        key, with gnupg.
+
+        :type oldkey: OpenPGPKey
+        :type key: OpenPGPKey
+
+        :return: The merged key, without metadata.
+        :rtype: OpenPGPKey
+        """
+        with self._temporary_gpgwrapper() as gpg:
+            gpg.import_keys(oldkey.key_data)
+            gpg.import_keys(key.key_data)
+            gpgkey = gpg.list_keys(secret=key.private).pop()
+            return self._build_key_from_gpg(
+                gpgkey,
+                gpg.export_keys(gpgkey['fingerprint'], secret=key.private),
+                _list_signatures(gpg, gpgkey['fingerprint'],
+                                 map(_parse_address, gpgkey['uids'])))
+
+    def _deactivate_key_docs(self, key, address, docs):
+        """
+        Stop using other keys than C{key} for C{address}.
+
+        :type key: OpenPGPKey
+        :type address: str
+        :param docs: The key documents active for C{address}.
+        :type docs: list(SoledadDocument)
+        :rtype: Deferred
+        """
+        deferreds = []
+        for doc in docs:
+            if doc.content[KEY_FINGERPRINT_KEY] == key.fingerprint:
+                continue
+            content = doc.content
+            content[KEY_ACTIVE_ADDRESS_KEY] = [
+                active for active in content[KEY_ACTIVE_ADDRESS_KEY]
+                if active != address]
+            doc.content = content
+            deferreds.append(self._soledad.put_doc(doc))
+        return defer.gatherResults(deferreds, consumeErrors=True)
+
     def _get_key_doc(self, address, private=False):
         """
         Get the document with a key (public, by default) bound to C{address}.
@@ -529,48 +1600,101 @@ class OpenPGPScheme(EncryptionScheme):
                  or None if it does not exist.
         :rtype: Deferred
         """
-        def get_key_from_active_doc(activedoc):
-            if len(activedoc) is 0:
+        def get_doc(doclist):
+            if len(doclist) is 0:
                 return None
-            leap_assert(
-                len(activedoc) is 1,
-                'Found more than one key for address %s!' % (address,))
-
-            key_id = activedoc[0].content[KEY_ID_KEY]
-            d = self._soledad.get_from_index(
-                TYPE_ID_PRIVATE_INDEX,
-                self.KEY_TYPE,
-                key_id,
-                '1' if private else '0')
-            d.addCallback(get_doc, key_id)
-            return d
-
-        def get_doc(doclist, key_id):
             leap_assert(
                 len(doclist) is 1,
-                'There is %d keys for id %s!' % (len(doclist), key_id))
+                'Found more than one key for address %s!' % (address,))
             return doclist.pop()
 
         d = self._soledad.get_from_index(
-            TYPE_ADDRESS_PRIVATE_INDEX,
-            self.ACTIVE_TYPE,
+            TYPE_ACTIVE_ADDRESS_PRIVATE_INDEX,
+            self.KEY_TYPE,
             address,
             '1' if private else '0')
-        d.addCallback(get_key_from_active_doc)
+        d.addCallback(get_doc)
+        return d
+
+    def _migrate_active_docs(self):
+        """
+        Move the active key documents stored by previous versions into the
+        key documents they point to.
+
+        Previous versions stored which key is active for each address in a
+        separate document, so getting the key for an address needed two
+        dependent queries.
+
+        :return: A Deferred which fires when all the active key documents
+                 have been migrated.
+        :rtype: Deferred
+        """
+        def migrate(activedocs):
+            deferreds = []
+            for activedoc in activedocs:
+                if activedoc.content.get(KEY_TYPE_KEY) == self.ACTIVE_TYPE:
+                    deferreds.append(self._migrate_active_doc(activedoc))
+            return defer.gatherResults(deferreds, consumeErrors=True)
+
+        def log_error(failure):
+            # the migration will be retried on the next start.
+            logger.error("Could not migrate active key documents: %r"
+                         % (failure,))
+
+        d = self._soledad.get_from_index(
+            TAGS_PRIVATE_INDEX, KEYMANAGER_ACTIVE_TAG, '*')
+        d.addCallback(migrate)
+        d.addErrback(log_error)
+        return d
+
+    def _migrate_active_doc(self, activedoc):
+        """
+        Mark the key that C{activedoc} points to as active for its address
+        and delete C{activedoc}.
+
+        :param activedoc: An active key document of a previous version.
+        :type activedoc: SoledadDocument
+        :rtype: Deferred
+        """
+        address = activedoc.content[KEY_ADDRESS_KEY]
+        private = activedoc.content[KEY_PRIVATE_KEY]
+
+        def activate(docs):
+            deferreds = []
+            for doc in docs:
+                content = doc.content
+                active = content.get(KEY_ACTIVE_ADDRESS_KEY, [])
+                if address in active:
+                    continue
+                content[KEY_ACTIVE_ADDRESS_KEY] = active + [address]
+                doc.content = content
+                deferreds.append(self._soledad.put_doc(doc))
+            return defer.gatherResults(deferreds, consumeErrors=True)
+
+        d = self._soledad.get_from_index(
+            TYPE_ID_PRIVATE_INDEX,
+            self.KEY_TYPE,
+            activedoc.content[KEY_ID_KEY],
+            '1' if private else '0')
+        d.addCallback(activate)
+        d.addCallback(lambda _: self._soledad.delete_doc(activedoc))
         return d
 
-    def _build_key_from_gpg(self, key, key_data):
+    def _build_key_from_gpg(self, key, key_data, signatures):
         """
         Build an OpenPGPKey for C{address} based on C{key} from
         local gpg storage.
 
-        ASCII armored GPG key data has to be queried independently in this
-        wrapper, so we receive it in C{key_data}.
+        ASCII armored GPG key data and signatures have to be queried
+        independently in this wrapper, so we receive them in C{key_data} and
+        C{signatures}.
 
         :param key: Key obtained from GPG storage.
         :type key: dict
         :param key_data: Key data obtained from GPG storage.
         :type key_data: str
+        :param signatures: The key IDs that have signed the key.
+        :type signatures: list(str)
         :return: An instance of the key.
         :rtype: OpenPGPKey
         """
@@ -591,6 +1715,7 @@ class OpenPGPScheme(EncryptionScheme):
             length=int(key['length']),
             expiry_date=expiry_date,
             refreshed_at=datetime.now(),
+            signatures=signatures,
         )
 
     def delete_key(self, key):
@@ -606,20 +1731,7 @@ class OpenPGPScheme(EncryptionScheme):
         :rtype: Deferred
         """
         leap_assert_type(key, OpenPGPKey)
-
-        def delete_docs(activedocs):
-            deferreds = []
-            for doc in activedocs:
-                d = self._soledad.delete_doc(doc)
-                deferreds.append(d)
-            return defer.gatherResults(deferreds)
-
-        def get_key_docs(_):
-            return self._soledad.get_from_index(
-                TYPE_ID_PRIVATE_INDEX,
-                self.KEY_TYPE,
-                key.key_id,
-                '1' if key.private else '0')
+        self._key_cache.invalidate(key.fingerprint)
 
         def delete_key(docs):
             if len(docs) == 0:
@@ -635,15 +1747,23 @@ class OpenPGPScheme(EncryptionScheme):
                     break
             if doc is None:
                 raise errors.KeyNotFound(key)
-            return self._soledad.delete_doc(doc)
+            self._keyring_pool.invalidate(key.fingerprint)
+            self._key_cache.invalidate(key.fingerprint)
+            d = self._soledad.delete_doc(doc)
+            d.addCallback(lambda _: self._get_usage_doc(
+                key.key_id, key.private, key.fingerprint))
+            d.addCallback(delete_usage)
+            return d
+
+        def delete_usage(usagedoc):
+            if usagedoc is not None:
+                return self._soledad.delete_doc(usagedoc)
 
         d = self._soledad.get_from_index(
             TYPE_ID_PRIVATE_INDEX,
-            self.ACTIVE_TYPE,
+            self.KEY_TYPE,
             key.key_id,
             '1' if key.private else '0')
-        d.addCallback(delete_docs)
-        d.addCallback(get_key_docs)
         d.addCallback(delete_key)
         return d
 
@@ -651,20 +1771,85 @@ class OpenPGPScheme(EncryptionScheme):
     # Data encryption, decryption, signing and verifying
     #
 
+    def _from_thread(self, func, *args, **kwargs):
+        """
+        Run C{func} in the scheme's gpg thread pool, so the gpg processes
+        don't block the reactor.
+
+        :param func: The function to run.
+        :type func: callable
+
+        :return: A Deferred which fires with the result of C{func}.
+        :rtype: Deferred
+        """
+        from twisted.internet import reactor
+        if not self._threadpool.started:
+            self._threadpool.start()
+            self._shutdown_trigger = reactor.addSystemEventTrigger(
+                'during', 'shutdown', self._threadpool.stop)
+        return threads.deferToThreadPool(
+            reactor, self._threadpool, func, *args, **kwargs)
+
     def _temporary_gpgwrapper(self, keys=None):
         """
         Return a gpg wrapper that implements the context manager protocol and
         contains C{keys}.
 
+        The keyring is leased from the scheme's keyring pool and given back
+        to it when the context is exited.
+
         :param keys: keys to conform the keyring.
         :type key: list(OpenPGPKey)
 
-        :return: a TempGPGWrapper instance
-        :rtype: TempGPGWrapper
+        :return: a context manager returning a gnupg.GPG instance
+        :rtype: GeneratorContextManager
         """
         # TODO do here checks on key_data
-        return TempGPGWrapper(
-            keys=keys, gpgbinary=self._gpgbinary)
+        if keys is not None and not isinstance(keys, list):
+            keys = [keys]
+        for key in keys or []:
+            leap_assert_type(key, OpenPGPKey)
+        return self._keyring_pool.keyring(keys)
+
+    def _with_files(self, process, path, output):
+        """
+        Run C{process} with the file at C{path} open for reading and a
+        function writing to the file at C{output}.
+
+        The output file is removed if C{process} fails.
+
+        :param process: A function called with the input file and the write
+                        function, returning a Deferred.
+        :type process: callable
+        :param path: The path of the input file.
+        :type path: str
+        :param output: The path of the output file.
+        :type output: str
+
+        :return: A Deferred which fires with the outcome of C{process}, or
+                 which fails with IOError if a file can't be opened.
+        :rtype: Deferred
+        """
+        try:
+            instream = open(path, 'rb')
+        except IOError:
+            return defer.fail()
+        try:
+            outstream = open(output, 'wb')
+        except IOError:
+            instream.close()
+            return defer.fail()
+
+        def close(result):
+            instream.close()
+            outstream.close()
+            if isinstance(result, Failure):
+                os.unlink(output)
+            return result
+
+        d = process(instream, outstream.write)
+        d.addBoth(close)
+        return d
 
     @staticmethod
     def _assert_gpg_result_ok(result):
@@ -689,48 +1874,131 @@ class OpenPGPScheme(EncryptionScheme):
         """
         Encrypt C{data} using public @{pubkey} and sign with C{sign} key.
 
+        If C{pubkey} is a list of keys a single message is encrypted to all
+        of them, with one session key and one gpg run.
+
+        The encryption runs in the scheme's gpg thread pool.
+
         :param data: The data to be encrypted.
         :type data: str
-        :param pubkey: The key used to encrypt.
-        :type pubkey: OpenPGPKey
+        :param pubkey: The key used to encrypt, or list of.
+        :type pubkey: OpenPGPKey or list of OpenPGPKeys
         :param sign: The key used for signing.
         :type sign: OpenPGPKey
         :param cipher_algo: The cipher algorithm to use.
         :type cipher_algo: str
 
-        :return: The encrypted data.
-        :rtype: str
+        :return: A Deferred which fires with the encrypted data as str, or
+                 which fails with EncryptError if failed encrypting for some
+                 reason.
+        :rtype: Deferred
+        """
+        return self._encrypt(data, pubkey, passphrase, sign, cipher_algo)
 
-        :raise EncryptError: Raised if failed encrypting for some reason.
+    def encrypt_stream(self, instream, consumer, pubkey, passphrase=None,
+                       sign=None, cipher_algo='AES256'):
         """
-        leap_assert_type(pubkey, OpenPGPKey)
-        leap_assert(pubkey.private is False, 'Key is not public.')
-        keys = [pubkey]
+        Encrypt the data read from C{instream} like encrypt() does, writing
+        the encrypted data to C{consumer} in chunks.
+
+        The data is fed to gpg and the encrypted data handed to C{consumer}
+        as they flow, so neither is ever held in memory as a whole. If the
+        encryption fails C{consumer} may have been written part of the
+        output.
+
+        :param instream: The data to be encrypted.
+        :type instream: file
+        :param consumer: The consumer of the encrypted data.
+        :type consumer: twisted.internet.interfaces.IConsumer
+        :param pubkey: The key used to encrypt, or list of.
+        :type pubkey: OpenPGPKey or list of OpenPGPKeys
+        :param sign: The key used for signing.
+        :type sign: OpenPGPKey
+        :param cipher_algo: The cipher algorithm to use.
+        :type cipher_algo: str
+
+        :return: A Deferred which fires when all the encrypted data was
+                 written to C{consumer}, or which fails with EncryptError if
+                 failed encrypting for some reason.
+        :rtype: Deferred
+        """
+        return self._encrypt(
+            instream, pubkey, passphrase, sign, cipher_algo,
+            _consumer_writer(consumer))
+
+    def encrypt_file(self, path, output, pubkey, passphrase=None,
+                     sign=None, cipher_algo='AES256'):
+        """
+        Encrypt the file at C{path} like encrypt() does, writing the
+        encrypted data to the file at C{output}.
+
+        The files are read and written in chunks, so neither is ever held in
+        memory as a whole. C{output} is removed if the encryption fails.
+
+        :param path: The path of the file to be encrypted.
+        :type path: str
+        :param output: The path of the file to write the encrypted data to.
+        :type output: str
+        :param pubkey: The key used to encrypt, or list of.
+        :type pubkey: OpenPGPKey or list of OpenPGPKeys
+        :param sign: The key used for signing.
+        :type sign: OpenPGPKey
+        :param cipher_algo: The cipher algorithm to use.
+        :type cipher_algo: str
+
+        :return: A Deferred which fires when the encrypted file was written,
+                 or which fails with EncryptError if failed encrypting for
+                 some reason.
+        :rtype: Deferred
+        """
+        return self._with_files(
+            lambda instream, write: self._encrypt(
+                instream, pubkey, passphrase, sign, cipher_algo, write),
+            path, output)
+
+    def _encrypt(self, data, pubkey, passphrase, sign, cipher_algo,
+                 write=None):
+        pubkeys = pubkey if isinstance(pubkey, list) else [pubkey]
+        leap_assert(pubkeys, 'No keys to encrypt to.')
+        for pubkey in pubkeys:
+            leap_assert_type(pubkey, OpenPGPKey)
+            leap_assert(pubkey.private is False, 'Key is not public.')
+        keys = list(pubkeys)
         if sign is not None:
             leap_assert_type(sign, OpenPGPKey)
             leap_assert(sign.private is True)
             keys.append(sign)
-        with self._temporary_gpgwrapper(keys) as gpg:
-            result = gpg.encrypt(
-                data, pubkey.fingerprint,
-                default_key=sign.key_id if sign else None,
-                passphrase=passphrase, symmetric=False,
-                cipher_algo=cipher_algo)
-            # Here we cannot assert for correctness of sig because the sig is
-            # in the ciphertext.
-            # result.ok    - (bool) indicates if the operation succeeded
-            # result.data  - (bool) contains the result of the operation
-            try:
-                self._assert_gpg_result_ok(result)
-                return result.data
-            except errors.GPGError as e:
-                logger.error('Failed to decrypt: %s.' % str(e))
-                raise errors.EncryptError()
+
+        def encrypt():
+            with self._temporary_gpgwrapper(keys) as gpg:
+                with _streaming_output(gpg, write) as failures:
+                    result = gpg.encrypt(
+                        data, *[key.fingerprint for key in pubkeys],
+                        default_key=sign.key_id if sign else None,
+                        passphrase=passphrase, symmetric=False,
+                        cipher_algo=cipher_algo)
+                if failures:
+                    failures[0].raiseException()
+                # Here we cannot assert for correctness of sig because the
+                # sig is in the ciphertext.
+                # result.ok    - (bool) indicates if the operation succeeded
+                # result.data  - (bool) contains the result of the operation
+                try:
+                    self._assert_gpg_result_ok(result)
+                except errors.GPGError as e:
+                    logger.error('Failed to decrypt: %s.' % str(e))
+                    raise errors.EncryptError()
+                if write is None:
+                    return result.data
+
+        return self._from_thread(encrypt)
 
     def decrypt(self, data, privkey, passphrase=None, verify=None):
         """
         Decrypt C{data} using private @{privkey} and verify with C{verify} key.
 
+        The decryption runs in the scheme's gpg thread pool.
+
         :param data: The data to be decrypted.
         :type data: str
         :param privkey: The key used to decrypt.
@@ -741,34 +2009,118 @@ class OpenPGPScheme(EncryptionScheme):
         :param verify: The key used to verify a signature.
         :type verify: OpenPGPKey
 
-        :return: The decrypted data and if signature verifies
-        :rtype: (unicode, bool)
+        :return: A Deferred which fires with the decrypted data and if
+                 signature verifies (unicode, bool), or which fails with
+                 DecryptError if failed decrypting for some reason.
+        :rtype: Deferred
+        """
+        return self._decrypt(data, privkey, passphrase, verify)
 
-        :raise DecryptError: Raised if failed decrypting for some reason.
+    def decrypt_stream(self, instream, consumer, privkey, passphrase=None,
+                       verify=None):
         """
+        Decrypt the data read from C{instream} like decrypt() does, writing
+        the decrypted data to C{consumer} in chunks.
+
+        The data is fed to gpg and the decrypted data handed to C{consumer}
+        as they flow, so neither is ever held in memory as a whole. Note
+        that the signature can only be checked once all the data was
+        decrypted, and that C{consumer} may have been written part of the
+        output if the decryption fails.
+
+        :param instream: The data to be decrypted.
+        :type instream: file
+        :param consumer: The consumer of the decrypted data.
+        :type consumer: twisted.internet.interfaces.IConsumer
+        :param privkey: The key used to decrypt.
+        :type privkey: OpenPGPKey
+        :param passphrase: The passphrase for the secret key used for
+                           decryption.
+        :type passphrase: str
+        :param verify: The key used to verify a signature.
+        :type verify: OpenPGPKey
+
+        :return: A Deferred which fires with whether the signature verifies
+                 once all the decrypted data was written to C{consumer}, or
+                 which fails with DecryptError if failed decrypting for some
+                 reason.
+        :rtype: Deferred
+        """
+        d = self._decrypt(instream, privkey, passphrase, verify,
+                          _consumer_writer(consumer))
+        d.addCallback(lambda result: result[1])
+        return d
+
+    def decrypt_file(self, path, output, privkey, passphrase=None,
+                     verify=None):
+        """
+        Decrypt the file at C{path} like decrypt() does, writing the
+        decrypted data to the file at C{output}.
+
+        The files are read and written in chunks, so neither is ever held in
+        memory as a whole. C{output} is removed if the decryption fails.
+
+        :param path: The path of the file to be decrypted.
+        :type path: str
+        :param output: The path of the file to write the decrypted data to.
+        :type output: str
+        :param privkey: The key used to decrypt.
+        :type privkey: OpenPGPKey
+        :param passphrase: The passphrase for the secret key used for
+                           decryption.
+        :type passphrase: str
+        :param verify: The key used to verify a signature.
+        :type verify: OpenPGPKey
+
+        :return: A Deferred which fires with whether the signature verifies
+                 once the decrypted file was written, or which fails with
+                 DecryptError if failed decrypting for some reason.
+        :rtype: Deferred
+        """
+        d = self._with_files(
+            lambda instream, write: self._decrypt(
+                instream, privkey, passphrase, verify, write),
+            path, output)
+        d.addCallback(lambda result: result[1])
+        return d
+
+    def _decrypt(self, data, privkey, passphrase, verify, write=None):
         leap_assert(privkey.private is True, 'Key is not private.')
         keys = [privkey]
         if verify is not None:
             leap_assert_type(verify, OpenPGPKey)
             leap_assert(verify.private is False)
             keys.append(verify)
-        with self._temporary_gpgwrapper(keys) as gpg:
-            try:
-                result = gpg.decrypt(
-                    data, passphrase=passphrase, always_trust=True)
-                self._assert_gpg_result_ok(result)
-
-                # verify signature
-                sign_valid = False
-                if (verify is not None and
-                        result.valid is True and
-                        verify.fingerprint == result.pubkey_fingerprint):
-                    sign_valid = True
-
-                return (result.data, sign_valid)
-            except errors.GPGError as e:
-                logger.error('Failed to decrypt: %s.' % str(e))
-                raise errors.DecryptError(str(e))
+
+        def decrypt():
+            with self._temporary_gpgwrapper(keys) as gpg:
+                try:
+                    with _streaming_output(gpg, write) as failures:
+                        if isinstance(data, basestring):
+                            result = gpg.decrypt(
+                                data, passphrase=passphrase,
+                                always_trust=True)
+                        else:
+                            result = gpg.decrypt_file(
+                                data, passphrase=passphrase,
+                                always_trust=True)
+                    if failures:
+                        failures[0].raiseException()
+                    self._assert_gpg_result_ok(result)
+
+                    # verify signature
+                    sign_valid = False
+                    if (verify is not None and
+                            result.valid is True and
+                            verify.fingerprint == result.pubkey_fingerprint):
+                        sign_valid = True
+
+                    return (result.data, sign_valid)
+                except errors.GPGError as e:
+                    logger.error('Failed to decrypt: %s.' % str(e))
+                    raise errors.DecryptError(str(e))
+
+        return self._from_thread(decrypt)
 
     def is_encrypted(self, data):
         """
@@ -780,15 +2132,45 @@ class OpenPGPScheme(EncryptionScheme):
         :return: Whether C{data} was encrypted using this wrapper.
         :rtype: bool
         """
-        with self._temporary_gpgwrapper() as gpg:
-            gpgutil = GPGUtilities(gpg)
-            return gpgutil.is_encrypted_asym(data)
+        return packets.is_encrypted_asym(data)
+
+    def get_recipients(self, data):
+        """
+        Return the IDs of the keys C{data} was encrypted to.
+
+        :param data: The encrypted data.
+        :type data: str
+
+        :return: The key IDs of the recipients.
+        :rtype: list(str)
+
+        :raise InvalidPacket: if C{data} is not valid OpenPGP data.
+        """
+        return packets.get_recipients(data)
+
+    def get_signers(self, data):
+        """
+        Return the IDs of the keys that signed C{data}.
+
+        Signatures of encrypted data can't be seen without decrypting it.
+
+        :param data: The signed data or its detached signature.
+        :type data: str
+
+        :return: The key IDs of the signers.
+        :rtype: list(str)
+
+        :raise InvalidPacket: if C{data} is not valid OpenPGP data.
+        """
+        return packets.get_issuers(data)
 
     def sign(self, data, privkey, digest_algo='SHA512', clearsign=False,
              detach=True, binary=False):
         """
         Sign C{data} with C{privkey}.
 
+        The signature runs in the scheme's gpg thread pool.
+
         :param data: The data to be signed.
         :type data: str
 
@@ -803,36 +2185,86 @@ class OpenPGPScheme(EncryptionScheme):
         :param binary: If True, do not ascii armour the output.
         :type binary: bool
 
-        :return: The ascii-armored signed data.
-        :rtype: str
+        :return: A Deferred which fires with the ascii-armored signed data,
+                 or which fails with SignFailed if there was any error
+                 signing.
+        :rtype: Deferred
         """
+        return self._sign(data, privkey, digest_algo, clearsign, detach,
+                          binary)
+
+    def sign_file(self, path, output, privkey, digest_algo='SHA512',
+                  clearsign=False, detach=True, binary=False):
+        """
+        Sign the file at C{path} like sign() does, writing the signature, or
+        the signed data, to the file at C{output}.
+
+        The files are read and written in chunks, so neither is ever held in
+        memory as a whole. C{output} is removed if the signing fails.
+
+        :param path: The path of the file to be signed.
+        :type path: str
+        :param output: The path of the file to write the signature to.
+        :type output: str
+        :param privkey: The private key to be used to sign.
+        :type privkey: OpenPGPKey
+        :param digest_algo: The hash digest to use.
+        :type digest_algo: str
+        :param clearsign: If True, create a cleartext signature.
+        :type clearsign: bool
+        :param detach: If True, create a detached signature.
+        :type detach: bool
+        :param binary: If True, do not ascii armour the output.
+        :type binary: bool
+
+        :return: A Deferred which fires when the signature was written, or
+                 which fails with SignFailed if there was any error signing.
+        :rtype: Deferred
+        """
+        return self._with_files(
+            lambda instream, write: self._sign(
+                instream, privkey, digest_algo, clearsign, detach, binary,
+                write),
+            path, output)
+
+    def _sign(self, data, privkey, digest_algo, clearsign, detach, binary,
+              write=None):
         leap_assert_type(privkey, OpenPGPKey)
         leap_assert(privkey.private is True)
 
-        # result.fingerprint - contains the fingerprint of the key used to
-        #                      sign.
-        with self._temporary_gpgwrapper(privkey) as gpg:
-            result = gpg.sign(data, default_key=privkey.key_id,
-                              digest_algo=digest_algo, clearsign=clearsign,
-                              detach=detach, binary=binary)
-            rfprint = privkey.fingerprint
-            privkey = gpg.list_keys(secret=True).pop()
-            kfprint = privkey['fingerprint']
-            if result.fingerprint is None:
-                raise errors.SignFailed(
-                    'Failed to sign with key %s: %s' %
-                    (privkey['keyid'], result.stderr))
-            leap_assert(
-                result.fingerprint == kfprint,
-                'Signature and private key fingerprints mismatch: '
-                '%s != %s' % (rfprint, kfprint))
-        return result.data
+        def sign():
+            # result.fingerprint - contains the fingerprint of the key used to
+            #                      sign.
+            with self._temporary_gpgwrapper(privkey) as gpg:
+                with _streaming_output(gpg, write) as failures:
+                    result = gpg.sign(
+                        data, default_key=privkey.key_id,
+                        digest_algo=digest_algo, clearsign=clearsign,
+                        detach=detach, binary=binary)
+                if failures:
+                    failures[0].raiseException()
+                # the keyring holds nothing but privkey, so there's no need
+                # to list it to know which key made the signature.
+                if result.fingerprint is None:
+                    raise errors.SignFailed(
+                        'Failed to sign with key %s: %s' %
+                        (privkey.key_id, result.stderr))
+                leap_assert(
+                    result.fingerprint == privkey.fingerprint,
+                    'Signature and private key fingerprints mismatch: '
+                    '%s != %s' % (result.fingerprint, privkey.fingerprint))
+            if write is None:
+                return result.data
+
+        return self._from_thread(sign)
 
     def verify(self, data, pubkey, detached_sig=None):
         """
         Verify signed C{data} with C{pubkey}, eventually using
         C{detached_sig}.
 
+        The verification runs in the scheme's gpg thread pool.
+
         :param data: The data to be verified.
         :type data: str
         :param pubkey: The public key to be used on verification.
@@ -841,26 +2273,100 @@ class OpenPGPScheme(EncryptionScheme):
                              verified against this detached signature.
         :type detached_sig: str
 
-        :return: signature matches
+        :return: A Deferred which fires with whether the signature matches.
+        :rtype: Deferred
+        """
+        return self._verify(data, pubkey, detached_sig)
+
+    def verify_stream(self, instream, pubkey, detached_sig=None):
+        """
+        Verify the signed data read from C{instream} like verify() does.
+
+        The data is fed to gpg in chunks, so it is never held in memory as a
+        whole.
+
+        :param instream: The data to be verified.
+        :type instream: file
+        :param pubkey: The public key to be used on verification.
+        :type pubkey: OpenPGPKey
+        :param detached_sig: A detached signature. If given, the data is
+                             verified against this detached signature.
+        :type detached_sig: str
+
+        :return: A Deferred which fires with whether the signature matches.
+        :rtype: Deferred
+        """
+        return self._verify(instream, pubkey, detached_sig)
+
+    def _verify(self, data, pubkey, detached_sig):
+        leap_assert_type(pubkey, OpenPGPKey)
+        leap_assert(pubkey.private is False)
+
+        def verify():
+            with self._temporary_gpgwrapper(pubkey) as gpg:
+                if isinstance(data, basestring):
+                    if detached_sig is None:
+                        result = gpg.verify(data)
+                        return self._signed_by(result, pubkey)
+                    # cStringIO reads from data without copying it.
+                    instream = StringIO(data)
+                else:
+                    instream = data
+                if detached_sig is None:
+                    result = gpg.verify_file(instream)
+                else:
+                    # gpg.verify_file() takes the detached sig as the name
+                    # of a file, so hand it the read end of a pipe.
+                    with _pipe_path(detached_sig) as sig_file:
+                        result = gpg.verify_file(instream, sig_file=sig_file)
+                return self._signed_by(result, pubkey)
+
+        return self._from_thread(verify)
+
+    @staticmethod
+    def _signed_by(result, pubkey):
+        """
+        Return whether the gpg verification C{result} is a valid signature
+        made by C{pubkey}.
+
+        :param result: The result of a gpg verification.
+        :type result: gnupg._parsers.Verify
+        :param pubkey: The public key used on verification.
+        :type pubkey: OpenPGPKey
+
         :rtype: bool
         """
+        # the keyring holds nothing but pubkey, so there's no need to list
+        # it to know which key made the signature.
+        return bool(result.valid and result.fingerprint == pubkey.fingerprint)
+
+    def verify_file(self, path, pubkey, detached_sig=None):
+        """
+        Verify the signed file at C{path} like verify() does, eventually
+        using the detached signature in the file at C{detached_sig}.
+
+        The file is fed to gpg in chunks, so it is never held in memory as a
+        whole.
+
+        :param path: The path of the file to be verified.
+        :type path: str
+        :param pubkey: The public key to be used on verification.
+        :type pubkey: OpenPGPKey
+        :param detached_sig: The path of a file with a detached signature.
+                             If given, the file at C{path} is verified
+                             against this detached signature.
+        :type detached_sig: str
+
+        :return: A Deferred which fires with whether the signature matches.
+        :rtype: Deferred
+        """
         leap_assert_type(pubkey, OpenPGPKey)
         leap_assert(pubkey.private is False)
-        with self._temporary_gpgwrapper(pubkey) as gpg:
-            result = None
-            if detached_sig is None:
-                result = gpg.verify(data)
-            else:
-                # to verify using a detached sig we have to use
-                # gpg.verify_file(), which receives the data as a binary
-                # stream and the name of a file containing the signature.
-                sf, sfname = tempfile.mkstemp()
-                with os.fdopen(sf, 'w') as sfd:
-                    sfd.write(detached_sig)
-                result = gpg.verify_file(io.BytesIO(data), sig_file=sfname)
-                os.unlink(sfname)
-            gpgpubkey = gpg.list_keys().pop()
-            valid = result.valid
-            rfprint = result.fingerprint
-            kfprint = gpgpubkey['fingerprint']
-            return valid and rfprint == kfprint
+
+        def verify():
+            with self._temporary_gpgwrapper(pubkey) as gpg:
+                with open(path, 'rb') as instream:
+                    result = gpg.verify_file(instream, sig_file=detached_sig)
+                return self._signed_by(result, pubkey)
+
+        return self._from_thread(verify)
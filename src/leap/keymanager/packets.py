@@ -0,0 +1,686 @@
+# -*- coding: utf-8 -*-
+# packets.py
+# Copyright (C) 2015 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+In-process inspection of OpenPGP packets.
+
+Answers simple questions about OpenPGP data, like whether it is encrypted
+and to which keys, without running gpg. Only the packet headers and the
+fields needed are parsed, nothing is decrypted nor verified.
+
+See RFC 4880, sections 4 and 5.
+"""
+import base64
+import binascii
+import bz2
+import hashlib
+import re
+import struct
+import zlib
+
+from leap.keymanager.errors import InvalidPacket
+
+
+#
+# Packet tags
+#
+
+PUBKEY_ENC_TAG = 1
+SIGNATURE_TAG = 2
+ONE_PASS_SIG_TAG = 4
+SECRET_KEY_TAG = 5
+PUBLIC_KEY_TAG = 6
+SECRET_SUBKEY_TAG = 7
+COMPRESSED_TAG = 8
+TRUST_TAG = 12
+USER_ID_TAG = 13
+PUBLIC_SUBKEY_TAG = 14
+USER_ATTRIBUTE_TAG = 17
+
+# the packets a transferable key is made of
+KEY_TAGS = (
+    SIGNATURE_TAG,
+    SECRET_KEY_TAG,
+    PUBLIC_KEY_TAG,
+    SECRET_SUBKEY_TAG,
+    USER_ID_TAG,
+    PUBLIC_SUBKEY_TAG,
+    USER_ATTRIBUTE_TAG,
+)
+
+# the public counterpart of secret key packets
+PUBLIC_TAGS = {
+    SECRET_KEY_TAG: PUBLIC_KEY_TAG,
+    SECRET_SUBKEY_TAG: PUBLIC_SUBKEY_TAG,
+}
+
+# the number of MPIs in the public key of each supported algorithm: RSA,
+# Elgamal and DSA
+PUBKEY_MPIS = {
+    1: 2,
+    2: 2,
+    3: 2,
+    16: 3,
+    17: 4,
+    20: 3,
+}
+
+# signatures binding a user ID to a key
+CERTIFICATION_TYPES = (0x10, 0x11, 0x12, 0x13)
+
+# signature subpackets
+CREATION_TIME_SUBPACKET = 2
+KEY_EXPIRATION_SUBPACKET = 9
+ISSUER_SUBPACKET = 16
+ISSUER_FINGERPRINT_SUBPACKET = 33
+
+# compression algorithms
+ZIP_ALGO = 1
+ZLIB_ALGO = 2
+BZIP2_ALGO = 3
+
+ARMOR_BEGIN_RE = re.compile(
+    r'^-----BEGIN PGP ([A-Z0-9 ,/]+)-----[ \t]*\r?$', re.MULTILINE)
+ARMOR_END_PREFIX = '-----END PGP '
+ARMOR_LINE_LENGTH = 64
+PUBLIC_KEY_BLOCK = 'PUBLIC KEY BLOCK'
+PRIVATE_KEY_BLOCK = 'PRIVATE KEY BLOCK'
+
+
+#
+# Armor
+#
+
+def dearmor(data):
+    """
+    Return the binary OpenPGP data in C{data}.
+
+    C{data} is returned as is if it is binary already, otherwise the first
+    ASCII armored block found in it is decoded. Cleartext signed messages
+    are skipped until their signature block.
+
+    :param data: Binary or ASCII armored OpenPGP data.
+    :type data: str
+
+    :return: The binary OpenPGP data.
+    :rtype: str
+
+    :raise InvalidPacket: if C{data} holds no OpenPGP data.
+    """
+    if data and ord(data[0]) & 0x80:
+        return data
+    for match in ARMOR_BEGIN_RE.finditer(data):
+        if match.group(1) != 'SIGNED MESSAGE':
+            return _decode_armor(data, match.end())
+    raise InvalidPacket('No OpenPGP data found')
+
+
+def dearmor_all(data):
+    """
+    Return the binary OpenPGP data of every ASCII armored block in C{data},
+    or C{data} itself if it is binary already.
+
+    :param data: Binary or ASCII armored OpenPGP data.
+    :type data: str
+
+    :rtype: list(str)
+
+    :raise InvalidPacket: if C{data} holds no OpenPGP data.
+    """
+    if data and ord(data[0]) & 0x80:
+        return [data]
+    blocks = [_decode_armor(data, match.end())
+              for match in ARMOR_BEGIN_RE.finditer(data)
+              if match.group(1) != 'SIGNED MESSAGE']
+    if not blocks:
+        raise InvalidPacket('No OpenPGP data found')
+    return blocks
+
+
+def _decode_armor(data, start):
+    lines = iter(data[start:].splitlines())
+    next(lines, None)  # the end of the BEGIN line
+    # skip the armor headers, which end with an empty line
+    for line in lines:
+        if not line.strip():
+            break
+    body = []
+    for line in lines:
+        line = line.strip()
+        if line.startswith('=') or line.startswith(ARMOR_END_PREFIX):
+            break
+        body.append(line)
+    try:
+        return binascii.a2b_base64(''.join(body))
+    except binascii.Error as e:
+        raise InvalidPacket('Invalid armor: %s' % (e,))
+
+
+def armor(data, block_type):
+    """
+    Return the ASCII armored form of the binary OpenPGP C{data}.
+
+    :param data: Binary OpenPGP data.
+    :type data: str
+    :param block_type: The type of armor block, e.g. PUBLIC_KEY_BLOCK.
+    :type block_type: str
+
+    :rtype: str
+    """
+    encoded = base64.b64encode(data)
+    lines = ['-----BEGIN PGP %s-----' % (block_type,), '']
+    for pos in range(0, len(encoded), ARMOR_LINE_LENGTH):
+        lines.append(encoded[pos:pos + ARMOR_LINE_LENGTH])
+    lines.append('=' + base64.b64encode(struct.pack('>I', _crc24(data))[1:]))
+    lines.append('-----END PGP %s-----' % (block_type,))
+    return '\n'.join(lines) + '\n'
+
+
+def _make_crc24_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864cfb
+        table.append(crc & 0xffffff)
+    return table
+
+
+CRC24_TABLE = _make_crc24_table()
+
+
+def _crc24(data):
+    crc = 0xb704ce
+    for char in data:
+        crc = ((crc << 8) & 0xffffff) ^ CRC24_TABLE[(crc >> 16) ^ ord(char)]
+    return crc
+
+
+#
+# Packets
+#
+
+def iter_packets(data, tags=()):
+    """
+    Iterate over the packets in the binary OpenPGP C{data}.
+
+    Only the bodies of the packets with a tag in C{tags} are extracted, so
+    walking past large data packets doesn't copy them.
+
+    :param data: Binary OpenPGP data.
+    :type data: str
+    :param tags: Tags of the packets whose body is wanted.
+    :type tags: tuple(int)
+
+    :return: An iterator over the tag of each packet and its body, or None
+             if its tag is not in C{tags}.
+    :rtype: iterator(tuple(int, str))
+
+    :raise InvalidPacket: if a malformed packet is found.
+    """
+    for tag, _, chunks in _iter_packet_headers(data):
+        body = None
+        if tag in tags:
+            body = ''.join(data[s:e] for s, e in chunks)
+        yield tag, body
+
+
+def _iter_packet_headers(data):
+    # the tag, start and body chunks of each packet
+    pos = 0
+    end = len(data)
+    while pos < end:
+        start = pos
+        ctb = ord(data[pos])
+        pos += 1
+        if not ctb & 0x80:
+            raise InvalidPacket('Invalid packet header at %d' % (start,))
+        if ctb & 0x40:
+            tag = ctb & 0x3f
+            chunks, pos = _new_format_body(data, pos)
+        else:
+            tag = (ctb >> 2) & 0x0f
+            chunks, pos = _old_format_body(data, pos, ctb & 0x03)
+        yield tag, start, chunks
+
+
+def _old_format_body(data, pos, length_type):
+    if length_type == 3:
+        # indeterminate length, up to the end of the data
+        return [(pos, len(data))], len(data)
+    fmt = ('>B', '>H', '>I')[length_type]
+    length = _unpack(fmt, data, pos)
+    pos += struct.calcsize(fmt)
+    return [_chunk(data, pos, length)], pos + length
+
+
+def _new_format_body(data, pos):
+    chunks = []
+    while True:
+        first = _unpack('>B', data, pos)
+        if first < 192:
+            length, pos = first, pos + 1
+        elif first < 224:
+            second = _unpack('>B', data, pos + 1)
+            length, pos = ((first - 192) << 8) + second + 192, pos + 2
+        elif first == 255:
+            length, pos = _unpack('>I', data, pos + 1), pos + 5
+        else:
+            # partial body length, more chunks follow
+            length = 1 << (first & 0x1f)
+            chunks.append(_chunk(data, pos + 1, length))
+            pos += 1 + length
+            continue
+        chunks.append(_chunk(data, pos, length))
+        return chunks, pos + length
+
+
+def _chunk(data, pos, length):
+    if pos + length > len(data):
+        raise InvalidPacket('Truncated packet at %d' % (pos,))
+    return pos, pos + length
+
+
+def _unpack(fmt, data, pos):
+    try:
+        return struct.unpack_from(fmt, data, pos)[0]
+    except struct.error:
+        raise InvalidPacket('Truncated packet at %d' % (pos,))
+
+
+def _key_id(data):
+    return binascii.hexlify(data).upper()
+
+
+def _encode_packet(tag, body):
+    length = len(body)
+    if length < 192:
+        header = chr(length)
+    elif length < 8384:
+        length -= 192
+        header = chr((length >> 8) + 192) + chr(length & 0xff)
+    else:
+        header = '\xff' + struct.pack('>I', length)
+    return chr(0xc0 | tag) + header + body
+
+
+#
+# Questions about OpenPGP data
+#
+
+def is_encrypted_asym(data):
+    """
+    Return whether C{data} is encrypted to some public key.
+
+    :param data: Binary or ASCII armored OpenPGP data.
+    :type data: str
+
+    :rtype: bool
+    """
+    try:
+        for tag, _ in iter_packets(dearmor(data)):
+            if tag == PUBKEY_ENC_TAG:
+                return True
+    except InvalidPacket:
+        pass
+    return False
+
+
+def get_recipients(data):
+    """
+    Return the IDs of the keys C{data} is encrypted to.
+
+    Messages encrypted to hidden recipients have a key ID made of zeros.
+
+    :param data: Binary or ASCII armored OpenPGP data.
+    :type data: str
+
+    :return: The key IDs of the recipients.
+    :rtype: list(str)
+
+    :raise InvalidPacket: if C{data} is not valid OpenPGP data.
+    """
+    recipients = []
+    for tag, body in iter_packets(dearmor(data), tags=(PUBKEY_ENC_TAG,)):
+        if tag == PUBKEY_ENC_TAG:
+            if len(body) < 9:
+                raise InvalidPacket('Truncated public key encrypted packet')
+            recipients.append(_key_id(body[1:9]))
+    return recipients
+
+
+def get_issuers(data):
+    """
+    Return the IDs of the keys that signed C{data}.
+
+    Signatures inside compressed data are found as well, but the ones
+    inside encrypted data can't be seen without decrypting it.
+
+    :param data: Binary or ASCII armored OpenPGP data.
+    :type data: str
+
+    :return: The key IDs of the signers.
+    :rtype: list(str)
+
+    :raise InvalidPacket: if C{data} is not valid OpenPGP data.
+    """
+    issuers = []
+    _find_issuers(dearmor(data), issuers)
+    return issuers
+
+
+def _find_issuers(data, issuers):
+    tags = (SIGNATURE_TAG, ONE_PASS_SIG_TAG, COMPRESSED_TAG)
+    for tag, body in iter_packets(data, tags=tags):
+        if tag == COMPRESSED_TAG:
+            _find_issuers(_decompress(body), issuers)
+            continue
+        if tag == SIGNATURE_TAG:
+            key_id = _parse_signature(body)[1]
+        elif tag == ONE_PASS_SIG_TAG:
+            if len(body) < 12:
+                raise InvalidPacket('Truncated one-pass signature packet')
+            key_id = _key_id(body[4:12])
+        else:
+            continue
+        # a one-pass signature is followed by its signature
+        if key_id is not None and key_id not in issuers:
+            issuers.append(key_id)
+
+
+def _decompress(body):
+    algo = ord(body[0]) if body else None
+    try:
+        if algo == 0:
+            return body[1:]
+        if algo == ZIP_ALGO:
+            return zlib.decompress(body[1:], -zlib.MAX_WBITS)
+        if algo == ZLIB_ALGO:
+            return zlib.decompress(body[1:])
+        if algo == BZIP2_ALGO:
+            return bz2.decompress(body[1:])
+    except (zlib.error, IOError) as e:
+        raise InvalidPacket('Invalid compressed packet: %s' % (e,))
+    raise InvalidPacket('Unknown compression algorithm %r' % (algo,))
+
+
+def _parse_signature(body):
+    """
+    Return the type, issuer key ID, creation time and key expiration time
+    of a signature packet.
+
+    The expiration time is only taken from the hashed subpackets, as the
+    unhashed ones are not protected by the signature. Fields that can't be
+    found are None.
+    """
+    version = ord(body[0]) if body else None
+    if version in (2, 3):
+        if len(body) < 15:
+            raise InvalidPacket('Truncated signature packet')
+        created = struct.unpack_from('>I', body, 3)[0]
+        return ord(body[2]), _key_id(body[7:15]), created, None
+    if version != 4:
+        # the fields of unknown signature versions can't be found
+        return None, None, None, None
+    if len(body) < 4:
+        raise InvalidPacket('Truncated signature packet')
+    sig_type = ord(body[1])
+    issuer = created = key_expires = None
+    pos = 4
+    for hashed in (True, False):
+        length = _unpack('>H', body, pos)
+        pos += 2
+        for subtype, value in _iter_subpackets(body, pos, pos + length):
+            if subtype == ISSUER_SUBPACKET and len(value) == 8:
+                issuer = issuer or _key_id(value)
+            elif (subtype == ISSUER_FINGERPRINT_SUBPACKET and
+                    len(value) == 21):
+                # version 4 fingerprint, the key ID is its last 8 octets
+                issuer = issuer or _key_id(value[-8:])
+            elif not hashed or len(value) != 4:
+                continue
+            elif subtype == CREATION_TIME_SUBPACKET:
+                created = struct.unpack('>I', value)[0]
+            elif subtype == KEY_EXPIRATION_SUBPACKET:
+                key_expires = struct.unpack('>I', value)[0]
+        pos += length
+    return sig_type, issuer, created, key_expires
+
+
+def _iter_subpackets(body, pos, end):
+    if end > len(body):
+        raise InvalidPacket('Truncated signature packet')
+    while pos < end:
+        first = _unpack('>B', body, pos)
+        if first < 192:
+            length, pos = first, pos + 1
+        elif first < 255:
+            second = _unpack('>B', body, pos + 1)
+            length, pos = ((first - 192) << 8) + second + 192, pos + 2
+        else:
+            length, pos = _unpack('>I', body, pos + 1), pos + 5
+        if length == 0 or pos + length > end:
+            raise InvalidPacket('Invalid signature subpacket')
+        yield ord(body[pos]) & 0x7f, body[pos + 1:pos + length]
+        pos += length
+
+
+#
+# Keys
+#
+
+class ParsedKey(object):
+    """
+    An OpenPGP key parsed from its packets.
+
+    Signatures are not verified, so the expiration date is taken from the
+    latest self-signature as is.
+    """
+
+    def __init__(self, key_id, fingerprint, uids, length, expires,
+                 uid_signatures, packets, secret):
+        """
+        :param key_id: The ID of the primary key.
+        :type key_id: str
+        :param fingerprint: The fingerprint of the primary key.
+        :type fingerprint: str
+        :param uids: The user IDs of the key.
+        :type uids: list(str)
+        :param length: The length in bits of the primary key.
+        :type length: int
+        :param expires: When the key expires as a unix timestamp, or None.
+        :type expires: int
+        :param uid_signatures: Each user ID with the key IDs that have
+                               certified it, in order.
+        :type uid_signatures: list(tuple(str, list(str)))
+        :param packets: The tag, body and length of the public part of the
+                        body, for key packets, of each packet of the key.
+        :type packets: list(tuple(int, str, int))
+        :param secret: Whether the secret key is present.
+        :type secret: bool
+        """
+        self.key_id = key_id
+        self.fingerprint = fingerprint
+        self.uids = uids
+        self.length = length
+        self.expires = expires
+        self.uid_signatures = uid_signatures
+        self.secret = secret
+        self._packets = packets
+
+    def export(self, secret=False):
+        """
+        Return the ASCII armored key.
+
+        :param secret: Export the secret key instead of the public one.
+        :type secret: bool
+
+        :rtype: str
+        """
+        encoded = []
+        for tag, body, public_length in self._packets:
+            if not secret and tag in PUBLIC_TAGS:
+                tag, body = PUBLIC_TAGS[tag], body[:public_length]
+            encoded.append(_encode_packet(tag, body))
+        block_type = PRIVATE_KEY_BLOCK if secret else PUBLIC_KEY_BLOCK
+        return armor(''.join(encoded), block_type)
+
+
+def parse_key(data):
+    """
+    Parse the single OpenPGP key, public or secret, in C{data}.
+
+    Only version 4 RSA, DSA and Elgamal keys are supported.
+
+    :param data: Binary or ASCII armored OpenPGP key.
+    :type data: str
+
+    :rtype: ParsedKey
+
+    :raise InvalidPacket: if C{data} doesn't hold a single key this parser
+                          supports.
+    """
+    key_id = fingerprint = length = created = None
+    uids = []
+    # the issuers of the certifications of each user ID.
+    uid_signatures = []
+    self_sigs = []
+    packets = []
+    on_uid = False
+    for tag, body in iter_packets(dearmor(data), tags=KEY_TAGS):
+        if tag == TRUST_TAG:
+            continue
+        if tag not in KEY_TAGS:
+            raise InvalidPacket('Unexpected packet in key: %d' % (tag,))
+        public_length = None
+        if tag in (SECRET_KEY_TAG, PUBLIC_KEY_TAG):
+            if key_id is not None:
+                raise InvalidPacket('More than one key found')
+            created, length, public_length = _parse_key_packet(body)
+            fingerprint = hashlib.sha1(
+                '\x99' + struct.pack('>H', public_length) +
+                body[:public_length]).hexdigest().upper()
+            key_id = fingerprint[-16:]
+        elif key_id is None:
+            raise InvalidPacket('No key found')
+        elif tag in (SECRET_SUBKEY_TAG, PUBLIC_SUBKEY_TAG):
+            _, _, public_length = _parse_key_packet(body)
+            on_uid = False
+        elif tag in (USER_ID_TAG, USER_ATTRIBUTE_TAG):
+            if tag == USER_ID_TAG:
+                uids.append(body)
+                uid_signatures.append((body, set()))
+            on_uid = tag == USER_ID_TAG
+        elif on_uid:
+            # like gpg, only list the certifications of user IDs, not
+            # revocations nor the signatures of attributes and subkeys
+            sig_type, issuer, sig_created, key_expires = \
+                _parse_signature(body)
+            if sig_type in CERTIFICATION_TYPES:
+                if issuer is not None:
+                    uid_signatures[-1][1].add(issuer)
+                if issuer == key_id and sig_created is not None:
+                    self_sigs.append((sig_created, key_expires))
+        packets.append((tag, body, public_length))
+    if key_id is None:
+        raise InvalidPacket('No key found')
+
+    expires = None
+    if self_sigs:
+        _, key_expires = max(self_sigs)
+        if key_expires:
+            expires = created + key_expires
+    secret = packets[0][0] == SECRET_KEY_TAG
+    uid_signatures = [(uid, sorted(sigs)) for uid, sigs in uid_signatures]
+    return ParsedKey(key_id, fingerprint, uids, length, expires,
+                     uid_signatures, packets, secret)
+
+
+def split_keys(data):
+    """
+    Split the keyring in C{data} into the keys it holds.
+
+    :param data: A binary keyring, or ASCII armored keys in one or more
+                 armor blocks.
+    :type data: str
+
+    :return: The binary data of each key, in order.
+    :rtype: list(str)
+
+    :raise InvalidPacket: if C{data} holds malformed packets or packets
+                          that don't belong to a key.
+    """
+    keys = []
+    for block in dearmor_all(data):
+        start = None
+        for tag, pos, _ in _iter_packet_headers(block):
+            if tag in (SECRET_KEY_TAG, PUBLIC_KEY_TAG):
+                if start is not None:
+                    keys.append(block[start:pos])
+                start = pos
+            elif start is None:
+                raise InvalidPacket('No key found')
+        if start is not None:
+            keys.append(block[start:])
+    return keys
+
+
+def key_digests(data):
+    """
+    Return the digests of the packets of the key in C{data}.
+
+    Keys with the same digests hold the same material, whatever their
+    armor. Trust packets are left out, they are local to a keyring.
+
+    :param data: Binary or ASCII armored OpenPGP key.
+    :type data: str
+
+    :rtype: set(str)
+
+    :raise InvalidPacket: if C{data} holds no valid OpenPGP data.
+    """
+    return set(
+        hashlib.sha256(chr(tag) + body).digest()
+        for tag, body in iter_packets(dearmor(data), KEY_TAGS)
+        if body is not None)
+
+
+def _parse_key_packet(body):
+    """
+    Return the creation time, the length in bits and the length of the
+    public part of the body of a key packet.
+    """
+    version = ord(body[0]) if body else None
+    if version != 4:
+        raise InvalidPacket('Unsupported key version: %r' % (version,))
+    if len(body) < 6:
+        raise InvalidPacket('Truncated key packet')
+    created = struct.unpack_from('>I', body, 1)[0]
+    algo = ord(body[5])
+    if algo not in PUBKEY_MPIS:
+        raise InvalidPacket('Unsupported key algorithm: %d' % (algo,))
+    pos = 6
+    length = None
+    for _ in range(PUBKEY_MPIS[algo]):
+        bits = _unpack('>H', body, pos)
+        if length is None:
+            length = bits
+        pos += 2 + (bits + 7) // 8
+    if pos > len(body):
+        raise InvalidPacket('Truncated key packet')
+    return created, length, pos
@@ -76,8 +76,10 @@ class KeyManagerWithSoledadTestCase(unittest.TestCase, BaseLeapTest):
         return d
 
     def _key_manager(self, user=ADDRESS, url='', token=None):
-        return KeyManager(user, url, self._soledad, token=token,
-                          gpgbinary=self.gpg_binary_path)
+        km = KeyManager(user, url, self._soledad, token=token,
+                        gpgbinary=self.gpg_binary_path)
+        self.addCleanup(km.close)
+        return km
 
     def _find_gpg(self):
         gpg_path = distutils.spawn.find_executable('gpg')
@@ -308,3 +310,29 @@ THx7N776fcYHGumbqUMYrxrcZSbNveE6SaK8fphRam1dewM0
 =a5gs
 -----END PGP PRIVATE KEY BLOCK-----
 """
+
+# key 862EBB01: public key "multi <multi@leap.se>", whose second user ID
+# "other <other@leap.se>" is signed by key 7FEE575A
+PUBLIC_KEY_MULTI_UID = """
+-----BEGIN PGP PUBLIC KEY BLOCK-----
+
+mI0EatKnVAEEAMbDOZYumVeuF5KJffvGM6DY4K/zopk0vFI3kBwKmTM5YshF6TbL
+kCjep31RWP7ODc7aEEazjebScbs8jOPq7Ime6MPXd5JFLKl/XEQPOE7klvbWK5KC
+9ehoodo8rz93nkzKWccIwwqaPNIaPDLRpyOHRswUQgXUfzSTccWq3WxjABEBAAG0
+FW11bHRpIDxtdWx0aUBsZWFwLnNlPojRBBMBCgA7AhsBBQsJCAcCBhUKCQgLAgQW
+AgMBAh4BAheAFiEEolYkckgoxvqahkWqnTln34YuuwEFAmrSp1kCGQEACgkQnTln
+34YuuwFu+QP9HPjvKzCWD2Q9AVyLnvbnqUM1xV8yCkJqdEuAWCdveAagKlwT+90v
+P1tzy59eBabe2KcZEIorYmZzEPfhvDmuTtup/etfcNt9GcQYSqtNEzSVaUCugkeR
+rZy2a/xfr156wSbHFVTHuMjw5fFVmPEn2uWM225RWu2t/9rba4RyAtm0FW90aGVy
+IDxvdGhlckBsZWFwLnNlPojOBBMBCgA4FiEEolYkckgoxvqahkWqnTln34YuuwEF
+AmrSp1QCGwEFCwkIBwIGFQoJCAsCBBYCAwECHgECF4AACgkQnTln34YuuwESkAQA
+l/DRsmUtfBlmRE7YulOaqKU7o59CThIfgoD6CT6vMzsvWw2XPK3thENMpNg3pPEp
+sWs23cxs5RYcO1KB4oM3Lq5uxA5NVIuzMzoOM3tDwKh5MhbkJaz7gNIHsyw1zkkU
+ijCHzyl2YgHsqUTSnQEpFHnnIGa0bEJAyUVerkJ/WROIswQQAQoAHRYhBPbitXKt
+uE6li9LppX+d+mh/7ldaBQJq0qdUAAoJEH+d+mh/7lda2t4EAKsvUgaNcVnTDNfQ
+dYtdpRb+kX9xHFEpZMwN1cJu3bsExKnGcIzZLzzDucVWTW+SCL/ttUTjJp8nl7eP
+7qD5wGeCMkMWcIg15yT89FYCJ8NzqV9cQlltUjXc862f/lHG+h7IL20MrgD6++fS
+7OAElZONp65Iod8SPpwjtkvW7nIK
+=j9sl
+-----END PGP PUBLIC KEY BLOCK-----
+"""
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# test_cache.py
+# Copyright (C) 2015 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the lookup and key caches.
+"""
+
+
+from twisted.trial import unittest
+
+from leap.keymanager.cache import (
+    KeyCache,
+    LookupCache,
+    ERROR,
+    FOUND,
+    NOT_FOUND,
+)
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class LookupCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = LookupCache(
+            max_entries=2, found_ttl=30, not_found_ttl=20, error_ttl=10,
+            clock=self.clock)
+
+    def test_outcomes_expire_after_their_ttl(self):
+        error = Exception()
+        self.cache.add('found', FOUND)
+        self.cache.add('not_found', NOT_FOUND, error)
+        self.assertEqual((FOUND, None), self.cache.get('found'))
+        self.assertEqual((NOT_FOUND, error), self.cache.get('not_found'))
+        self.clock.now = 20
+        self.assertEqual((FOUND, None), self.cache.get('found'))
+        self.assertIsNone(self.cache.get('not_found'))
+        self.cache.add('error', ERROR, error)
+        self.clock.now = 30
+        self.assertIsNone(self.cache.get('found'))
+        self.assertIsNone(self.cache.get('error'))
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.add('a', FOUND)
+        self.cache.add('b', FOUND)
+        self.cache.get('a')
+        self.cache.add('c', FOUND)
+        self.assertEqual(2, len(self.cache))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('c'))
+
+    def test_invalidate(self):
+        self.cache.add('a', FOUND)
+        self.cache.invalidate('a')
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_stats(self):
+        self.cache.add('a', FOUND)
+        self.cache.get('a')
+        self.cache.get('b')
+        self.assertEqual(
+            {'hits': 1, 'misses': 1, 'entries': 1}, self.cache.stats())
+
+
+class Key(object):
+
+    def __init__(self, fingerprint, size, private=False):
+        self.fingerprint = fingerprint
+        self.key_data = 'x' * size
+        self.private = private
+
+
+class KeyCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = KeyCache(max_size=10)
+
+    def test_get_returns_a_copy(self):
+        key = Key('F1', 4)
+        self.cache.put('a', key)
+        cached = self.cache.get('a', False)
+        self.assertEqual('F1', cached.fingerprint)
+        self.assertIsNot(key, cached)
+        self.assertIsNone(self.cache.get('a', True))
+
+    def test_peek_is_not_counted(self):
+        key = Key('F1', 4)
+        self.cache.put('a', key)
+        peeked = self.cache.peek('a', False)
+        self.assertEqual('F1', peeked.fingerprint)
+        self.assertIsNot(key, peeked)
+        self.assertIsNone(self.cache.peek('b', False))
+        self.assertEqual(0, self.cache.hits)
+        self.assertEqual(0, self.cache.misses)
+
+    def test_size_is_bounded(self):
+        self.cache.put('a', Key('F1', 4))
+        self.cache.put('b', Key('F2', 4))
+        self.cache.get('a', False)
+        self.cache.put('c', Key('F3', 4))
+        self.assertIsNone(self.cache.get('b', False))
+        self.assertIsNotNone(self.cache.get('a', False))
+        self.cache.put('d', Key('F4', 11))
+        self.assertIsNone(self.cache.get('d', False))
+        self.assertEqual(8, self.cache.stats()['size'])
+
+    def test_invalidate(self):
+        self.cache.put('a', Key('F1', 4))
+        self.cache.put('b', Key('F1', 4, private=True))
+        self.cache.invalidate('F1')
+        self.assertEqual(0, len(self.cache))
+
+    def test_stale_reads_are_not_cached(self):
+        generation = self.cache.generation
+        self.cache.invalidate_address('a', False)
+        self.cache.put('a', Key('F1', 4), generation=generation)
+        self.assertIsNone(self.cache.get('a', False))
+        self.cache.put('a', Key('F1', 4), generation=self.cache.generation)
+        self.assertIsNotNone(self.cache.get('a', False))
+
+    def test_stats(self):
+        self.cache.put('a', Key('F1', 4))
+        self.cache.get('a', False)
+        self.cache.get('b', False)
+        self.assertEqual(
+            {'hits': 1, 'misses': 1, 'hit_ratio': 0.5, 'entries': 1,
+             'size': 4},
+            self.cache.stats())
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# test_http.py
+# Copyright (C) 2015 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the non-blocking HTTP client.
+"""
+
+
+from twisted.internet import reactor
+from twisted.internet.defer import gatherResults, inlineCallbacks
+from twisted.trial import unittest
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+
+from leap.keymanager.http import HTTPClient, HTTPError, TimeoutError
+
+
+class KeyResource(Resource):
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        if request.args.get('address') == ['user@leap.se']:
+            return '{"openpgp": "key"}'
+        request.setResponseCode(404)
+        return 'not found'
+
+    def render_PUT(self, request):
+        request.setResponseCode(204)
+        return ''
+
+
+class SlowResource(Resource):
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        return NOT_DONE_YET
+
+
+class HTTPClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        root = Resource()
+        root.putChild('key', KeyResource())
+        root.putChild('slow', SlowResource())
+        self.port = reactor.listenTCP(0, Site(root), interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+        self.client = HTTPClient(timeout=1)
+        self.addCleanup(self.client.close)
+
+    def _uri(self, path):
+        return 'http://127.0.0.1:%d/%s' % (self.port.getHost().port, path)
+
+    @inlineCallbacks
+    def test_get_sends_form_data(self):
+        res = yield self.client.get(
+            self._uri('key'), data={'address': 'user@leap.se'})
+        self.assertTrue(res.ok)
+        self.assertEqual({'openpgp': 'key'}, res.json())
+
+    @inlineCallbacks
+    def test_error_status(self):
+        res = yield self.client.get(
+            self._uri('key'), data={'address': 'other@leap.se'})
+        self.assertFalse(res.ok)
+        self.assertEqual(404, res.status_code)
+        self.assertRaises(HTTPError, res.raise_for_status)
+
+    @inlineCallbacks
+    def test_put(self):
+        res = yield self.client.put(self._uri('key'), data='data')
+        self.assertEqual(204, res.status_code)
+
+    @inlineCallbacks
+    def test_connections_per_host(self):
+        client = HTTPClient(connections_per_host=1)
+        self.addCleanup(client.close)
+        uri = self._uri('key')
+        yield gatherResults([client.get(uri) for _ in range(3)])
+        host = '127.0.0.1:%d' % (self.port.getHost().port,)
+        stats = client.stats()[host]
+        self.assertEqual(3, stats['requests'])
+        self.assertEqual(1, stats['connections'])
+        self.assertEqual(0, stats['active'])
+        self.assertEqual(0, stats['waiting'])
+
+    def test_timeout(self):
+        d = self.client.get(self._uri('slow'))
+        return self.assertFailure(d, TimeoutError)
@@ -21,9 +21,13 @@ Tests for the Key Manager.
 """
 
 
+import io
+import os
+
 from datetime import datetime
 from mock import Mock
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import (
+    fail, gatherResults, inlineCallbacks, succeed)
 from twisted.trial import unittest
 
 from leap.keymanager import (
@@ -31,10 +35,13 @@ from leap.keymanager import (
     KeyAddressMismatch,
     errors
 )
+from leap.keymanager.http import HTTPError
 from leap.keymanager.openpgp import OpenPGPKey
 from leap.keymanager.keys import (
     is_address,
     build_key_from_dict,
+    TYPE_ACTIVE_ADDRESS_PRIVATE_INDEX,
+    TYPE_ID_PRIVATE_INDEX,
 )
 from leap.keymanager.validation import ValidationLevels
 from leap.keymanager.tests import (
@@ -82,6 +89,7 @@ class KeyManagerUtilTestCase(unittest.TestCase):
             'validation': str(ValidationLevels.Weak_Chain),
             'encr_used': False,
             'sign_used': True,
+            'signatures': [KEY_FINGERPRINT[-16:]],
         }
         key = build_key_from_dict(OpenPGPKey, kdict)
         self.assertEqual(
@@ -120,6 +128,9 @@ class KeyManagerUtilTestCase(unittest.TestCase):
         self.assertEqual(
             kdict['sign_used'], key.sign_used,
             'Wrong data in key.')
+        self.assertEqual(
+            kdict['signatures'], key.signatures,
+            'Wrong data in key.')
 
 
 class KeyManagerKeyManagementTestCase(KeyManagerWithSoledadTestCase):
@@ -178,7 +189,7 @@ class KeyManagerKeyManagementTestCase(KeyManagerWithSoledadTestCase):
         token = "mytoken"
         km = self._key_manager(token=token)
         yield km._wrapper_map[OpenPGPKey].put_ascii_key(PUBLIC_KEY, ADDRESS)
-        km._fetcher.put = Mock()
+        km._fetcher.put = Mock(return_value=succeed(Mock(ok=True)))
         # the following data will be used on the send
         km.ca_cert_path = 'capath'
         km.session_id = 'sessionid'
@@ -238,6 +249,138 @@ class KeyManagerKeyManagementTestCase(KeyManagerWithSoledadTestCase):
         self.assertTrue(ADDRESS_OTHER in key.address)
         self.assertEqual(key.validation, ValidationLevels.Weak_Chain)
 
+    @inlineCallbacks
+    def test_concurrent_get_key_fetches_once(self):
+        """
+        Test that concurrent lookups for the same key share one fetch.
+        """
+        km = self._key_manager(url=NICKSERVER_URI)
+
+        class Response(object):
+            status_code = 200
+
+            def json(self):
+                return {'address': ADDRESS_2, 'openpgp': PUBLIC_KEY_2}
+
+            def raise_for_status(self):
+                pass
+
+        km._fetcher.get = Mock(return_value=succeed(Response()))
+        km.ca_cert_path = 'cacertpath'
+        km.put_raw_key = Mock(wraps=km.put_raw_key)
+        keys = yield gatherResults(
+            [km.get_key(ADDRESS_2, OpenPGPKey) for _ in range(3)])
+        self.assertEqual(1, km._fetcher.get.call_count)
+        self.assertEqual(1, km.put_raw_key.call_count)
+        self.assertEqual(1, len(set(k.fingerprint for k in keys)))
+        self.assertEqual(3, len(set(id(k) for k in keys)))
+
+    @inlineCallbacks
+    def test_key_not_found_on_server_is_cached(self):
+        """
+        Test that a key the server doesn't have is not fetched again right
+        away.
+        """
+        km = self._key_manager(url=NICKSERVER_URI)
+
+        class Response(object):
+            uri = NICKSERVER_URI
+            status_code = 404
+            content = ''
+
+            def raise_for_status(self):
+                raise HTTPError(self)
+
+        km._fetcher.get = Mock(return_value=succeed(Response()))
+        km.ca_cert_path = 'cacertpath'
+        for _ in range(2):
+            d = km.get_key(ADDRESS_2, OpenPGPKey)
+            yield self.assertFailure(d, KeyNotFound)
+        self.assertEqual(1, km._fetcher.get.call_count)
+        self.assertEqual(1, km.get_lookup_cache_stats()['hits'])
+
+    @inlineCallbacks
+    def test_key_not_stored_is_not_cached(self):
+        """
+        Test that failing to store a key fetched from the server doesn't
+        keep it from being fetched again.
+        """
+        km = self._key_manager(url=NICKSERVER_URI)
+
+        class Response(object):
+            status_code = 200
+
+            def json(self):
+                return {'address': ADDRESS_2, 'openpgp': PUBLIC_KEY_2}
+
+            def raise_for_status(self):
+                pass
+
+        km._fetcher.get = Mock(return_value=succeed(Response()))
+        km.ca_cert_path = 'cacertpath'
+        km.put_raw_key = Mock(
+            return_value=fail(errors.KeyNotValidUpgrade(ADDRESS_2)))
+        for _ in range(2):
+            d = km.get_key(ADDRESS_2, OpenPGPKey)
+            yield self.assertFailure(d, errors.KeyNotValidUpgrade)
+        self.assertEqual(2, km._fetcher.get.call_count)
+
+    @inlineCallbacks
+    def test_get_keys(self):
+        """
+        Test that getting many keys only fetches the missing ones.
+        """
+        km = self._key_manager(url=NICKSERVER_URI)
+        yield km._wrapper_map[OpenPGPKey].put_ascii_key(PUBLIC_KEY, ADDRESS)
+
+        class Response(object):
+            status_code = 200
+
+            def json(self):
+                return {'address': ADDRESS_2, 'openpgp': PUBLIC_KEY_2}
+
+            def raise_for_status(self):
+                pass
+
+        km._fetcher.get = Mock(return_value=succeed(Response()))
+        km.ca_cert_path = 'cacertpath'
+        keys = yield km.get_keys(
+            [ADDRESS, ADDRESS_2], OpenPGPKey, fetch_remote=False)
+        self.assertEqual(KEY_FINGERPRINT, keys[ADDRESS].fingerprint)
+        self.assertTrue(keys[ADDRESS_2].check(KeyNotFound))
+        keys = yield km.get_keys([ADDRESS, ADDRESS_2, ADDRESS], OpenPGPKey)
+        self.assertEqual(2, len(keys))
+        self.assertEqual(KEY_FINGERPRINT, keys[ADDRESS].fingerprint)
+        self.assertTrue(ADDRESS_2 in keys[ADDRESS_2].address)
+        km._fetcher.get.assert_called_once_with(
+            NICKSERVER_URI,
+            data={'address': ADDRESS_2},
+            verify='cacertpath',
+        )
+
+    @inlineCallbacks
+    def test_get_keys_local_queries(self):
+        km = self._key_manager()
+        pgp = km._wrapper_map[OpenPGPKey]
+        yield pgp.put_ascii_key(PUBLIC_KEY, ADDRESS)
+        yield pgp.put_ascii_key(PUBLIC_KEY_2, ADDRESS_2)
+        pgp._clear_key_cache()
+        self._soledad.get_from_index = Mock(
+            wraps=self._soledad.get_from_index)
+        keys = yield km.get_keys(
+            [ADDRESS, ADDRESS_2, 'missing@leap.se'], OpenPGPKey,
+            fetch_remote=False)
+        self.assertEqual(KEY_FINGERPRINT, keys[ADDRESS].fingerprint)
+        self.assertTrue(ADDRESS_2 in keys[ADDRESS_2].address)
+        self.assertTrue(keys['missing@leap.se'].check(KeyNotFound))
+        # the key document of each address and the usage documents of the
+        # keys found, without listing all the stored keys.
+        indexes = [args[0] for args, _ in
+                   self._soledad.get_from_index.call_args_list]
+        self.assertEqual(
+            [TYPE_ACTIVE_ADDRESS_PRIVATE_INDEX] * 3 +
+            [TYPE_ID_PRIVATE_INDEX] * 2, indexes)
+
     def _fetch_key(self, km, address, key):
         """
         :returns: a Deferred that will fire with the OpenPGPKey
@@ -253,7 +396,7 @@ class KeyManagerKeyManagementTestCase(KeyManagerWithSoledadTestCase):
                 pass
 
         # mock the fetcher so it returns the key for ADDRESS_2
-        km._fetcher.get = Mock(return_value=Response())
+        km._fetcher.get = Mock(return_value=succeed(Response()))
         km.ca_cert_path = 'cacertpath'
         # try to key get without fetching from server
         d_fail = km.get_key(address, OpenPGPKey, fetch_remote=False)
@@ -286,7 +429,7 @@ class KeyManagerKeyManagementTestCase(KeyManagerWithSoledadTestCase):
             ok = True
             content = PUBLIC_KEY
 
-        km._fetcher.get = Mock(return_value=Response())
+        km._fetcher.get = Mock(return_value=succeed(Response()))
         km.ca_cert_path = 'cacertpath'
 
         yield km.fetch_key(ADDRESS, "http://site.domain/key", OpenPGPKey)
@@ -303,7 +446,7 @@ class KeyManagerKeyManagementTestCase(KeyManagerWithSoledadTestCase):
             ok = True
             content = ""
 
-        km._fetcher.get = Mock(return_value=Response())
+        km._fetcher.get = Mock(return_value=succeed(Response()))
         km.ca_cert_path = 'cacertpath'
         d = km.fetch_key(ADDRESS, "http://site.domain/key", OpenPGPKey)
         return self.assertFailure(d, KeyNotFound)
@@ -319,7 +462,7 @@ class KeyManagerKeyManagementTestCase(KeyManagerWithSoledadTestCase):
             ok = True
             content = PUBLIC_KEY
 
-        km._fetcher.get = Mock(return_value=Response())
+        km._fetcher.get = Mock(return_value=succeed(Response()))
         km.ca_cert_path = 'cacertpath'
         d = km.fetch_key(ADDRESS_2, "http://site.domain/key", OpenPGPKey)
         return self.assertFailure(d, KeyAddressMismatch)
@@ -348,6 +491,174 @@ class KeyManagerCryptoTestCase(KeyManagerWithSoledadTestCase):
                                fetch_remote=False)
         self.assertEqual(signingkey.fingerprint, key.fingerprint)
 
+    @inlineCallbacks
+    def test_keymanager_openpgp_usage_written_in_batches(self):
+        km = self._key_manager()
+        pgp = km._wrapper_map[OpenPGPKey]
+        yield pgp.put_ascii_key(PUBLIC_KEY, ADDRESS)
+        self._soledad.put_doc = Mock(wraps=self._soledad.put_doc)
+        for _ in range(3):
+            yield km.encrypt(self.RAW_DATA, ADDRESS, OpenPGPKey,
+                             fetch_remote=False)
+        # the flag is seen before being written
+        self.assertEqual(0, self._soledad.put_doc.call_count)
+        key = yield km.get_key(ADDRESS, OpenPGPKey, fetch_remote=False)
+        self.assertTrue(key.encr_used)
+        yield pgp.flush_usage()
+        self.assertEqual(1, self._soledad.put_doc.call_count)
+        # flags already set are not written again
+        yield km.encrypt(self.RAW_DATA, ADDRESS, OpenPGPKey,
+                         fetch_remote=False)
+        yield pgp.flush_usage()
+        self.assertEqual(1, self._soledad.put_doc.call_count)
+        # only the usage document is written
+        doc = yield pgp._get_key_doc(ADDRESS)
+        self.assertFalse('encr_used' in doc.content)
+        usagedoc = yield pgp._get_usage_doc(
+            doc.content['key_id'], False, doc.content['fingerprint'])
+        self.assertTrue(usagedoc.content['encr_used'])
+        self.assertFalse(usagedoc.content['sign_used'])
+
+    @inlineCallbacks
+    def test_put_key_looks_up_each_doc_once(self):
+        km = self._key_manager()
+        pgp = km._wrapper_map[OpenPGPKey]
+        yield pgp.deferred_indexes
+        self._soledad.get_from_index = Mock(
+            wraps=self._soledad.get_from_index)
+        key, _ = yield pgp.parse_ascii_key(PUBLIC_KEY)
+        yield km.put_key(key, ADDRESS)
+        self.assertEqual(3, self._soledad.get_from_index.call_count)
+        # the upgrade check uses the documents looked up for the put
+        pgp._clear_key_cache()
+        key, _ = yield pgp.parse_ascii_key(PUBLIC_KEY)
+        key.validation = ValidationLevels.Provider_Trust
+        yield km.put_key(key, ADDRESS)
+        self.assertEqual(6, self._soledad.get_from_index.call_count)
+        stored = yield pgp.get_key(ADDRESS)
+        self.assertEqual(ValidationLevels.Provider_Trust, stored.validation)
+
+    @inlineCallbacks
+    def test_put_raw_keys(self):
+        km = self._key_manager()
+        progress = []
+        results = yield km.put_raw_keys(
+            [(PUBLIC_KEY, ADDRESS),
+             (PRIVATE_KEY_2, ADDRESS_2, ValidationLevels.Provider_Trust),
+             (PUBLIC_KEY, ADDRESS_2)],
+            OpenPGPKey,
+            on_result=lambda index, _: progress.append(index))
+        self.assertEqual([0, 1, 2], sorted(progress))
+        self.assertEqual(KEY_FINGERPRINT, results[0].fingerprint)
+        self.assertFalse(results[1].private)
+        self.assertTrue(results[2].check(KeyAddressMismatch))
+
+        key = yield km.get_key(ADDRESS_2, OpenPGPKey, fetch_remote=False)
+        self.assertEqual(results[1].fingerprint, key.fingerprint)
+        self.assertEqual(ValidationLevels.Provider_Trust, key.validation)
+        key = yield km.get_key(ADDRESS_2, OpenPGPKey, private=True,
+                               fetch_remote=False)
+        self.assertTrue(key.private)
+
+    @inlineCallbacks
+    def test_put_keyring_file(self):
+        km = self._key_manager()
+        path = self.get_tempfile('keyring')
+        with open(path, 'w') as f:
+            f.write(PUBLIC_KEY + PUBLIC_KEY_2)
+        results = yield km.put_keyring_file(path, OpenPGPKey)
+        self.assertEqual(2, len(results))
+        self.assertEqual(KEY_FINGERPRINT, results[0].fingerprint)
+        key = yield km.get_key(ADDRESS, OpenPGPKey, fetch_remote=False)
+        self.assertEqual(KEY_FINGERPRINT, key.fingerprint)
+        key = yield km.get_key(ADDRESS_2, OpenPGPKey, fetch_remote=False)
+        self.assertEqual(results[1].fingerprint, key.fingerprint)
+
+    @inlineCallbacks
+    def test_put_keyring_file_skips_uids_without_address(self):
+        km = self._key_manager()
+        path = self.get_tempfile('keyring')
+        with open(path, 'w') as f:
+            f.write(PUBLIC_KEY_NOADDR)
+        results = yield km.put_keyring_file(path, OpenPGPKey)
+        # only bound to the user ID with an email address
+        self.assertEqual(1, len(results))
+        key = yield km.get_key(
+            ADDRESS_NOADDR, OpenPGPKey, fetch_remote=False)
+        self.assertEqual(results[0].fingerprint, key.fingerprint)
+
+    def test_put_keyring_file_missing(self):
+        km = self._key_manager()
+        d = km.put_keyring_file(self.get_tempfile('missing'), OpenPGPKey)
+        return self.assertFailure(d, IOError)
+
+    @inlineCallbacks
+    def test_keymanager_openpgp_encrypt_to_many(self):
+        km = self._key_manager()
+        yield km._wrapper_map[OpenPGPKey].put_ascii_key(PRIVATE_KEY, ADDRESS)
+        yield km._wrapper_map[OpenPGPKey].put_ascii_key(
+            PRIVATE_KEY_2, ADDRESS_2)
+        encdata = yield km.encrypt(self.RAW_DATA, [ADDRESS, ADDRESS_2],
+                                   OpenPGPKey, fetch_remote=False)
+        # every recipient decrypts the same message
+        for address in [ADDRESS, ADDRESS_2]:
+            rawdata, _ = yield km.decrypt(
+                encdata, address, OpenPGPKey, fetch_remote=False)
+            self.assertEqual(self.RAW_DATA, rawdata)
+        key = yield km.get_key(ADDRESS_2, OpenPGPKey, fetch_remote=False)
+        self.assertTrue(key.encr_used)
+
+    @inlineCallbacks
+    def test_keymanager_openpgp_encrypt_decrypt_stream(self):
+        km = self._key_manager()
+        yield km._wrapper_map[OpenPGPKey].put_ascii_key(PRIVATE_KEY, ADDRESS)
+        yield km._wrapper_map[OpenPGPKey].put_ascii_key(
+            PRIVATE_KEY_2, ADDRESS_2)
+        data = os.urandom(200 * 1024)
+        encrypted = Mock()
+        yield km.encrypt_stream(io.BytesIO(data), encrypted, ADDRESS,
+                                OpenPGPKey, sign=ADDRESS_2, fetch_remote=False)
+        # the encrypted data is written in chunks
+        self.assertTrue(encrypted.write.call_count > 1)
+        encdata = ''.join(
+            args[0] for args, _ in encrypted.write.call_args_list)
+        decrypted = Mock()
+        signingkey = yield km.decrypt_stream(
+            io.BytesIO(encdata), decrypted, ADDRESS, OpenPGPKey,
+            verify=ADDRESS_2, fetch_remote=False)
+        self.assertEqual(
+            data,
+            ''.join(args[0] for args, _ in decrypted.write.call_args_list))
+        key = yield km.get_key(ADDRESS_2, OpenPGPKey, private=False,
+                               fetch_remote=False)
+        self.assertEqual(signingkey.fingerprint, key.fingerprint)
+
+    @inlineCallbacks
+    def test_keymanager_openpgp_encrypt_decrypt_file(self):
+        km = self._key_manager()
+        yield km._wrapper_map[OpenPGPKey].put_ascii_key(PRIVATE_KEY, ADDRESS)
+        yield km._wrapper_map[OpenPGPKey].put_ascii_key(
+            PRIVATE_KEY_2, ADDRESS_2)
+        data = os.urandom(200 * 1024)
+        path = self.get_tempfile('data')
+        with open(path, 'wb') as f:
+            f.write(data)
+        yield km.encrypt_file(path, path + '.gpg', ADDRESS, OpenPGPKey,
+                              sign=ADDRESS_2, fetch_remote=False)
+        signingkey = yield km.decrypt_file(
+            path + '.gpg', path + '.out', ADDRESS, OpenPGPKey,
+            verify=ADDRESS_2, fetch_remote=False)
+        with open(path + '.out', 'rb') as f:
+            self.assertEqual(data, f.read())
+        key = yield km.get_key(ADDRESS_2, OpenPGPKey, private=False,
+                               fetch_remote=False)
+        self.assertEqual(signingkey.fingerprint, key.fingerprint)
+        # a failed decryption leaves no output behind
+        d = km.decrypt_file(path, path + '.bad', ADDRESS, OpenPGPKey,
+                            fetch_remote=False)
+        yield self.assertFailure(d, errors.DecryptError)
+        self.assertFalse(os.path.exists(path + '.bad'))
+
     @inlineCallbacks
     def test_keymanager_openpgp_encrypt_decrypt_wrong_sign(self):
         km = self._key_manager()
@@ -365,6 +676,28 @@ class KeyManagerCryptoTestCase(KeyManagerWithSoledadTestCase):
         self.assertEqual(self.RAW_DATA, rawdata)
         self.assertTrue(isinstance(signingkey, errors.InvalidSignature))
 
+    @inlineCallbacks
+    def test_keymanager_openpgp_decrypt_many(self):
+        km = self._key_manager()
+        yield km._wrapper_map[OpenPGPKey].put_ascii_key(PRIVATE_KEY, ADDRESS)
+        yield km._wrapper_map[OpenPGPKey].put_ascii_key(
+            PRIVATE_KEY_2, ADDRESS_2)
+        encdata = yield km.encrypt(self.RAW_DATA, ADDRESS, OpenPGPKey,
+                                   sign=ADDRESS_2, fetch_remote=False)
+        streamed = []
+        results = yield km.decrypt_many(
+            [encdata, 'not encrypted', encdata], ADDRESS, OpenPGPKey,
+            verify=ADDRESS_2, fetch_remote=False, concurrency=2,
+            on_result=lambda index, _: streamed.append(index))
+        self.assertEqual([0, 1, 2], sorted(streamed))
+        self.assertEqual(3, len(results))
+        for rawdata, signingkey in [results[0], results[2]]:
+            self.assertEqual(self.RAW_DATA, rawdata)
+            self.assertTrue(ADDRESS_2 in signingkey.address)
+        self.assertTrue(results[1].check(errors.DecryptError))
+        key = yield km.get_key(ADDRESS_2, OpenPGPKey, fetch_remote=False)
+        self.assertTrue(key.sign_used)
+
     @inlineCallbacks
     def test_keymanager_openpgp_sign_verify(self):
         km = self._key_manager()
@@ -380,6 +713,65 @@ class KeyManagerCryptoTestCase(KeyManagerWithSoledadTestCase):
                                fetch_remote=False)
         self.assertEqual(signingkey.fingerprint, key.fingerprint)
 
+    @inlineCallbacks
+    def test_keymanager_openpgp_sign_verify_file(self):
+        km = self._key_manager()
+        yield km._wrapper_map[OpenPGPKey].put_ascii_key(PRIVATE_KEY, ADDRESS)
+        path = self.get_tempfile('signed')
+        with open(path, 'wb') as f:
+            f.write(self.RAW_DATA)
+        yield km.sign_file(path, path + '.sig', ADDRESS, OpenPGPKey)
+        signingkey = yield km.verify_file(
+            path, ADDRESS, OpenPGPKey, detached_sig=path + '.sig')
+        self.assertEqual(signingkey.fingerprint, KEY_FINGERPRINT)
+
+    @inlineCallbacks
+    def test_keymanager_openpgp_sign_many(self):
+        km = self._key_manager()
+        yield km._wrapper_map[OpenPGPKey].put_ascii_key(PRIVATE_KEY, ADDRESS)
+        data = ['data %d' % i for i in range(3)]
+        signatures = yield km.sign_many(data, ADDRESS, OpenPGPKey)
+        clearsigned = yield km.sign_many(
+            data, ADDRESS, OpenPGPKey, clearsign=True, detach=False)
+        results = yield km.verify_many(
+            zip(data, [ADDRESS] * 3, signatures) +
+            zip(clearsigned, [ADDRESS] * 3),
+            OpenPGPKey, fetch_remote=False)
+        self.assertEqual(
+            [KEY_FINGERPRINT] * 6, [key.fingerprint for key in results])
+
+    @inlineCallbacks
+    def test_keymanager_openpgp_verify_many(self):
+        km = self._key_manager()
+        yield km._wrapper_map[OpenPGPKey].put_ascii_key(PRIVATE_KEY, ADDRESS)
+        yield km._wrapper_map[OpenPGPKey].put_ascii_key(
+            PRIVATE_KEY_2, ADDRESS_2)
+        signdata = yield km.sign(self.RAW_DATA, ADDRESS, OpenPGPKey,
+                                 detach=False)
+        detached = yield km.sign(self.RAW_DATA, ADDRESS_2, OpenPGPKey)
+        progress = []
+        pgp = km._wrapper_map[OpenPGPKey]
+        pgp.mark_used = Mock(wraps=pgp.mark_used)
+        results = yield km.verify_many(
+            [(signdata, ADDRESS),
+             (self.RAW_DATA, ADDRESS_2, detached),
+             (signdata, 'unknown@leap.se'),
+             (signdata, ADDRESS_2),
+             (signdata, ADDRESS)],
+            OpenPGPKey, fetch_remote=False, concurrency=2,
+            on_result=lambda index, _: progress.append(index))
+        self.assertEqual(range(5), sorted(progress))
+        # each signer key is marked as used once
+        self.assertEqual(2, pgp.mark_used.call_count)
+        self.assertEqual(KEY_FINGERPRINT, results[0].fingerprint)
+        self.assertTrue(ADDRESS_2 in results[1].address)
+        self.assertTrue(results[2].check(KeyNotFound))
+        self.assertTrue(results[3].check(errors.InvalidSignature))
+        self.assertEqual(KEY_FINGERPRINT, results[4].fingerprint)
+        for address in [ADDRESS, ADDRESS_2]:
+            key = yield km.get_key(address, OpenPGPKey, fetch_remote=False)
+            self.assertTrue(key.sign_used)
+
     def test_keymanager_encrypt_key_not_found(self):
         km = self._key_manager()
         d = km._wrapper_map[OpenPGPKey].put_ascii_key(PRIVATE_KEY, ADDRESS)
@@ -427,3 +819,26 @@ QzEd9yAN+81fkIBaa6Y8LCBxV03JCc2J4eCUKXd1gg==
 =gDzy
 -----END PGP PUBLIC KEY BLOCK-----
 """
+
+# key FDDCDAC5: public key "noaddr <noaddr@leap.se>" with a second user ID
+# "No Address" without an email address
+ADDRESS_NOADDR = "noaddr@leap.se"
+PUBLIC_KEY_NOADDR = """
+-----BEGIN PGP PUBLIC KEY BLOCK-----
+
+mI0EatKnxwEEAPbH3yK1tMrJJ5Fq4hUvemjHqI0csdSue2CfYQ1fvN2bJnqUZMJN
+fZCrEELcz50xTkJXOGWRmRMulrbJTUBkqgdiWwrUamM70/cs5q+CZ3nBSxl5q+Gs
+NfZ/K/3INUYXzYiKrMkhDFh86cFAJQg/lJd/9B/deP6K46Ag8q1q4wLHABEBAAG0
+F25vYWRkciA8bm9hZGRyQGxlYXAuc2U+iM4EEwEKADgWIQSXcT0DiUDro8hYhtXl
+LbGE/dzaxQUCatKnxwIbAQULCQgHAgYVCgkICwIEFgIDAQIeAQIXgAAKCRDlLbGE
+/dzaxUGkBADdsYW2gAi8lYF79HQhwWaBCaOIniCAWNWQgrckJNmSyktZTVj3Pcxt
+CjLkuQIO7RpTIeZRXie8RnzhYWcksYKn3u+NnfOXoLlFMqNG9sC0UQvYMrtEXUqN
+m2iMsXwviNdEO3QeArzpDctrYiZ9TThrOiPXeonSPaV9RRmuDDSAm7QKTm8gQWRk
+cmVzc4jOBBMBCgA4FiEEl3E9A4lA66PIWIbV5S2xhP3c2sUFAmrSp8cCGwEFCwkI
+BwIGFQoJCAsCBBYCAwECHgECF4AACgkQ5S2xhP3c2sXGGwP/Xi37x6F2PuX2HyHl
+n+t6ybZzmEBnlBiCix31C0d218JtT7aAjEUILZkSnHKCatC3tjek5g435lmd9iu8
+Q5awQF2rlbECY3rn4p+S+lXvLEPDDyEjeY1cV8Bn7qvPG0k5LONFonYqWUfZDLzQ
+7iF0Id1IAdrbLHZkpYTiMIamHmc=
+=+Dy8
+-----END PGP PUBLIC KEY BLOCK-----
+"""
@@ -21,13 +21,33 @@ Tests for the OpenPGP support on Key Manager.
 """
 
 
-from twisted.internet.defer import inlineCallbacks
+import io
+import json
+import os
+
+from mock import Mock, patch
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.python.threadable import isInIOThread
 
 from leap.keymanager import (
     KeyNotFound,
     openpgp,
 )
+from leap.keymanager.errors import InvalidPacket
+from leap.keymanager.keys import (
+    KEY_ACTIVE_ADDRESS_KEY,
+    KEY_ADDRESS_KEY,
+    KEY_ENCR_USED_KEY,
+    KEY_ID_KEY,
+    KEY_PRIVATE_KEY,
+    KEY_TAGS_KEY,
+    KEY_TYPE_KEY,
+    KEYMANAGER_ACTIVE_TAG,
+    KEYMANAGER_USAGE_TAG,
+    TAGS_PRIVATE_INDEX,
+)
 from leap.keymanager.openpgp import OpenPGPKey
+from leap.keymanager.validation import ValidationLevels
 from leap.keymanager.tests import (
     KeyManagerWithSoledadTestCase,
     ADDRESS,
@@ -35,6 +55,7 @@ from leap.keymanager.tests import (
     KEY_FINGERPRINT,
     PUBLIC_KEY,
     PUBLIC_KEY_2,
+    PUBLIC_KEY_MULTI_UID,
     PRIVATE_KEY,
     PRIVATE_KEY_2,
 )
@@ -105,19 +126,20 @@ class OpenPGPCryptoTestCase(KeyManagerWithSoledadTestCase):
         # encrypt
         yield pgp.put_ascii_key(PUBLIC_KEY, ADDRESS)
         pubkey = yield pgp.get_key(ADDRESS, private=False)
-        cyphertext = pgp.encrypt(data, pubkey)
+        cyphertext = yield pgp.encrypt(data, pubkey)
 
         self.assertTrue(cyphertext is not None)
         self.assertTrue(cyphertext != '')
         self.assertTrue(cyphertext != data)
         self.assertTrue(pgp.is_encrypted(cyphertext))
         self.assertTrue(pgp.is_encrypted(cyphertext))
+        self.assertEqual(1, len(pgp.get_recipients(cyphertext)))
 
         # decrypt
         yield self._assert_key_not_found(pgp, ADDRESS, private=True)
         yield pgp.put_ascii_key(PRIVATE_KEY, ADDRESS)
         privkey = yield pgp.get_key(ADDRESS, private=True)
-        decrypted, _ = pgp.decrypt(cyphertext, privkey)
+        decrypted, _ = yield pgp.decrypt(cyphertext, privkey)
         self.assertEqual(decrypted, data)
 
         yield pgp.delete_key(pubkey)
@@ -132,7 +154,7 @@ class OpenPGPCryptoTestCase(KeyManagerWithSoledadTestCase):
             self._soledad, gpgbinary=self.gpg_binary_path)
         yield pgp.put_ascii_key(PRIVATE_KEY, ADDRESS)
         privkey = yield pgp.get_key(ADDRESS, private=True)
-        signed = pgp.sign(data, privkey)
+        signed = yield pgp.sign(data, privkey)
         self.assertRaises(
             AssertionError,
             pgp.verify, signed, privkey)
@@ -154,10 +176,11 @@ class OpenPGPCryptoTestCase(KeyManagerWithSoledadTestCase):
             self._soledad, gpgbinary=self.gpg_binary_path)
         yield pgp.put_ascii_key(PRIVATE_KEY, ADDRESS)
         privkey = yield pgp.get_key(ADDRESS, private=True)
-        signed = pgp.sign(data, privkey)
+        signed = yield pgp.sign(data, privkey)
         yield pgp.put_ascii_key(PUBLIC_KEY_2, ADDRESS_2)
         wrongkey = yield pgp.get_key(ADDRESS_2)
-        self.assertFalse(pgp.verify(signed, wrongkey))
+        validsign = yield pgp.verify(signed, wrongkey)
+        self.assertFalse(validsign)
 
     @inlineCallbacks
     def test_encrypt_sign_with_public_raises(self):
@@ -179,7 +202,7 @@ class OpenPGPCryptoTestCase(KeyManagerWithSoledadTestCase):
         yield pgp.put_ascii_key(PRIVATE_KEY, ADDRESS)
         privkey = yield pgp.get_key(ADDRESS, private=True)
         pubkey = yield pgp.get_key(ADDRESS, private=False)
-        encrypted_and_signed = pgp.encrypt(
+        encrypted_and_signed = yield pgp.encrypt(
             data, pubkey, sign=privkey)
         self.assertRaises(
             AssertionError,
@@ -194,11 +217,11 @@ class OpenPGPCryptoTestCase(KeyManagerWithSoledadTestCase):
         yield pgp.put_ascii_key(PRIVATE_KEY, ADDRESS)
         privkey = yield pgp.get_key(ADDRESS, private=True)
         pubkey = yield pgp.get_key(ADDRESS, private=False)
-        encrypted_and_signed = pgp.encrypt(data, pubkey, sign=privkey)
+        encrypted_and_signed = yield pgp.encrypt(data, pubkey, sign=privkey)
         yield pgp.put_ascii_key(PUBLIC_KEY_2, ADDRESS_2)
         wrongkey = yield pgp.get_key(ADDRESS_2)
-        decrypted, validsign = pgp.decrypt(encrypted_and_signed, privkey,
-                                           verify=wrongkey)
+        decrypted, validsign = yield pgp.decrypt(
+            encrypted_and_signed, privkey, verify=wrongkey)
         self.assertEqual(decrypted, data)
         self.assertFalse(validsign)
 
@@ -209,9 +232,9 @@ class OpenPGPCryptoTestCase(KeyManagerWithSoledadTestCase):
             self._soledad, gpgbinary=self.gpg_binary_path)
         yield pgp.put_ascii_key(PRIVATE_KEY, ADDRESS)
         privkey = yield pgp.get_key(ADDRESS, private=True)
-        signed = pgp.sign(data, privkey, detach=False)
+        signed = yield pgp.sign(data, privkey, detach=False)
         pubkey = yield pgp.get_key(ADDRESS, private=False)
-        validsign = pgp.verify(signed, pubkey)
+        validsign = yield pgp.verify(signed, pubkey)
         self.assertTrue(validsign)
 
     @inlineCallbacks
@@ -228,13 +251,24 @@ class OpenPGPCryptoTestCase(KeyManagerWithSoledadTestCase):
         privkey2 = yield pgp.get_key(ADDRESS_2, private=True)
 
         data = 'data'
-        encrypted_and_signed = pgp.encrypt(
+        encrypted_and_signed = yield pgp.encrypt(
             data, pubkey2, sign=privkey)
-        res, validsign = pgp.decrypt(
+        res, validsign = yield pgp.decrypt(
             encrypted_and_signed, privkey2, verify=pubkey)
         self.assertEqual(data, res)
         self.assertTrue(validsign)
 
+    @inlineCallbacks
+    def test_get_signers(self):
+        data = 'data'
+        pgp = openpgp.OpenPGPScheme(
+            self._soledad, gpgbinary=self.gpg_binary_path)
+        yield pgp.put_ascii_key(PRIVATE_KEY, ADDRESS)
+        privkey = yield pgp.get_key(ADDRESS, private=True)
+        signed = yield pgp.sign(data, privkey, detach=False)
+        self.assertFalse(pgp.is_encrypted(signed))
+        self.assertEqual([privkey.key_id], pgp.get_signers(signed))
+
     @inlineCallbacks
     def test_sign_verify_detached_sig(self):
         data = 'data'
@@ -244,9 +278,280 @@ class OpenPGPCryptoTestCase(KeyManagerWithSoledadTestCase):
         privkey = yield pgp.get_key(ADDRESS, private=True)
         signature = yield pgp.sign(data, privkey, detach=True)
         pubkey = yield pgp.get_key(ADDRESS, private=False)
-        validsign = pgp.verify(data, pubkey, detached_sig=signature)
+        validsign = yield pgp.verify(data, pubkey, detached_sig=signature)
         self.assertTrue(validsign)
 
+    @inlineCallbacks
+    def test_verify_stream_detached_sig(self):
+        data = os.urandom(200 * 1024)
+        pgp = openpgp.OpenPGPScheme(
+            self._soledad, gpgbinary=self.gpg_binary_path)
+        yield pgp.put_ascii_key(PRIVATE_KEY, ADDRESS)
+        privkey = yield pgp.get_key(ADDRESS, private=True)
+        signature = yield pgp.sign(data, privkey, detach=True)
+        pubkey = yield pgp.get_key(ADDRESS, private=False)
+        validsign = yield pgp.verify_stream(
+            io.BytesIO(data), pubkey, detached_sig=signature)
+        self.assertTrue(validsign)
+        validsign = yield pgp.verify_stream(
+            io.BytesIO(data[1:]), pubkey, detached_sig=signature)
+        self.assertFalse(validsign)
+
+    @inlineCallbacks
+    def test_parse_ascii_key_without_gpg(self):
+        pgp = openpgp.OpenPGPScheme(
+            self._soledad, gpgbinary=self.gpg_binary_path)
+        self.addCleanup(pgp.close)
+        for key_data in (PRIVATE_KEY, PUBLIC_KEY_MULTI_UID):
+            yield self._assert_parsed_without_gpg(pgp, key_data)
+        # only the certifications of the first user ID are listed
+        key, _ = yield pgp.parse_ascii_key(PUBLIC_KEY_MULTI_UID)
+        self.assertEqual([key.key_id], key.signatures)
+
+    @inlineCallbacks
+    def _assert_parsed_without_gpg(self, pgp, key_data):
+        with_gpg = pgp._parse_ascii_key_with_gpg(key_data)
+        temporary_gpgwrapper = pgp._temporary_gpgwrapper
+        pgp._temporary_gpgwrapper = None
+        try:
+            without_gpg = yield pgp.parse_ascii_key(key_data)
+        finally:
+            pgp._temporary_gpgwrapper = temporary_gpgwrapper
+        for key, expected in zip(without_gpg, with_gpg):
+            self.assertEqual(expected.address, key.address)
+            self.assertEqual(expected.key_id, key.key_id)
+            self.assertEqual(expected.fingerprint, key.fingerprint)
+            self.assertEqual(expected.private, key.private)
+            self.assertEqual(expected.length, key.length)
+            self.assertEqual(expected.expiry_date, key.expiry_date)
+            self.assertEqual(expected.signatures, key.signatures)
+
+    @inlineCallbacks
+    def test_gpg_runs_off_the_reactor_thread(self):
+        data = 'data'
+        pgp = openpgp.OpenPGPScheme(
+            self._soledad, gpgbinary=self.gpg_binary_path)
+        self.addCleanup(pgp.close)
+        yield pgp.put_ascii_key(PUBLIC_KEY, ADDRESS)
+        pubkey = yield pgp.get_key(ADDRESS, private=False)
+        wrapper = pgp._temporary_gpgwrapper
+        threads = []
+
+        def temporary_gpgwrapper(keys=None):
+            threads.append(isInIOThread())
+            return wrapper(keys)
+
+        pgp._temporary_gpgwrapper = temporary_gpgwrapper
+        yield pgp.encrypt(data, pubkey)
+        # and so do merging keys and parsing the keys the in-process parser
+        # doesn't support
+        with patch.object(openpgp, '_has_new_packets', return_value=True):
+            yield pgp.put_key(pubkey, ADDRESS)
+        with patch.object(openpgp.packets, 'parse_key',
+                          side_effect=InvalidPacket('unsupported')):
+            key, _ = yield pgp.parse_ascii_key(PUBLIC_KEY)
+        self.assertEqual(KEY_FINGERPRINT, key.fingerprint)
+        self.assertEqual([False] * 3, threads)
+
+    @inlineCallbacks
+    def test_keyring_is_reused_and_emptied(self):
+        pgp = openpgp.OpenPGPScheme(
+            self._soledad, gpgbinary=self.gpg_binary_path,
+            keyring_pool_size=1)
+        yield pgp.put_ascii_key(PUBLIC_KEY, ADDRESS)
+        pubkey = yield pgp.get_key(ADDRESS, private=False)
+        with pgp._temporary_gpgwrapper(pubkey) as gpg:
+            homedir = gpg.homedir
+            self.assertEqual(1, len(gpg.list_keys()))
+        with pgp._temporary_gpgwrapper() as gpg:
+            self.assertEqual(homedir, gpg.homedir)
+            self.assertEqual(0, len(gpg.list_keys()))
+        pgp.close()
+        self.assertFalse(os.path.exists(homedir))
+
+    def test_keyring_pool_size(self):
+        pgp = openpgp.OpenPGPScheme(
+            self._soledad, gpgbinary=self.gpg_binary_path,
+            keyring_pool_size=1)
+        with pgp._temporary_gpgwrapper() as gpg1:
+            with pgp._temporary_gpgwrapper() as gpg2:
+                self.assertNotEqual(gpg1.homedir, gpg2.homedir)
+        # only the most recently used keyring is kept in the pool
+        self.assertTrue(os.path.exists(gpg1.homedir))
+        self.assertFalse(os.path.exists(gpg2.homedir))
+        pgp.close()
+
+    @inlineCallbacks
+    def test_keyring_cache(self):
+        pgp = openpgp.OpenPGPScheme(
+            self._soledad, gpgbinary=self.gpg_binary_path)
+        yield pgp.put_ascii_key(PRIVATE_KEY, ADDRESS)
+        yield pgp.put_ascii_key(PUBLIC_KEY_2, ADDRESS_2)
+        pubkey = yield pgp.get_key(ADDRESS, private=False)
+        pubkey2 = yield pgp.get_key(ADDRESS_2, private=False)
+        with pgp._temporary_gpgwrapper(pubkey) as gpg:
+            homedir = gpg.homedir
+        with pgp._temporary_gpgwrapper(pubkey2) as gpg:
+            homedir2 = gpg.homedir
+        # keyrings prepared for the same keys are reused
+        with pgp._temporary_gpgwrapper(pubkey) as gpg:
+            self.assertEqual(homedir, gpg.homedir)
+        with pgp._temporary_gpgwrapper(pubkey2) as gpg:
+            self.assertEqual(homedir2, gpg.homedir)
+        # and dropped when the key material changes
+        yield pgp.put_ascii_key(PUBLIC_KEY, ADDRESS)
+        idle = pgp._keyring_pool._idle
+        self.assertFalse(
+            any([k.contains(pubkey.fingerprint) for k in idle]))
+        self.assertTrue(
+            any([k.contains(pubkey2.fingerprint) for k in idle]))
+        pgp.close()
+
+    @inlineCallbacks
+    def test_keyring_pool_drops_private_keys(self):
+        pgp = openpgp.OpenPGPScheme(
+            self._soledad, gpgbinary=self.gpg_binary_path)
+        yield pgp.put_ascii_key(PRIVATE_KEY, ADDRESS)
+        privkey = yield pgp.get_key(ADDRESS, private=True)
+        with pgp._temporary_gpgwrapper(privkey) as gpg:
+            homedir = gpg.homedir
+            self.assertEqual(1, len(gpg.list_keys(secret=True)))
+        # the keyring is kept for reuse, without the private key
+        with pgp._temporary_gpgwrapper() as gpg:
+            self.assertEqual(homedir, gpg.homedir)
+            self.assertEqual(0, len(gpg.list_keys(secret=True)))
+        pgp.close()
+
+    @inlineCallbacks
+    def test_key_cache(self):
+        pgp = openpgp.OpenPGPScheme(
+            self._soledad, gpgbinary=self.gpg_binary_path)
+        yield pgp.put_ascii_key(PUBLIC_KEY, ADDRESS)
+        key = yield pgp.get_key(ADDRESS, private=False)
+        # keys are cached as they are stored
+        self.assertEqual(1, pgp.get_key_cache_stats()['hits'])
+        key.validation = ValidationLevels.Provider_Endorsement
+        cached = yield pgp.get_key(ADDRESS, private=False)
+        self.assertEqual(KEY_FINGERPRINT, cached.fingerprint)
+        self.assertNotEqual(key.validation, cached.validation)
+        # and dropped when deleted
+        yield pgp.delete_key(key)
+        yield self._assert_key_not_found(pgp, ADDRESS)
+        self.assertEqual(0, pgp.get_key_cache_stats()['entries'])
+        pgp.close()
+
+    @inlineCallbacks
+    def test_put_unchanged_key_skips_merge(self):
+        pgp = openpgp.OpenPGPScheme(
+            self._soledad, gpgbinary=self.gpg_binary_path)
+        yield pgp.put_ascii_key(PUBLIC_KEY, ADDRESS)
+        pgp._merge_keys = Mock(wraps=pgp._merge_keys)
+        self._soledad.put_doc = Mock(wraps=self._soledad.put_doc)
+        # the same key material is not merged nor written again
+        yield pgp.put_ascii_key(PUBLIC_KEY, ADDRESS)
+        self.assertFalse(pgp._merge_keys.called)
+        self.assertFalse(self._soledad.put_doc.called)
+        # but its metadata is
+        key, _ = yield pgp.parse_ascii_key(PUBLIC_KEY)
+        key.validation = ValidationLevels.Provider_Endorsement
+        yield pgp.put_key(key, ADDRESS)
+        self.assertFalse(pgp._merge_keys.called)
+        key = yield pgp.get_key(ADDRESS, private=False)
+        self.assertEqual(ValidationLevels.Provider_Endorsement,
+                         key.validation)
+        pgp.close()
+
+    @inlineCallbacks
+    def test_migrate_active_docs(self):
+        yield self._put_key_with_active_doc()
+        pgp = openpgp.OpenPGPScheme(
+            self._soledad, gpgbinary=self.gpg_binary_path)
+        key = yield pgp.get_key(ADDRESS, private=False)
+        self.assertEqual(KEY_FINGERPRINT, key.fingerprint)
+        activedocs = yield self._soledad.get_from_index(
+            TAGS_PRIVATE_INDEX, KEYMANAGER_ACTIVE_TAG, '0')
+        self.assertEqual([], activedocs)
+        pgp.close()
+
+    @inlineCallbacks
+    def test_get_key_waits_for_migration(self):
+        yield self._put_key_with_active_doc()
+        started = Deferred()
+        migration = Deferred()
+        migrate_active_doc = openpgp.OpenPGPScheme._migrate_active_doc
+
+        def slow_migrate_active_doc(pgp, activedoc):
+            started.callback(None)
+            migration.addCallback(
+                lambda _: migrate_active_doc(pgp, activedoc))
+            return migration
+
+        with patch.object(openpgp.OpenPGPScheme, '_migrate_active_doc',
+                          slow_migrate_active_doc):
+            pgp = openpgp.OpenPGPScheme(
+                self._soledad, gpgbinary=self.gpg_binary_path)
+            self.addCleanup(pgp.close)
+            d = pgp.get_key(ADDRESS, private=False)
+            ready = pgp.wait_ready()
+            # the key is only active for the address in its key document
+            # once the migration is done
+            yield started
+            self.assertFalse(d.called)
+            self.assertFalse(ready.called)
+            migration.callback(None)
+            key = yield d
+        self.assertEqual(KEY_FINGERPRINT, key.fingerprint)
+        self.assertTrue(ready.called)
+
+    @inlineCallbacks
+    def _put_key_with_active_doc(self):
+        """
+        Store PUBLIC_KEY, and the document marking it as active for ADDRESS,
+        as previous versions did.
+        """
+        pgp = openpgp.OpenPGPScheme(
+            self._soledad, gpgbinary=self.gpg_binary_path)
+        key, _ = yield pgp.parse_ascii_key(PUBLIC_KEY)
+        content = json.loads(key.get_json())
+        del content[KEY_ACTIVE_ADDRESS_KEY]
+        yield self._soledad.create_doc(content)
+        yield self._soledad.create_doc({
+            KEY_ADDRESS_KEY: ADDRESS,
+            KEY_TYPE_KEY: pgp.ACTIVE_TYPE,
+            KEY_ID_KEY: key.key_id,
+            KEY_PRIVATE_KEY: False,
+            KEY_TAGS_KEY: [KEYMANAGER_ACTIVE_TAG],
+        })
+        pgp.close()
+
+    @inlineCallbacks
+    def test_usage_moved_out_of_key_docs(self):
+        pgp = openpgp.OpenPGPScheme(
+            self._soledad, gpgbinary=self.gpg_binary_path)
+        key, _ = yield pgp.parse_ascii_key(PUBLIC_KEY)
+        # store the key as previous versions did, with its usage
+        content = json.loads(key.get_json(active_address=[ADDRESS]))
+        content[KEY_ENCR_USED_KEY] = True
+        yield self._soledad.create_doc(content)
+
+        key = yield pgp.get_key(ADDRESS, private=False)
+        self.assertTrue(key.encr_used)
+        yield pgp.put_ascii_key(PUBLIC_KEY, ADDRESS)
+        doc = yield pgp._get_key_doc(ADDRESS)
+        self.assertFalse(KEY_ENCR_USED_KEY in doc.content)
+        usagedocs = yield self._soledad.get_from_index(
+            TAGS_PRIVATE_INDEX, KEYMANAGER_USAGE_TAG, '0')
+        self.assertEqual(1, len(usagedocs))
+        self.assertTrue(usagedocs[0].content[KEY_ENCR_USED_KEY])
+        key = yield pgp.get_key(ADDRESS, private=False)
+        self.assertTrue(key.encr_used)
+
+        yield pgp.delete_key(key)
+        usagedocs = yield self._soledad.get_from_index(
+            TAGS_PRIVATE_INDEX, KEYMANAGER_USAGE_TAG, '0')
+        self.assertEqual([], usagedocs)
+        pgp.close()
+
     def _assert_key_not_found(self, pgp, address, private=False):
         d = pgp.get_key(address, private=private)
         return self.assertFailure(d, KeyNotFound)
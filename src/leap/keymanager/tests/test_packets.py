@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# test_packets.py
+# Copyright (C) 2015 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the in-process inspection of OpenPGP packets.
+"""
+
+
+from twisted.trial import unittest
+
+from leap.keymanager import packets
+from leap.keymanager.errors import InvalidPacket
+from leap.keymanager.tests import (
+    KEY_FINGERPRINT,
+    PRIVATE_KEY,
+    PUBLIC_KEY,
+    PUBLIC_KEY_2,
+    PUBLIC_KEY_MULTI_UID,
+)
+
+
+class PacketsTestCase(unittest.TestCase):
+
+    def test_encrypted_message(self):
+        self.assertTrue(packets.is_encrypted_asym(ENCRYPTED))
+        self.assertEqual([ENCRYPTION_SUBKEY_ID_2],
+                         packets.get_recipients(ENCRYPTED))
+        self.assertEqual([], packets.get_issuers(ENCRYPTED))
+
+    def test_binary_message(self):
+        data = packets.dearmor(ENCRYPTED)
+        self.assertEqual(data, packets.dearmor(data))
+        self.assertTrue(packets.is_encrypted_asym(data))
+        self.assertEqual([ENCRYPTION_SUBKEY_ID_2],
+                         packets.get_recipients(data))
+
+    def test_message_inside_text(self):
+        data = 'Some text\n\n%s\nMore text' % (ENCRYPTED,)
+        self.assertTrue(packets.is_encrypted_asym(data))
+
+    def test_signed_message(self):
+        # the signature is inside a compressed packet
+        self.assertFalse(packets.is_encrypted_asym(SIGNED))
+        self.assertEqual([], packets.get_recipients(SIGNED))
+        self.assertEqual([KEY_FINGERPRINT[-16:]],
+                         packets.get_issuers(SIGNED))
+
+    def test_detached_signature(self):
+        self.assertFalse(packets.is_encrypted_asym(DETACHED_SIGNATURE))
+        self.assertEqual([KEY_ID_2],
+                         packets.get_issuers(DETACHED_SIGNATURE))
+
+    def test_not_openpgp_data(self):
+        self.assertFalse(packets.is_encrypted_asym('data'))
+        self.assertRaises(InvalidPacket, packets.get_recipients, 'data')
+        self.assertRaises(InvalidPacket, packets.get_issuers, 'data')
+
+    def test_truncated_packet(self):
+        data = packets.dearmor(ENCRYPTED)[:20]
+        self.assertRaises(InvalidPacket, packets.get_recipients, data)
+
+    def test_parse_public_key(self):
+        key = packets.parse_key(PUBLIC_KEY)
+        self.assertFalse(key.secret)
+        self.assertEqual(KEY_FINGERPRINT, key.fingerprint)
+        self.assertEqual(KEY_FINGERPRINT[-16:], key.key_id)
+        self.assertEqual(['Leap Test Key <leap@leap.se>'], key.uids)
+        self.assertEqual(4096, key.length)
+        self.assertEqual(None, key.expires)
+        self.assertEqual(
+            [('Leap Test Key <leap@leap.se>', [KEY_FINGERPRINT[-16:]])],
+            key.uid_signatures)
+
+    def test_parse_key_signatures_by_uid(self):
+        key = packets.parse_key(PUBLIC_KEY_MULTI_UID)
+        self.assertEqual(
+            [('multi <multi@leap.se>', [KEY_ID_MULTI_UID]),
+             ('other <other@leap.se>', [KEY_ID_2, KEY_ID_MULTI_UID])],
+            key.uid_signatures)
+
+    def test_parse_private_key(self):
+        key = packets.parse_key(PRIVATE_KEY)
+        self.assertTrue(key.secret)
+        self.assertEqual(KEY_FINGERPRINT, key.fingerprint)
+        # the public key is exported without the secret material
+        public = packets.parse_key(key.export())
+        self.assertFalse(public.secret)
+        self.assertEqual(KEY_FINGERPRINT, public.fingerprint)
+        self.assertTrue(packets.parse_key(key.export(secret=True)).secret)
+
+    def test_parse_not_a_key(self):
+        self.assertRaises(InvalidPacket, packets.parse_key, ENCRYPTED)
+        keyring = packets.dearmor(PUBLIC_KEY) + packets.dearmor(PUBLIC_KEY_2)
+        self.assertRaises(InvalidPacket, packets.parse_key, keyring)
+
+    def test_split_keys(self):
+        keyring = packets.dearmor(PUBLIC_KEY) + packets.dearmor(PUBLIC_KEY_2)
+        keys = packets.split_keys(keyring)
+        self.assertEqual(2, len(keys))
+        self.assertEqual(KEY_FINGERPRINT,
+                         packets.parse_key(keys[0]).fingerprint)
+        self.assertEqual(KEY_ID_2, packets.parse_key(keys[1]).key_id)
+        # armored keys, one block each
+        self.assertEqual(keys, packets.split_keys(PUBLIC_KEY + PUBLIC_KEY_2))
+        self.assertRaises(InvalidPacket, packets.split_keys, ENCRYPTED)
+
+    def test_key_digests(self):
+        digests = packets.key_digests(PUBLIC_KEY)
+        # the armor doesn't matter
+        self.assertEqual(digests, packets.key_digests(
+            packets.parse_key(PUBLIC_KEY).export()))
+        self.assertEqual(digests, packets.key_digests(
+            packets.dearmor(PUBLIC_KEY)))
+        # the public part of the private key is in the public key
+        public = packets.parse_key(PRIVATE_KEY).export()
+        self.assertTrue(packets.key_digests(public).issubset(digests))
+        self.assertFalse(digests.issubset(
+            packets.key_digests(PUBLIC_KEY_2)))
+
+
+# Data for testing
+
+ENCRYPTION_SUBKEY_ID_2 = "53B044BB91D01A17"
+KEY_ID_2 = "7F9DFA687FEE575A"
+KEY_ID_MULTI_UID = "9D3967DF862EBB01"
+
+# "hello" encrypted to anotheruser@leap.se
+ENCRYPTED = """
+-----BEGIN PGP MESSAGE-----
+
+hIwDU7BEu5HQGhcBA/42Z+mmOt1q/MOh2BfzNkfAukGj5KjfVGNVpqLxA40XqXrb
+W2X0DeEUtqkeASXjTFGw1NivgJZtDrs5M2GM3sN8ENFqO8XGVp7ZhusYJwHsFeXo
+wcMFdyVyCaI1rN+pdgZX6TjoKbM7Xigg8TY+/BiO1jarQ6/qlG0CQQb5QYrw69JE
+AQ9HzedFl1gBVOewtwFvISjWcpqiMlet+YdFpcH4QmW+MYvic2kSIrkg6ELHpSg3
+jZmugfYLCRnEJ82viXFd568VV9s=
+=DWCv
+-----END PGP MESSAGE-----
+"""
+
+# "hello" signed by leap@leap.se
+SIGNED = """
+-----BEGIN PGP MESSAGE-----
+
+owEBZAKb/ZANAwAKAS9FXigk0Y3fAawPYgNtc2dq0qAcaGVsbG8KiQJBBAABCgAr
+FiEE425zjWkXPBPXCeRPL0VeKCTRjd8FAmrSoBwNHGxlYXBAbGVhcC5zZQAKCRAv
+RV4oJNGN3z4GD/9UX4s+FV1VAFhxMIWP1qHudsGeQO2/p8NbPXGzNsFYt9YylGEp
+6LxA8ErNmFFYj+v2VpG3XFMN7Ws/TonPqX+9q33BgY5IwK++D/rQ/kfynFL/5/Cs
+1SSDvlZCFW1vI3eykMyVaIaOBPVlInVCuU7K1bhUZqmzxyOi3FouuHiASL1o1/Zb
+q4BjNLenNGQ7SUfMYEKteo7JcUcjPoYyqb236swQ8S/3jNagoxGq2ZQGnVNcz7B/
+CIYrP/F1Rhm47IZVTXlIzqOxyCoCx9OFlykEyGsCfRCrVigV+aFS/MsJyGInq8ZQ
+ALJqj3r4rKmclSr0ogYN3ju/EKp05ZQcgtX1yiZPe5UKfcWVXlWHP9oL1bo+R5kJ
+pJ386jcHePU1X9fx5JY+G1RpmW5EkY4NiSCGnEaAMBK4pmcwDLcGim7QoeidIjM6
+h7ovh7V2vqPVIeYFfK3z/4yAqlF09FjA0ADBo6R21MKAmuEo3uxSnUT38l6ZSNkQ
+4DNjz1wy+RtEX2kM9Vz5IUUy7qzIspBnZEJ/MNnp5OKkE5JQOj4s2K86iMmvfgY1
+jZ7CdfVpHqPkSXCuxLYjD4svG2FgKCdtdp+uyjWDc9MCLE+MGAX+vTDYyJzNYLtc
+PHpxIvSrU8o41gHlZFCvMmMhMxtlKy4XRD3r4KAKwJuuHms71kBLIg90fA==
+=82Da
+-----END PGP MESSAGE-----
+"""
+
+# "hello" detached signature by anotheruser@leap.se
+DETACHED_SIGNATURE = """
+-----BEGIN PGP SIGNATURE-----
+
+iMgEAAEKADIWIQT24rVyrbhOpYvS6aV/nfpof+5XWgUCatKgFhQcYW5vdGhlcnVz
+ZXJAbGVhcC5zZQAKCRB/nfpof+5XWrrCA/9lHhDyborBBgYpehH7pgvVfkilcPBG
+aKKA5BvrIvBawrJnhaP+YnYzCTy7hYxvB7oH2iS4rwAQb6QUk4tG5/Ky4bnSK2Ha
+6N2AKhcfh75GwUQqXk+PVtOjjzwQkc5Vey8UmTFofq3C0oFTKVMgWV/9vgUhS3UC
+ystHdbEI7ThNTw==
+=ygqi
+-----END PGP SIGNATURE-----
+"""
@@ -30,6 +30,7 @@ from leap.keymanager.tests import (
     KeyManagerWithSoledadTestCase,
     ADDRESS,
     PUBLIC_KEY,
+    PRIVATE_KEY,
     KEY_FINGERPRINT
 )
 from leap.keymanager.validation import ValidationLevels
@@ -118,6 +119,35 @@ class ValidationLevelsTestCase(KeyManagerWithSoledadTestCase):
             validation=ValidationLevels.Provider_Endorsement)
         yield self.assertFailure(d, KeyNotValidUpgrade)
 
+    @inlineCallbacks
+    def test_bulk_cant_upgrade_keeps_private_key(self):
+        km = self._key_manager()
+        yield km.put_raw_key(PRIVATE_KEY, OpenPGPKey, ADDRESS,
+                             validation=ValidationLevels.Provider_Trust)
+        results = yield km.put_raw_keys(
+            [(UNEXPIRED_PRIVATE, ADDRESS)], OpenPGPKey)
+        self.assertTrue(results[0].check(KeyNotValidUpgrade))
+        key = yield km.get_key(ADDRESS, OpenPGPKey, private=True,
+                               fetch_remote=False)
+        self.assertEqual(key.fingerprint, KEY_FINGERPRINT)
+        key = yield km.get_key(ADDRESS, OpenPGPKey, fetch_remote=False)
+        self.assertEqual(key.fingerprint, KEY_FINGERPRINT)
+
+    @inlineCallbacks
+    def test_bulk_private_key_upgrade_is_not_checked(self):
+        km = self._key_manager()
+        pgp = km._wrapper_map[OpenPGPKey]
+        yield pgp.put_ascii_key(PRIVATE_KEY, ADDRESS)
+        pubkey = yield pgp.get_key(ADDRESS)
+        yield pgp.delete_key(pubkey)
+        # like put_raw_key, only the upgrade of the public key is checked
+        results = yield km.put_raw_keys(
+            [(UNEXPIRED_PRIVATE, ADDRESS)], OpenPGPKey)
+        self.assertEqual(EXPIRED_FINGERPRINT, results[0].fingerprint)
+        key = yield km.get_key(ADDRESS, OpenPGPKey, private=True,
+                               fetch_remote=False)
+        self.assertEqual(EXPIRED_FINGERPRINT, key.fingerprint)
+
     @inlineCallbacks
     def test_signed_key(self):
         km = self._key_manager()
@@ -126,6 +156,14 @@ class ValidationLevelsTestCase(KeyManagerWithSoledadTestCase):
         key = yield km.get_key(ADDRESS, OpenPGPKey, fetch_remote=False)
         self.assertEqual(key.fingerprint, SIGNED_FINGERPRINT)
 
+    @inlineCallbacks
+    def test_signatures_are_stored(self):
+        km = self._key_manager()
+        yield km.put_raw_key(SIGNED_KEY, OpenPGPKey, ADDRESS)
+        key = yield km.get_key(ADDRESS, OpenPGPKey, fetch_remote=False)
+        # the signatures were listed when parsing the key, not on access
+        self.assertIn(KEY_FINGERPRINT[-16:], key._signatures)
+
 
 # Key material for testing
 